@@ -0,0 +1,75 @@
+"""
+Measures the decoding speed of vi3o in frames per second:
+
+    python benchmark.py [--frames N] [--modes rgb,grey] [--threads N] [--size WxH]
+                        [--prefetch N] video.mkv [...]
+
+Pass for example one 1080p and one 4K recording to compare the performance
+of different versions of vi3o at different resolutions, or of the different
+output modes. To compare with an older version, build it in a separate
+worktree and run this benchmark from there as well, as the vi3o next to the
+script is the one imported:
+
+    git worktree add ../vi3o-before <commit>
+    cp benchmark.py ../vi3o-before/
+    (cd ../vi3o-before && python setup.py build_ext --inplace &&
+     python benchmark.py --modes rgb,grey ~/1080p.mkv ~/4k.mkv)
+    python setup.py build_ext --inplace
+    python benchmark.py --modes rgb,grey ~/1080p.mkv ~/4k.mkv
+"""
+
+import argparse
+import time
+
+from vi3o import Video
+
+
+def benchmark(filename, frames, **kwargs):
+    video = Video(filename, **kwargs)
+    it = iter(video)
+    img = next(it)  # Exclude the decoder setup
+    count = 0
+    t0 = time.time()
+    for img in it:
+        count += 1
+        if count >= frames:
+            break
+    return img.shape, count / (time.time() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark vi3o decoding')
+    parser.add_argument('--frames', type=int, default=300, help='Number of frames to decode')
+    parser.add_argument('--modes', default='rgb', help='Comma separated list of output '
+                        'modes to benchmark, rgb or grey (default: rgb)')
+    parser.add_argument('--threads', type=int, help='Number of decoder threads (mkv only)')
+    parser.add_argument('--thread-type', choices=['frame', 'slice'],
+                        help='Kind of decoder threading (mkv only)')
+    parser.add_argument('--size', help='Scale the frames to this size while decoding, '
+                        'e.g. 640x360 (mkv only)')
+    parser.add_argument('--prefetch', type=int, help='Number of frames to decode ahead '
+                        'in a background thread')
+    parser.add_argument('videos', nargs='+')
+    args = parser.parse_args()
+
+    kwargs = {}
+    if args.threads is not None:
+        kwargs['threads'] = args.threads
+    if args.thread_type is not None:
+        kwargs['thread_type'] = args.thread_type
+    if args.prefetch is not None:
+        kwargs['prefetch'] = args.prefetch
+    if args.size is not None:
+        kwargs['size'] = tuple(int(v) for v in args.size.split('x'))
+    modes = args.modes.split(',')
+    for mode in modes:
+        if mode not in ('rgb', 'grey'):
+            parser.error("unknown mode: %s" % mode)
+    for filename in args.videos:
+        for mode in modes:
+            shape, fps = benchmark(filename, args.frames, **dict(kwargs, grey=(mode == 'grey')))
+            print("%s %dx%d %s: %.1f fps" % (filename, shape[1], shape[0], mode, fps))
+
+
+if __name__ == '__main__':
+    main()
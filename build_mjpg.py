@@ -8,6 +8,8 @@ ffi.cdef("""
         struct mjpg {
             int width, height;
             unsigned char *pixels;
+            int scale_denom;
+            int roi_x, roi_y, roi_width, roi_height;
             unsigned int timestamp_sec;
             unsigned int timestamp_usec;
             long start_position_in_file, stop_position_in_file;
@@ -26,6 +28,7 @@ ffi.cdef("""
         int mjpg_open_buffer(struct mjpg *m, uint8_t *buf, int len, int type, int dataOrder);
         int mjpg_next_head(struct mjpg *m);
         int mjpg_next_data(struct mjpg *m);
+        int mjpg_skip_data(struct mjpg *m);
         int mjpg_close(struct mjpg *m);
         int mjpg_seek (struct mjpg *m, long offset);
 
@@ -12,6 +12,10 @@ ffi.cdef("""
             uint8_t *codec_private;
             size_t codec_private_len;
             char *codec_id;
+            int64_t systime_samples;
+            long time_scale;
+            unsigned long cluster_offset;
+            int64_t cluster_systime_offset_sum, cluster_systime_offset_count;
             ...;
         };
         struct mkv_frame {
@@ -21,17 +25,42 @@ ffi.cdef("""
             unsigned long offset;
             int key_frame;
         };
+        struct mkv_index_entry {
+            uint64_t pts;
+            unsigned long offset;
+            int key_frame;
+        };
+        struct mkv_cue {
+            uint64_t pts;
+            unsigned long offset;
+        };
 
         struct mkv *mkv_open(char *filename);
+        int mkv_remap(struct mkv *s, char *filename, struct mkv_frame *frm);
         void mkv_close(struct mkv *s);
         int mkv_next(struct mkv *s, struct mkv_frame *frm);
         void mkv_seek(struct mkv *s, unsigned long offset);
+        void mkv_limit(struct mkv *s, unsigned long offset);
+        unsigned long mkv_tell(struct mkv *s);
+        unsigned long mkv_sync(struct mkv *s, unsigned long offset);
+        int mkv_cues(struct mkv *s, struct mkv_cue *cues, int n);
 
         struct decode;
-        struct decode *decode_open(struct mkv *m);
+        enum {DECODE_THREAD_DEFAULT=0, DECODE_THREAD_FRAME=1, DECODE_THREAD_SLICE=2};
+        struct decode *decode_open(struct mkv *m, int thread_count, int thread_type, int grey);
         void decode_close(struct decode *p);
-        int decode_frame(struct decode *p, struct mkv_frame *frm, uint8_t *img, uint64_t *ts, int grey);
+        void decode_flush(struct decode *p);
+        void decode_set_keyframes_only(struct decode *p, int keyframes_only);
+        void decode_skip_to(struct decode *p, uint64_t pts);
+        enum {DECODE_BICUBIC=0, DECODE_BILINEAR=1, DECODE_FAST_BILINEAR=2, DECODE_NEAREST=3,
+              DECODE_AREA=4, DECODE_LANCZOS=5};
+        int decode_set_output(struct decode *p, int crop_x, int crop_y, int crop_width, int crop_height,
+                              int width, int height, int interpolation);
+        enum {DECODE_RGB24=0, DECODE_GRAY8=1, DECODE_YUV420P=2};
+        int decode_frame(struct decode *p, struct mkv_frame *frm, uint8_t *img, uint64_t *ts, int format);
         int64_t mkv_estimate_systime_offset(struct mkv *s);
+        int mkv_index(struct mkv *s, struct mkv_index_entry *entries, int n);
+        int64_t mkv_systime_offset(struct mkv *s);
 
          """)
 ffi.set_source("vi3o._mkv", '#include "src/decode.h"',
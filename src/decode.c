@@ -1,11 +1,14 @@
 #include <stdint.h>
 #include <stdlib.h>
 #include <stdio.h>
+#include <string.h>
 #include <assert.h>
 #include <time.h>
 
 #include <libavcodec/avcodec.h>
 #include <libavutil/avutil.h>
+#include <libavutil/imgutils.h>
+#include <libavutil/pixdesc.h>
 #include <libswscale/swscale.h>
 
 #include "decode.h"
@@ -30,6 +33,20 @@
 #define av_frame_alloc  avcodec_alloc_frame
 #endif
 
+#ifndef AV_INPUT_BUFFER_PADDING_SIZE
+#define AV_INPUT_BUFFER_PADDING_SIZE FF_INPUT_BUFFER_PADDING_SIZE
+#endif
+
+#if !defined(AV_CODEC_FLAG_GRAY) && defined(CODEC_FLAG_GRAY)
+#define AV_CODEC_FLAG_GRAY CODEC_FLAG_GRAY
+#endif
+
+#if !defined(AV_PIX_FMT_FLAG_PAL) && defined(PIX_FMT_PAL)
+#define AV_PIX_FMT_FLAG_PAL PIX_FMT_PAL
+#define AV_PIX_FMT_FLAG_BITSTREAM PIX_FMT_BITSTREAM
+#define AV_PIX_FMT_FLAG_HWACCEL PIX_FMT_HWACCEL
+#endif
+
 
 struct decode {
     AVCodec* codec;                                                                        /* the AVCodec* which represents the H264 decoder */
@@ -37,34 +54,53 @@ struct decode {
     AVFrame* picture;                                                                      /* will contain a decoded picture */
     uint64_t next_time;
     struct mkv *m;
+    int crop_x, crop_y, crop_width, crop_height;                                           /* the part of the decoded picture that is output */
+    int width, height;                                                                     /* the size of the output images */
+    int sws_flags;                                                                         /* the swscale interpolation */
+    struct SwsContext *sws;                                                                /* conversion context reused between frames */
+    int sws_src_format, sws_width, sws_height, sws_src_range, sws_dst_format;              /* the parameters sws was created for */
+    int sws_dst_width, sws_dst_height, sws_dst_flags;
+    enum AVDiscard discard;                                                                /* the packets discarded when not skipping */
+    uint64_t skip_pts;                                                                     /* pictures before this pts are skipped */
+    int drained;                                                                           /* the decoder was drained and needs a flush */
 };
 
-#if LIBAVCODEC_VERSION_INT >= AV_VERSION_INT(56,60,100) // Debian Stretch, Ubuntu Xenial
-static void replace_deprecated_codecs(struct decode *p)
+/*
+ * The pixel format of the decoded picture, with the deprecated yuvj formats
+ * replaced by the yuv formats and *full_range set instead. The pix_fmt of the
+ * codec context is left as is, as the decoder discards reference pictures of
+ * another format than the one it decodes.
+ */
+static int picture_format(struct decode *p, int *full_range)
 {
-    switch (p->codec_context->pix_fmt) {
+    int pix_fmt = p->codec_context->pix_fmt;
+    *full_range = 0;
+#if LIBAVCODEC_VERSION_INT >= AV_VERSION_INT(56,60,100) // Debian Stretch, Ubuntu Xenial
+    *full_range = (p->codec_context->color_range == AVCOL_RANGE_JPEG);
+    switch (pix_fmt) {
     case AV_PIX_FMT_YUVJ420P:
-        p->codec_context->pix_fmt = AV_PIX_FMT_YUV420P;
-        p->codec_context->color_range = AVCOL_RANGE_JPEG;
+        pix_fmt = AV_PIX_FMT_YUV420P;
+        *full_range = 1;
         break;
 
     case AV_PIX_FMT_YUVJ422P:
-        p->codec_context->pix_fmt = AV_PIX_FMT_YUV422P;
-        p->codec_context->color_range = AVCOL_RANGE_JPEG;
+        pix_fmt = AV_PIX_FMT_YUV422P;
+        *full_range = 1;
         break;
 
     case AV_PIX_FMT_YUVJ444P:
-        p->codec_context->pix_fmt = AV_PIX_FMT_YUV444P;
-        p->codec_context->color_range = AVCOL_RANGE_JPEG;
+        pix_fmt = AV_PIX_FMT_YUV444P;
+        *full_range = 1;
         break;
 
     default:
         break;
     }
-}
 #endif
+    return pix_fmt;
+}
 
-struct decode *decode_open(struct mkv *m) {
+struct decode *decode_open(struct mkv *m, int thread_count, int thread_type, int grey) {
 
     assert(m);
     assert(m->codec_private);
@@ -72,6 +108,8 @@ struct decode *decode_open(struct mkv *m) {
     struct decode *p = calloc(sizeof(struct decode), 1);
     p->next_time = 0;
     p->m = m;
+    decode_set_output(p, 0, 0, m->width, m->height, m->width, m->height, DECODE_BICUBIC);
+    p->discard = AVDISCARD_DEFAULT;
 
     static int avcodec_register_all_called=0;
     if (!avcodec_register_all_called) {
@@ -83,8 +121,21 @@ struct decode *decode_open(struct mkv *m) {
     assert(p->codec);
     p->codec_context = avcodec_alloc_context3(p->codec);
     assert(p->codec_context);
-    p->codec_context->extradata = m->codec_private;
+    // Keep a padded copy as the mkv data might be remapped (see mkv_remap)
+    p->codec_context->extradata = av_mallocz(m->codec_private_len + AV_INPUT_BUFFER_PADDING_SIZE);
+    assert(p->codec_context->extradata);
+    memcpy(p->codec_context->extradata, m->codec_private, m->codec_private_len);
     p->codec_context->extradata_size = m->codec_private_len;
+    p->codec_context->thread_count = thread_count;
+    if (thread_type == DECODE_THREAD_FRAME) {
+        p->codec_context->thread_type = FF_THREAD_FRAME;
+    } else if (thread_type == DECODE_THREAD_SLICE) {
+        p->codec_context->thread_type = FF_THREAD_SLICE;
+    }
+#ifdef AV_CODEC_FLAG_GRAY
+    // Skip the chroma planes if the decoder supports it
+    if (grey) p->codec_context->flags |= AV_CODEC_FLAG_GRAY;
+#endif
     int rc = avcodec_open2(p->codec_context, p->codec, NULL);
     if (rc<0) {
         perror("avcodec_open2");
@@ -97,75 +148,294 @@ struct decode *decode_open(struct mkv *m) {
 }
 
 void decode_close(struct decode *p) {
+    if (!p) return;
+    sws_freeContext(p->sws);
+    p->sws = NULL;
     av_free(p->picture);
     p->picture = NULL;
     avcodec_close(p->codec_context);
+    av_freep(&p->codec_context->extradata);
     av_free(p->codec_context);
     p->codec_context = NULL;
+    free(p);
+}
+
+void decode_flush(struct decode *p) {
+    avcodec_flush_buffers(p->codec_context);
+    p->drained = 0;
+}
+
+void decode_set_keyframes_only(struct decode *p, int keyframes_only) {
+    p->discard = keyframes_only ? AVDISCARD_NONKEY : AVDISCARD_DEFAULT;
+    p->codec_context->skip_frame = p->discard;
+}
+
+void decode_skip_to(struct decode *p, uint64_t pts) {
+    p->skip_pts = pts;
+}
+
+int decode_set_output(struct decode *p, int crop_x, int crop_y, int crop_width, int crop_height,
+                      int width, int height, int interpolation) {
+    static const int flags[] = {
+        [DECODE_BICUBIC] = SWS_BICUBIC,
+        [DECODE_BILINEAR] = SWS_BILINEAR,
+        [DECODE_FAST_BILINEAR] = SWS_FAST_BILINEAR,
+        [DECODE_NEAREST] = SWS_POINT,
+        [DECODE_AREA] = SWS_AREA,
+        [DECODE_LANCZOS] = SWS_LANCZOS,
+    };
+    if (crop_x < 0 || crop_y < 0 || crop_width <= 0 || crop_height <= 0 ||
+        crop_x + crop_width > p->m->width || crop_y + crop_height > p->m->height ||
+        width <= 0 || height <= 0 ||
+        interpolation < 0 || interpolation >= (int) (sizeof(flags) / sizeof(flags[0]))) {
+        return -1;
+    }
+    p->crop_x = crop_x;
+    p->crop_y = crop_y;
+    p->crop_width = crop_width;
+    p->crop_height = crop_height;
+    p->width = width;
+    p->height = height;
+    p->sws_flags = flags[interpolation];
+    return 0;
+}
+
+/*
+ * Point src at the top left corner of the cropped region in each plane of
+ * the decoded picture. The luma plane is cropped exactly and the chroma
+ * planes at the chroma sample covering the corner, like the ffmpeg crop
+ * filter with exact=1. If round_corner is set, the corner is instead rounded
+ * down to a multiple of the chroma subsampling, to keep the planes aligned.
+ * Returns 0 if the format is not supported.
+ */
+static int crop_picture(struct decode *p, const uint8_t *src[4], int round_corner) {
+    const AVPixFmtDescriptor *desc = av_pix_fmt_desc_get(p->codec_context->pix_fmt);
+    int steps[4], step_comps[4], x = p->crop_x, y = p->crop_y, i;
+
+    if (!desc || (desc->flags & (AV_PIX_FMT_FLAG_PAL | AV_PIX_FMT_FLAG_BITSTREAM |
+                                 AV_PIX_FMT_FLAG_HWACCEL))) {
+        return 0;
+    }
+    av_image_fill_max_pixsteps(steps, step_comps, desc);
+    if (round_corner) {
+        x = x >> desc->log2_chroma_w << desc->log2_chroma_w;
+        y = y >> desc->log2_chroma_h << desc->log2_chroma_h;
+    }
+    for (i = 0; i < 4; i++) {
+        int chroma = (i == 1 || i == 2);
+        if (!p->picture->data[i]) {
+            src[i] = NULL;
+            continue;
+        }
+        src[i] = p->picture->data[i] +
+                 (y >> (chroma ? desc->log2_chroma_h : 0)) * p->picture->linesize[i] +
+                 (x >> (chroma ? desc->log2_chroma_w : 0)) * steps[i];
+    }
+    return 1;
+}
+
+/* True if the output images are not scaled */
+static int unscaled(struct decode *p) {
+    return p->width == p->crop_width && p->height == p->crop_height;
+}
+
+/*
+ * Copy the luma plane of the decoded picture into img if it is in a planar
+ * 8 bit YUV format, expanding limited range luma to full range like
+ * swscale does. Returns 0 if the format is not supported.
+ */
+static int copy_luma(struct decode *p, uint8_t *img) {
+    static uint8_t expand[256];
+    static int expand_initialized = 0;
+    const uint8_t *src[4];
+    int y, full_range = 0;
+
+    switch (p->codec_context->pix_fmt) {
+    case AV_PIX_FMT_YUVJ420P:
+    case AV_PIX_FMT_YUVJ422P:
+    case AV_PIX_FMT_YUVJ444P:
+        full_range = 1;
+        break;
+    case AV_PIX_FMT_YUV420P:
+    case AV_PIX_FMT_YUV422P:
+    case AV_PIX_FMT_YUV444P:
+    case AV_PIX_FMT_NV12:
+        break;
+    default:
+        return 0;
+    }
+    if (!unscaled(p) || !crop_picture(p, src, 0)) return 0;
+#if LIBAVCODEC_VERSION_INT >= AV_VERSION_INT(56,60,100) // Debian Stretch, Ubuntu Xenial
+    if (p->codec_context->color_range == AVCOL_RANGE_JPEG) full_range = 1;
+#endif
+
+    if (!full_range && !expand_initialized) {
+        for (y = 0; y < 256; y++) {
+            int v = ((y - 16) * 255 + 219 / 2) / 219;
+            expand[y] = v < 0 ? 0 : (v > 255 ? 255 : v);
+        }
+        expand_initialized = 1;
+    }
+
+    for (y = 0; y < p->height; y++) {
+        const uint8_t *row = src[0] + y * p->picture->linesize[0];
+        uint8_t *dst = img + y * p->width;
+        if (full_range) {
+            memcpy(dst, row, p->width);
+        } else {
+            int x;
+            for (x = 0; x < p->width; x++) dst[x] = expand[row[x]];
+        }
+    }
+    return 1;
+}
+
+/*
+ * Copy the planes of the decoded picture into img as I420 if it is already
+ * in that format. Returns 0 if it is not. The samples are copied as is, so
+ * full range (yuvj) pictures stay full range.
+ */
+static int copy_yuv420p(struct decode *p, uint8_t *img) {
+    const uint8_t *src[4];
+    int plane, y;
+    int width = p->width, height = p->height;
+    int chroma_width = (width + 1) / 2, chroma_height = (height + 1) / 2;
+
+    if (p->codec_context->pix_fmt != AV_PIX_FMT_YUV420P &&
+        p->codec_context->pix_fmt != AV_PIX_FMT_YUVJ420P) {
+        return 0;
+    }
+    if (!unscaled(p) || !crop_picture(p, src, 1)) return 0;
+    for (plane = 0; plane < 3; plane++) {
+        int w = plane ? chroma_width : width;
+        int h = plane ? chroma_height : height;
+        for (y = 0; y < h; y++) {
+            memcpy(img, src[plane] + y * p->picture->linesize[plane], w);
+            img += w;
+        }
+    }
+    return 1;
 }
 
-int decode_frame(struct decode *p, struct mkv_frame *frm, uint8_t *img, uint64_t *ts, int grey) {
+/*
+ * Get a conversion context from the decoded picture format to dst_format,
+ * reusing the previous one unless the format, size or range has changed.
+ */
+static struct SwsContext *get_sws_context(struct decode *p, int dst_format) {
+    int src_range;
+    int src_format = picture_format(p, &src_range);
+    if (p->sws &&
+        p->sws_src_format == src_format &&
+        p->sws_width == p->crop_width && p->sws_height == p->crop_height &&
+        p->sws_src_range == src_range &&
+        p->sws_dst_format == dst_format &&
+        p->sws_dst_width == p->width && p->sws_dst_height == p->height &&
+        p->sws_dst_flags == p->sws_flags) {
+        return p->sws;
+    }
+
+    sws_freeContext(p->sws);
+    p->sws = sws_getContext(p->crop_width, p->crop_height,
+                            src_format,
+                            p->width, p->height,
+                            dst_format,
+                            p->sws_flags, NULL, NULL,NULL);
+    if (!p->sws) return NULL;
+    p->sws_src_format = src_format;
+    p->sws_width = p->crop_width;
+    p->sws_height = p->crop_height;
+    p->sws_src_range = src_range;
+    p->sws_dst_format = dst_format;
+    p->sws_dst_width = p->width;
+    p->sws_dst_height = p->height;
+    p->sws_dst_flags = p->sws_flags;
+
+    if (src_range) {
+        // We need to set the correct color space information for swscaler
+        int placeholder[4], srcRange, dstRange, brightness, contrast,
+            saturation;
+        sws_getColorspaceDetails(p->sws, (int **)&placeholder,
+                                 &srcRange, (int **)&placeholder, &dstRange,
+                                 &brightness, &contrast, &saturation);
+
+        srcRange = 1; // Indicate that white-black range of input is JPEG
+        // YUV output keeps the range of the input, like when it is copied as is
+        if (dst_format == AV_PIX_FMT_YUV420P) dstRange = 1;
+
+        // Get the default YUV2RGB coefficients
+        const int *coefs = sws_getCoefficients(SWS_CS_DEFAULT);
+
+        // Setup the color space
+        sws_setColorspaceDetails(p->sws, coefs, srcRange, coefs,
+                                 dstRange, brightness, contrast,
+                                 saturation);
+    }
+    return p->sws;
+}
+
+int decode_frame(struct decode *p, struct mkv_frame *frm, uint8_t *img, uint64_t *ts, int format) {
     AVPacket pkt;
+    if (p->drained) {
+        // A drained decoder does not accept more packets until it is flushed
+        avcodec_flush_buffers(p->codec_context);
+        p->drained = 0;
+    }
     av_init_packet(&pkt);
     pkt.data = frm->data;
     pkt.size = frm->len;
     pkt.pts = frm->pts;
+    if (frm->len > 0) {
+        // Packets that are skipped and that no other pictures refer to are not decoded
+        p->codec_context->skip_frame = p->discard;
+        if (frm->pts < p->skip_pts && p->discard < AVDISCARD_NONREF) {
+            p->codec_context->skip_frame = AVDISCARD_NONREF;
+        }
+    }
     int got_picture = 0;
     int len = avcodec_decode_video2(p->codec_context, p->picture,
                                     &got_picture, &pkt);
     if (len < 0) return -1;
+    if (!got_picture && frm->len > 0 && frm->key_frame && p->discard == AVDISCARD_NONKEY) {
+        // No later packet is needed to output a keyframe when only keyframes
+        // are decoded, so drain the decoder instead of reading the rest of the GOP
+        av_init_packet(&pkt);
+        pkt.data = NULL;
+        pkt.size = 0;
+        len = avcodec_decode_video2(p->codec_context, p->picture, &got_picture, &pkt);
+        p->drained = 1;
+        if (len < 0) return -1;
+    }
 
     if (got_picture) {
+        *ts = p->picture->pkt_pts;
+        if (*ts < p->skip_pts) return 2;
+        if (format == DECODE_GRAY8 && copy_luma(p, img)) return 1;
+        if (format == DECODE_YUV420P && copy_yuv420p(p, img)) return 1;
 
         int pixfmt = AV_PIX_FMT_RGB24;
-        int strides[] = {p->m->width * 3};
-        if (grey) {
+        int strides[] = {p->width * 3, 0, 0};
+        uint8_t *planes[] = {img, NULL, NULL};
+        if (format == DECODE_GRAY8) {
             pixfmt = AV_PIX_FMT_GRAY8;
-            strides[0] = p->m->width;
+            strides[0] = p->width;
+        } else if (format == DECODE_YUV420P) {
+            // Other YUV formats are converted by swscale
+            pixfmt = AV_PIX_FMT_YUV420P;
+            strides[0] = p->width;
+            strides[1] = strides[2] = (p->width + 1) / 2;
+            planes[1] = img + p->width * p->height;
+            planes[2] = planes[1] + strides[1] * ((p->height + 1) / 2);
         }
 
-        struct SwsContext *img_convert_ctx;
-#if LIBAVCODEC_VERSION_INT >= AV_VERSION_INT(56,60,100) // Debian Stretch, Ubuntu Xenial
-        replace_deprecated_codecs(p);
-#endif
-        img_convert_ctx = sws_getCachedContext(NULL,
-                                               p->m->width, p->m->height,
-                                               p->codec_context->pix_fmt,
-                                               p->m->width, p->m->height,
-                                               pixfmt,
-                                               SWS_BICUBIC, NULL, NULL,NULL);
+        const uint8_t *src[4];
+        if (!crop_picture(p, src, format == DECODE_YUV420P)) return -1;
+        struct SwsContext *img_convert_ctx = get_sws_context(p, pixfmt);
+        if (!img_convert_ctx) return -1;
 
-#if LIBAVCODEC_VERSION_INT >= AV_VERSION_INT(56,60,100) // Debian Stretch, Ubuntu Xenial
-        if (p->codec_context->color_range == AVCOL_RANGE_JPEG) {
-            // We need to set the correct color space information for swscaler
-            int placeholder[4], srcRange, dstRange, brightness, contrast,
-                saturation;
-            sws_getColorspaceDetails(img_convert_ctx, (int **)&placeholder,
-                                     &srcRange, (int **)&placeholder, &dstRange,
-                                     &brightness, &contrast, &saturation);
-
-            srcRange = 1; // Indicate that white-black range of input is JPEG
-
-            // Get the default YUV2RGB coefficients
-            const int *coefs = sws_getCoefficients(SWS_CS_DEFAULT);
-
-            // Setup the color space
-            sws_setColorspaceDetails(img_convert_ctx, coefs, srcRange, coefs,
-                                     dstRange, brightness, contrast,
-                                     saturation);
-        }
-#endif
-
-        uint8_t *const planes[] = {img};
-        sws_scale(img_convert_ctx,
-              (const uint8_t * const*) ((AVPicture*)p->picture)->data,
-              ((AVPicture*)p->picture)->linesize,
-              0, p->m->height,
-              planes, strides);
+        sws_scale(img_convert_ctx, src, p->picture->linesize,
+                  0, p->crop_height,
+                  planes, strides);
 
-
-        sws_freeContext(img_convert_ctx);
-        *ts = p->picture->pkt_pts;
         return 1;
     }
     return 0;
@@ -1,8 +1,62 @@
 #include "mkv.h"
 
 struct decode;
-struct decode *decode_open(struct mkv *m);
+
+/* Kinds of threading to use when decoding */
+enum {DECODE_THREAD_DEFAULT=0, DECODE_THREAD_FRAME=1, DECODE_THREAD_SLICE=2};
+
+/*
+ * Open a decoder for the video track of m using thread_count threads (0 for
+ * one per cpu core) with threading of type thread_type. If grey is set the
+ * decoder is asked to skip the chroma planes and only greyscale images can
+ * be decoded.
+ */
+struct decode *decode_open(struct mkv *m, int thread_count, int thread_type, int grey);
 void decode_close(struct decode *p);
-int decode_frame(struct decode *p, struct mkv_frame *frm, uint8_t *img, uint64_t *ts, int grey);
+
+/*
+ * Drop all frames buffered in the decoder, e.g. after seeking.
+ */
+void decode_flush(struct decode *p);
+
+/*
+ * If keyframes_only is set, all packets except keyframes are discarded
+ * without being decoded, and each keyframe is output as soon as its packet
+ * has been decoded, without waiting for the following packets.
+ */
+void decode_set_keyframes_only(struct decode *p, int keyframes_only);
+
+/*
+ * Skip the pictures with a pts before pts. They are decoded if later pictures
+ * refer to them, but not converted to the output format.
+ */
+void decode_skip_to(struct decode *p, uint64_t pts);
+
+/* Interpolation used when scaling the output images */
+enum {DECODE_BICUBIC=0, DECODE_BILINEAR=1, DECODE_FAST_BILINEAR=2, DECODE_NEAREST=3,
+      DECODE_AREA=4, DECODE_LANCZOS=5};
+
+/*
+ * Output the crop_width x crop_height region at crop_x, crop_y of the decoded
+ * pictures scaled to width x height using interpolation. By default the
+ * entire picture is output unscaled. For DECODE_YUV420P output, crop_x and
+ * crop_y are rounded down to multiples of the chroma subsampling. Returns -1
+ * if the parameters are out of range.
+ */
+int decode_set_output(struct decode *p, int crop_x, int crop_y, int crop_width, int crop_height,
+                      int width, int height, int interpolation);
+
+/* Output formats of decode_frame */
+enum {DECODE_RGB24=0, DECODE_GRAY8=1, DECODE_YUV420P=2};
+
+/*
+ * Decode the packet frm and write the next decoded picture, if any, to img in
+ * format, which is one of the DECODE_* output formats. DECODE_YUV420P images
+ * are written as tightly packed I420 in the range of the video, i.e. full
+ * range for yuvj pictures. Returns 1 if a picture was written, 2 if
+ * a picture was skipped (see decode_skip_to), 0 if the decoder needs more
+ * packets and -1 on errors.
+ */
+int decode_frame(struct decode *p, struct mkv_frame *frm, uint8_t *img, uint64_t *ts, int format);
 
 
@@ -22,6 +22,24 @@
 #define MAX(x, y) (((x) > (y)) ? (x) : (y))
 #define MIN(x, y) (((x) < (y)) ? (x) : (y))
 
+/* Number of rows per component block after DCT scaling */
+#if JPEG_LIB_VERSION >= 70
+#define MIN_DCT_V_SCALED_SIZE(cinfo) ((cinfo)->min_DCT_v_scaled_size)
+#else
+#define MIN_DCT_V_SCALED_SIZE(cinfo) ((cinfo)->min_DCT_scaled_size)
+#endif
+
+/* Skips n scanlines without decoding them if libjpeg-turbo is used */
+static void skip_scanlines(struct mjpg *m, JDIMENSION n) {
+#ifdef LIBJPEG_TURBO_VERSION
+  if (n > 0)
+    jpeg_skip_scanlines(&m->cameraDecomp, n);
+#else
+  while (n-- > 0)
+    jpeg_read_scanlines(&m->cameraDecomp, m->cameraBuffer[0], 1);
+#endif
+}
+
 void skip_past_str( struct jpeg_decompress_struct *dec, char *str ) {
   unsigned char *p;
   unsigned int len=strlen(str);
@@ -150,6 +168,8 @@ int mjpg_open_fd(struct mjpg *m, FILE *fd, int type, int dataOrder) {
   m->width=-1;
   m->nErr=0;
   m->pixels = NULL;
+  m->scale_denom = 1;
+  m->roi_width = 0;
 
   return OK;
 }
@@ -189,6 +209,10 @@ int mjpg_next_head(struct mjpg *m) {
   
   jpeg_read_header(&m->cameraDecomp, TRUE);
 
+  /* Scaling in the DCT domain skips most of the IDCT work */
+  m->cameraDecomp.scale_num = 1;
+  m->cameraDecomp.scale_denom = m->scale_denom;
+
   if (m->dataOrder==IMORDER_PLANAR_SUBX ||
       m->dataOrder==IMORDER_PLANAR_SUBXY)
     m->dataOrder=IMORDER_PLANAR;
@@ -253,6 +277,7 @@ int mjpg_next_head(struct mjpg *m) {
 int mjpg_next_data(struct mjpg *m) {
   int x, y, i, ch;
   int row_stride;               /* physical row width in output buffer */
+  int x0 = 0, y0 = 0, w = m->width, h = m->height; /* region to decode */
 
   if (m->type==IMTYPE_GRAY) {
     ch=1;
@@ -270,116 +295,101 @@ int mjpg_next_data(struct mjpg *m) {
     return ERROR_FILEFORMAT;
   }
 
+  if (m->roi_width > 0) {
+    x0 = m->roi_x; y0 = m->roi_y; w = m->roi_width; h = m->roi_height;
+    if (m->dataOrder==IMORDER_PLANAR) {
+      /* Keep the chroma planes aligned with the luma plane */
+      x0 &= ~1;
+      y0 &= ~1;
+    }
+    if (x0 < 0 || y0 < 0 || w <= 0 || h <= 0 || x0 + w > m->width || y0 + h > m->height) {
+      d_printf("MJPG: Bad roi %dx%d at %d,%d\n", w, h, x0, y0);
+      return ERROR_ILLEGALARGUMENT;
+    }
+  }
+
   if (m->dataOrder==IMORDER_INTERLEAVED) {
-    row_stride = m->cameraDecomp.output_width *
-      m->cameraDecomp.output_components;
-    y=0;
-    if (m->type==IMTYPE_YCbCr || m->type==IMTYPE_RGB ||
-        m->type==IMTYPE_GRAY) {
-      while (m->cameraDecomp.output_scanline < m->cameraDecomp.output_height) {
-        jpeg_read_scanlines(&m->cameraDecomp, m->cameraBuffer[0], 1);
-        memcpy(m->pixels+(y*m->width*ch),m->cameraBuffer[0][0],
-               row_stride);
-        y++;
-      }
-    } else if (m->type==IMTYPE_BGR) {
-      while (m->cameraDecomp.output_scanline < m->cameraDecomp.output_height) {
-        jpeg_read_scanlines(&m->cameraDecomp, m->cameraBuffer[0], 1);
+    if (m->type!=IMTYPE_YCbCr && m->type!=IMTYPE_RGB &&
+        m->type!=IMTYPE_GRAY && m->type!=IMTYPE_BGR) {
+      d_printf("MJPG: Unknown image format %d\n", m->type);
+      return ERROR_ILLEGALARGUMENT;
+    }
+#ifdef LIBJPEG_TURBO_VERSION
+    /* Only decode the iMCU columns overlapping the roi. The region decoded
+     * is widened to iMCU boundaries, so x0 becomes the offset into it. */
+    if (w < m->width) {
+      JDIMENSION xoffset = x0, width = w;
+      jpeg_crop_scanline(&m->cameraDecomp, &xoffset, &width);
+      x0 -= xoffset;
+    }
+#endif
+    skip_scanlines(m, y0);
+    row_stride = w * ch;
+    for (y=0; y<h; y++) {
+      JSAMPLE *row = m->cameraBuffer[0][0] + x0 * ch;
+      jpeg_read_scanlines(&m->cameraDecomp, m->cameraBuffer[0], 1);
+      if (m->type==IMTYPE_BGR) {
         for (x=0; x<row_stride; x++) {
-          m->pixels[y*m->width*ch+x]=
-            m->cameraBuffer[0][0][x+2*(1-x%3)];
+          m->pixels[y*row_stride+x]=row[x+2*(1-x%3)];
         }
-        y++;
+      } else {
+        memcpy(m->pixels+y*row_stride, row, row_stride);
       }
-    } else {
-      d_printf("MJPG: Unknown image format %d\n", m->type);
-      return ERROR_ILLEGALARGUMENT;
+    }
+    /* Skipping all the remaining rows would leave the rest of the image in
+     * the input, so the last one is read */
+    if (m->cameraDecomp.output_scanline < m->cameraDecomp.output_height) {
+      skip_scanlines(m, m->cameraDecomp.output_height - m->cameraDecomp.output_scanline - 1);
+      jpeg_read_scanlines(&m->cameraDecomp, m->cameraBuffer[0], 1);
     }
   } else if (m->dataOrder==IMORDER_PLANAR) {
-    unsigned char *y,*cb,*cr;
-    y=m->pixels;
-    cb=y+m->width*ch*m->height;
-    cr=cb+m->width*ch*m->height;
-
-    row_stride=m->cameraDecomp.max_v_samp_factor * DCTSIZE;
+    /* The planes are written tightly packed, i.e. as I420 for YCbCr: a full
+     * resolution Y plane followed by Cb and Cr planes subsampled by 2 in
+     * both directions. Only the Y plane is written for IMTYPE_GRAY. */
+    jpeg_component_info *comp = m->cameraDecomp.comp_info;
+    int chroma_width = (w + 1) / 2, chroma_height = (h + 1) / 2;
+    unsigned char *cb = m->pixels + w * h;
+    unsigned char *cr = cb + chroma_width * chroma_height;
+
+    row_stride=m->cameraDecomp.max_v_samp_factor * MIN_DCT_V_SCALED_SIZE(&m->cameraDecomp);
     if (m->cameraDecomp.num_components==1 && ch==1 && m->type==IMTYPE_GRAY) {
       // Greyscale images are fine
     } else if (m->cameraDecomp.num_components!=3 ||
-        m->cameraDecomp.comp_info[0].h_samp_factor!=2 || 
-        (m->cameraDecomp.comp_info[0].v_samp_factor!=1 &&
-         m->cameraDecomp.comp_info[0].v_samp_factor!=2) ||
-        m->cameraDecomp.comp_info[1].h_samp_factor!=1 ||
-        m->cameraDecomp.comp_info[1].v_samp_factor!=1 ||
-        m->cameraDecomp.comp_info[2].h_samp_factor!=1 ||
-        m->cameraDecomp.comp_info[2].v_samp_factor!=1) {
+        comp[0].h_samp_factor!=2 ||
+        (comp[0].v_samp_factor!=1 && comp[0].v_samp_factor!=2) ||
+        comp[1].h_samp_factor!=1 || comp[1].v_samp_factor!=1 ||
+        comp[2].h_samp_factor!=1 || comp[2].v_samp_factor!=1) {
       d_printf("MJPG: Can only handle 422 or 420 YCbCr jpegs\n");
-      return 0;
+      return ERROR_FILEFORMAT;
+    }
+    if (m->type!=IMTYPE_YCbCr && m->type!=IMTYPE_GRAY) {
+      d_printf("MJPG: Unknown image format %d\n", m->type);
+      return ERROR_ILLEGALARGUMENT;
     }
     m->dataOrder=IMORDER_PLANAR_SUBXY;
 
+    /* Raw data can not be skipped, so the full images are decoded and the
+     * roi is copied out of them */
+    y=0;
     while (m->cameraDecomp.output_scanline < m->cameraDecomp.output_height) {
       if (jpeg_read_raw_data(&m->cameraDecomp, m->cameraBuffer, row_stride)!=row_stride) {
         d_printf("MJPG: jpeg_read_raw_data failed");
         return ERROR_FILEFORMAT;
       }
-
+      for (i=MAX(y0-y, 0); i<row_stride && y+i<y0+h; i++) {
+        memcpy(m->pixels + (y+i-y0) * w, m->cameraBuffer[0][i] + x0, w);
+      }
       if (m->type==IMTYPE_YCbCr) {
-        if (m->cameraDecomp.comp_info[0].v_samp_factor==1) {
-          for (i=0; i<DCTSIZE/2; i++) {
-            memcpy(y,m->cameraBuffer[0][2*i],
-                   m->cameraDecomp.comp_info[0].width_in_blocks*DCTSIZE); 
-            y+=m->cameraDecomp.comp_info[0].width_in_blocks*DCTSIZE;
-            memcpy(y,m->cameraBuffer[0][2*i+1],
-                   m->cameraDecomp.comp_info[0].width_in_blocks*DCTSIZE); 
-            y+=m->cameraDecomp.comp_info[0].width_in_blocks*DCTSIZE;
-          
-            memcpy(cb,m->cameraBuffer[1][2*i],
-                   m->cameraDecomp.comp_info[1].width_in_blocks*DCTSIZE);
-            cb+=m->cameraDecomp.comp_info[1].width_in_blocks*DCTSIZE;
-          
-            memcpy(cr,m->cameraBuffer[2][2*i],
-                   m->cameraDecomp.comp_info[2].width_in_blocks*DCTSIZE);
-            cr+=m->cameraDecomp.comp_info[2].width_in_blocks*DCTSIZE;
-          }
-        } else {
-          for (i=0; i<2*DCTSIZE; i++) {
-            memcpy(y,m->cameraBuffer[0][i],
-                   m->cameraDecomp.comp_info[0].width_in_blocks*DCTSIZE); 
-            y+=m->cameraDecomp.comp_info[0].width_in_blocks*DCTSIZE;
-          }
-          for (i=0; i<DCTSIZE; i++) {
-            memcpy(cb,m->cameraBuffer[1][i],
-                   m->cameraDecomp.comp_info[1].width_in_blocks*DCTSIZE);
-            cb+=m->cameraDecomp.comp_info[1].width_in_blocks*DCTSIZE;
-          
-            memcpy(cr,m->cameraBuffer[2][i],
-                   m->cameraDecomp.comp_info[2].width_in_blocks*DCTSIZE);
-            cr+=m->cameraDecomp.comp_info[2].width_in_blocks*DCTSIZE;
-          }
-        }
-      } else if (m->type==IMTYPE_GRAY) {
-        if (m->cameraDecomp.comp_info[0].v_samp_factor==1) {
-          for (i=0; i<DCTSIZE/2; i++) {
-            memcpy(y,m->cameraBuffer[0][2*i],
-                   m->cameraDecomp.comp_info[0].width_in_blocks*DCTSIZE); 
-            y+=m->cameraDecomp.comp_info[0].width_in_blocks*DCTSIZE;
-            memcpy(y,m->cameraBuffer[0][2*i+1],
-                   m->cameraDecomp.comp_info[0].width_in_blocks*DCTSIZE); 
-            y+=m->cameraDecomp.comp_info[0].width_in_blocks*DCTSIZE;
-          }
-        } else {
-          int rows = MIN(2*DCTSIZE, m->cameraDecomp.output_height - m->cameraDecomp.output_scanline + 2*DCTSIZE);
-          for (i=0; i<rows; i++) {
-            memcpy(y,m->cameraBuffer[0][i],
-                   m->cameraDecomp.comp_info[0].width_in_blocks*DCTSIZE); 
-            y+=m->cameraDecomp.comp_info[0].width_in_blocks*DCTSIZE;
-          }
+        /* One chroma row per two luma rows, every other chroma row is
+         * dropped from 422 jpegs */
+        i = MAX(y0-y, 0);
+        for (i+=(y+i)%2; i<row_stride && y+i<y0+h; i+=2) {
+          int row = i * comp[1].v_samp_factor / comp[0].v_samp_factor;
+          memcpy(cb + (y+i-y0)/2 * chroma_width, m->cameraBuffer[1][row] + x0/2, chroma_width);
+          memcpy(cr + (y+i-y0)/2 * chroma_width, m->cameraBuffer[2][row] + x0/2, chroma_width);
         }
-        
-      } else {
-        d_printf("MJPG: Unknown image format %d\n", m->type);
-      return ERROR_ILLEGALARGUMENT;
       }
+      y+=row_stride;
     }
   } else {
     d_printf("MJPG: Unknown dataOrder %d\n",m->dataOrder);
@@ -392,6 +402,33 @@ int mjpg_next_data(struct mjpg *m) {
   return OK;
 }
 
+/// Skips the data of the frame whose header was read by mjpg_next_head
+int mjpg_skip_data(struct mjpg *m) {
+  struct jpeg_source_mgr *src = m->cameraDecomp.src;
+  int ff = 0;
+  int c;
+
+  /* Images with several scans are read to their end when decompression is
+   * started, otherwise the data is skipped up to the EOI marker. In the
+   * entropy coded data, 0xFF is only followed by 0 or a RST marker. */
+  if (!jpeg_input_complete(&m->cameraDecomp)) {
+    for (;;) {
+      if (src->bytes_in_buffer == 0 && !src->fill_input_buffer(&m->cameraDecomp))
+        return ERROR_EOF;
+      c = *src->next_input_byte++;
+      src->bytes_in_buffer--;
+      if (ff && c == JPEG_EOI)
+        break;
+      ff = (c == 0xFF);
+    }
+  }
+  jpeg_abort_decompress(&m->cameraDecomp);
+  m->stop_position_in_file = ftell(m->fd)-m->cameraDecomp.src->bytes_in_buffer;
+
+  m->nErr = 0;
+  return OK;
+}
+
 int mjpg_seek (struct mjpg *m, long offset) {
   if(!fseek(m->fd, offset, SEEK_SET)) {
     m->cameraDecomp.src->bytes_in_buffer=0;
@@ -31,6 +31,9 @@ struct mjpg {
   char mjpg_separator[MAX_SEPARATOR_LEN];
   int width, height, dataOrder;
   unsigned char *pixels;
+  int scale_denom;              /**< Decode the images scaled by 1/scale_denom, 1, 2, 4 or 8 */
+  int roi_x, roi_y;             /**< Only decode the roi_width x roi_height region at */
+  int roi_width, roi_height;    /**< (roi_x, roi_y) of the scaled images if roi_width > 0 */
 
   int nErr;
 
@@ -46,6 +49,7 @@ int mjpg_open(struct mjpg *m, char *name, int type, int dataOrder);
 int mjpg_open_buffer(struct mjpg *m, uint8_t *buf, int len, int type, int dataOrder);
 int mjpg_next_head(struct mjpg *m);
 int mjpg_next_data(struct mjpg *m);
+int mjpg_skip_data(struct mjpg *m);
 int mjpg_close(struct mjpg *m);
 
 int mjpg_seek (struct mjpg *m, long offset);
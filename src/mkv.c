@@ -62,7 +62,7 @@ static uint64_t get_id(struct mkv *s) {
     /* Sanity check, within mmaped bounds and leading
     /  byte should always containt atleast one set bit
     /  due to the UTF-like format */
-    if (s->cur >= s->data + s->len || !s->cur[0]) {
+    if (s->cur >= s->end || !s->cur[0]) {
         s->cur++;
         return 0;
     }
@@ -72,7 +72,7 @@ static uint64_t get_id(struct mkv *s) {
     /  a 1 byte value 8 bits always is 0. */
     for (i=0; (s->cur[0] >> (8-i)) != 1; i++) {
         /* Make sure were not out of mmaped area... */
-        if (s->cur + i >= s->data + s->len) {
+        if (s->cur + i >= s->end) {
             s->cur += i;
             return 0;
         }
@@ -117,6 +117,7 @@ struct mkv *mkv_open(char *filename) {
     s->data = s->cur = mmap(NULL, s->len, PROT_READ, MAP_SHARED, fd, 0);
     assert(s->data != MAP_FAILED);
     close(fd);
+    s->end = s->data + s->len;
     s->munmap_on_close = 1;
     s->codec_private = NULL;
     s->codec_private_len = 0;
@@ -124,6 +125,36 @@ struct mkv *mkv_open(char *filename) {
     return s;
 }
 
+int mkv_remap(struct mkv *s, char *filename, struct mkv_frame *frm) {
+    int fd = open(filename, O_RDONLY);
+    if (fd < 0) return 0;
+    struct stat st;
+    fstat(fd, &st);
+    if (st.st_size <= s->len) {
+        close(fd);
+        return 0;
+    }
+    uint8_t *data = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if (data == MAP_FAILED) return 0;
+    // Move all pointers into the new mapping
+    s->cur = data + (s->cur - s->data);
+    if (frm && frm->data) {
+        frm->data = data + (frm->data - s->data);
+    }
+    if (s->codec_private) {
+        s->codec_private = data + (s->codec_private - s->data);
+    }
+    if (s->munmap_on_close) {
+        munmap(s->data, s->len);
+    }
+    s->data = data;
+    s->len = st.st_size;
+    s->end = s->data + s->len;
+    s->munmap_on_close = 1;
+    return 1;
+}
+
 void mkv_close(struct mkv *s) {
     if (s->munmap_on_close) {
         munmap(s->data, s->len);
@@ -174,8 +205,11 @@ int handle_axis_block(struct mkv *s, uint8_t *data, int len, uint64_t ts) {
                 // we accumulate the system time offset from the frame
                 // timestamps and uses that to get higher resolution
                 // on the system time
-                s->systime_offset_sum += systime-ts;
-                s->systime_offset_count += 1;
+                // Enough samples might have been collected already
+                if (!s->systime_samples || s->systime_offset_count < s->systime_samples) {
+                    s->systime_offset_sum += systime-ts;
+                    s->systime_offset_count += 1;
+                }
                 // Verify expected position of markers
                 if (len - pos > 12) {
                     // All good!
@@ -230,10 +264,12 @@ int read_simple_block(struct mkv *s, struct mkv_frame *frm, uint64_t len) {
 }
 
 int mkv_next(struct mkv *s, struct mkv_frame *frm) {
-    while (s->cur < s->data + s->len) {
-        unsigned long offset = s->cur - s->data; /* Bytes from start of file */
+    unsigned long offset;
+    while (s->cur < s->end) {
+        offset = s->cur - s->data; /* Bytes from start of file */
         uint64_t id = get_id(s); /* Read element ID and advance cursor position */
         uint64_t len = get_size(s); /* Read element size and advance cursor */
+        if (s->cur > s->end) goto truncated;
         switch(id) {
             case 0x18538067: // Segments
                 break;
@@ -242,22 +278,24 @@ int mkv_next(struct mkv *s, struct mkv_frame *frm) {
             case 0x2AD7B1: // Segments->Segment Information->TimecodeScale
                 // All scaled timecodes should be multiplied with this number
                 // to get the time in nanoseconds
-                if (s->cur + len > s->data + s->len) {s->cur += len; break;}
+                if (s->cur + len > s->end) goto truncated;
                 s->time_scale = get_uint(s, len);
                 break;
             case 0x1f43b675: // Segments->Cluster
                 // A cluster contains multimedia data and usually spans over
                 // a range of a few seconds
                 s->cluster_offset = offset;
+                s->cluster_systime_offset_sum = s->systime_offset_sum;
+                s->cluster_systime_offset_count = s->systime_offset_count;
                 break;
             case 0xE7: // Segments->Cluster->Timecode
                 // The Cluster timecode is the timecode all block timecodes are
                 // indicated relatively to
-                if (s->cur + len > s->data + s->len) {s->cur += len; break;}
+                if (s->cur + len > s->end) goto truncated;
                 s->time_offset = get_uint(s, len);
                 break;
             case 0xa3: // Segments->Cluster->SimpleBlock
-                if (s->cur + len > s->data + s->len) {s->cur += len; break;}
+                if (s->cur + len > s->end) goto truncated;
                 if (!read_simple_block(s, frm, len)) {
                     return 1;
                 }
@@ -270,7 +308,7 @@ int mkv_next(struct mkv *s, struct mkv_frame *frm) {
             case 0xae: // Segments->Tracks->TrackEntry
                 break;
             case 0xd7: // Segments->Tracks->TrackEntry->TrackNumber
-                if (s->cur + len > s->data + s->len) {s->cur += len; break;}
+                if (s->cur + len > s->end) goto truncated;
                 uint64_t track_number = get_uint(s, len);
                 break;
             case 0x83: // Segments->Tracks->TrackEntry->TrackType
@@ -278,12 +316,12 @@ int mkv_next(struct mkv *s, struct mkv_frame *frm) {
                 // 0x01 video track
                 // 0x03 complex track, e.g. audio + video
                 // 0x02, 0x10, 0x11, 0x12, 0x20 Other...
-                if (s->cur + len > s->data + s->len) {s->cur += len; break;}
+                if (s->cur + len > s->end) goto truncated;
                 uint64_t track_type = get_uint(s, len);
                 break;
             case 0x63a2: // Segments->Tracks->TrackEntry->CodecPrivate
                 // Information Codec needs before decoding can start 
-                if (s->cur + len > s->data + s->len) {s->cur += len; break;}
+                if (s->cur + len > s->end) goto truncated;
                 s->codec_private = s->cur;
                 s->codec_private_len = len;
                 s->cur += len;
@@ -297,20 +335,28 @@ int mkv_next(struct mkv *s, struct mkv_frame *frm) {
                 // Contains information that is specific for video tracks
                 break;
             case 0xb0: // Segments->Tracks->TrackEntry->Video->PixelWidth
-                if (s->cur + len > s->data + s->len) {s->cur += len; break;}
+                if (s->cur + len > s->end) goto truncated;
                 s->width = get_uint(s, len);
                 break;
             case 0xba: // Segments->Tracks->TrackEntry->Video->PixelHeight
-                if (s->cur + len > s->data + s->len) {s->cur += len; break;}
+                if (s->cur + len > s->end) goto truncated;
                 s->height = get_uint(s, len);
                 break;
             default:
                 //printf("0x%x\n", id);
+                if (s->cur + len > s->end) goto truncated;
                 s->cur += len;
         }
     }
     memset(frm, 0, sizeof(struct mkv_frame));
     return 0;
+
+truncated:
+    // Leave the cursor at the start of the truncated element to
+    // allow it to be read if more data is appended (see mkv_remap)
+    s->cur = s->data + offset;
+    memset(frm, 0, sizeof(struct mkv_frame));
+    return 0;
 }
 
 void mkv_seek(struct mkv *s, unsigned long offset) {
@@ -319,12 +365,221 @@ void mkv_seek(struct mkv *s, unsigned long offset) {
 
 }
 
+void mkv_limit(struct mkv *s, unsigned long offset) {
+    if (offset == 0 || offset > s->len) offset = s->len;
+    s->end = s->data + offset;
+}
+
+unsigned long mkv_tell(struct mkv *s) {
+    return s->cur - s->data;
+}
+
+/*
+ * Check that the bytes at offset looks like the start of a Cluster, i.e.
+ * the Cluster ID and size followed by a Timecode element, possibly after
+ * CRC-32 and Void elements.
+ */
+static int valid_cluster(struct mkv *s, unsigned long offset) {
+    uint8_t *org = s->cur, *org_end = s->end;
+    uint8_t *body;
+    uint64_t len, id;
+    int valid = 0;
+    s->cur = s->data + offset + 4;
+    s->end = s->data + s->len;
+    len = get_size(s);
+    body = s->cur;
+    // Known sizes has to fit in the file, 2^56-1 is the unknown size
+    if (len != 0xffffffffffffffULL && (uint64_t) (s->end - body) < len) goto done;
+    while (s->cur < s->end) {
+        id = get_id(s);
+        len = get_size(s);
+        if (id == 0xBF || id == 0xEC) { // CRC-32 or Void
+            if ((uint64_t) (s->end - s->cur) < len) goto done;
+            s->cur += len;
+            continue;
+        }
+        valid = (id == 0xE7 && len >= 1 && len <= 8 && (uint64_t) (s->end - s->cur) >= len);
+        break;
+    }
+done:
+    s->cur = org;
+    s->end = org_end;
+    return valid;
+}
+
+unsigned long mkv_sync(struct mkv *s, unsigned long offset) {
+    uint8_t id[] = {0x1f, 0x43, 0xb6, 0x75};
+    uint8_t *p = s->data + offset, *end = s->data + s->len;
+    while (p + sizeof(id) <= end && (p = memchr(p, id[0], end - p - sizeof(id) + 1))) {
+        if (!memcmp(p, id, sizeof(id)) && valid_cluster(s, p - s->data)) {
+            return p - s->data;
+        }
+        p++;
+    }
+    return 0;
+}
+
+/*
+ * Check that the element at offset is a Cluster
+ */
+static int is_cluster(struct mkv *s, unsigned long offset) {
+    uint8_t id[] = {0x1f, 0x43, 0xb6, 0x75};
+    return offset + sizeof(id) <= s->len && !memcmp(s->data + offset, id, sizeof(id));
+}
+
+/*
+ * Parse the CuePoints of the Cues element at the cursor and store up
+ * to n of them in cues. Returns the total number of cue points found.
+ */
+static int read_cues(struct mkv *s, uint64_t segment_offset, struct mkv_cue *cues, int n) {
+    int count = 0, pending = 0;
+    uint64_t pts = 0;
+    uint64_t len = get_size(s);
+    uint8_t *end = s->cur + len;
+    if (end > s->end) end = s->end;
+    while (s->cur < end) {
+        uint64_t id = get_id(s);
+        len = get_size(s);
+        switch (id) {
+            case 0xbb: // Cues->CuePoint
+                pending = 0;
+                break;
+            case 0xb3: // Cues->CuePoint->CueTime
+                if (s->cur + len > end) {s->cur = end; break;}
+                // Same scaling as for the SimpleBlock timecodes
+                pts = get_uint(s, len) * (s->time_scale / 1000);
+                pending = 1;
+                break;
+            case 0xb7: // Cues->CuePoint->CueTrackPositions
+                break;
+            case 0xf1: // Cues->CuePoint->CueTrackPositions->CueClusterPosition
+                if (s->cur + len > end) {s->cur = end; break;}
+                uint64_t offset = segment_offset + get_uint(s, len);
+                // Only use the first track position of each cue point
+                // and only if it points to a cluster
+                if (pending && is_cluster(s, offset)) {
+                    if (count < n) {
+                        cues[count].pts = pts;
+                        cues[count].offset = offset;
+                    }
+                    count++;
+                    pending = 0;
+                }
+                break;
+            default:
+                s->cur += len;
+        }
+    }
+    return count;
+}
+
+int mkv_cues(struct mkv *s, struct mkv_cue *cues, int n) {
+    uint8_t *org = s->cur;
+    uint64_t segment_offset = 0, cues_offset = 0;
+    int count = -1;
+
+    s->cur = s->data;
+    s->time_scale = 1000000; // Default TimecodeScale
+    if (get_id(s) != 0x1A45DFA3) goto done; // EBML header
+    s->cur += get_size(s);
+    if (get_id(s) != 0x18538067) goto done; // Segments
+    get_size(s);
+    // SeekPositions are relative to the start of the segment data
+    segment_offset = s->cur - s->data;
+
+    // Walk the top level elements of the segment up to the first
+    // Cluster looking for the SeekHead, the TimecodeScale and the Cues
+    while (s->cur < s->end && !cues_offset) {
+        unsigned long offset = s->cur - s->data;
+        uint64_t id = get_id(s);
+        uint64_t len = get_size(s);
+        uint8_t *end = s->cur + len;
+        if (end > s->end) break; // Unknown size or truncated
+        switch (id) {
+            case 0x114D9B74: // Segments->SeekHead
+                while (s->cur < end) {
+                    uint64_t seek_id = 0;
+                    uint64_t child = get_id(s);
+                    uint64_t child_len = get_size(s);
+                    if (child == 0x4DBB) { // SeekHead->Seek
+                        uint8_t *seek_end = s->cur + child_len;
+                        if (seek_end > end) break;
+                        while (s->cur < seek_end) {
+                            uint64_t field = get_id(s);
+                            uint64_t field_len = get_size(s);
+                            if (s->cur + field_len > seek_end) break;
+                            if (field == 0x53AB) { // Seek->SeekID
+                                seek_id = get_uint(s, field_len);
+                            } else if (field == 0x53AC && seek_id == 0x1C53BB6B) { // Seek->SeekPosition
+                                cues_offset = segment_offset + get_uint(s, field_len);
+                            } else {
+                                s->cur += field_len;
+                            }
+                        }
+                        s->cur = seek_end;
+                    } else {
+                        s->cur += child_len;
+                    }
+                }
+                s->cur = end;
+                break;
+            case 0x1549A966: // Segments->Segment Information
+                while (s->cur < end) {
+                    uint64_t child = get_id(s);
+                    uint64_t child_len = get_size(s);
+                    if (s->cur + child_len > end) break;
+                    if (child == 0x2AD7B1) { // TimecodeScale
+                        s->time_scale = get_uint(s, child_len);
+                    } else {
+                        s->cur += child_len;
+                    }
+                }
+                s->cur = end;
+                break;
+            case 0x1C53BB6B: // Segments->Cues
+                cues_offset = offset;
+                break;
+            default:
+                // Skip everything else including Clusters
+                s->cur = end;
+        }
+    }
+
+    if (cues_offset && cues_offset < s->len) {
+        s->cur = s->data + cues_offset;
+        if (get_id(s) == 0x1C53BB6B) {
+            count = read_cues(s, segment_offset, cues, n);
+        }
+    }
+
+done:
+    s->cur = org;
+    return count;
+}
+
+int mkv_index(struct mkv *s, struct mkv_index_entry *entries, int n) {
+    struct mkv_frame frm;
+    int i;
+    for (i = 0; i < n && mkv_next(s, &frm); i++) {
+        entries[i].pts = frm.pts;
+        entries[i].offset = frm.offset;
+        entries[i].key_frame = frm.key_frame;
+    }
+    return i;
+}
+
+int64_t mkv_systime_offset(struct mkv *s) {
+    if (s->systime_offset_count == 0) return 0;
+    s->systime_offset = s->systime_offset_sum / s->systime_offset_count;
+    return s->systime_offset;
+}
+
 int64_t mkv_estimate_systime_offset(struct mkv *s) {
     uint8_t *org = s->cur;
     struct mkv_frame frm;
     while (mkv_next(s, &frm));
     if (s->systime_offset_count == 0) return 0;
-    s->systime_offset = s->systime_offset_sum / s->systime_offset_count;
+    mkv_systime_offset(s);
     s->cur = org;
     return s->systime_offset;
 }
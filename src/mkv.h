@@ -13,9 +13,21 @@ struct mkv_frame {
     int key_frame;  // Set if this is a key-frame, else 0
 };
 
+struct mkv_index_entry {
+    uint64_t pts;  // Frame time from the matroska SimpleBlock
+    unsigned long offset;  // Offset for the cluster containing the frame
+    int key_frame;  // Set if this is a key-frame, else 0
+};
+
+struct mkv_cue {
+    uint64_t pts;  // Time of the cue point
+    unsigned long offset;  // Offset for the cluster of the cue point
+};
+
 struct mkv {
     uint8_t *cur;  // Current cursor position
     uint8_t *data; // Start address of mapped data
+    uint8_t *end;  // Parsing stops at this address
     size_t len; // Total size of mapped video in bytes
     int munmap_on_close;
     long time_scale;  // Current segment time multiplier to get nano sec
@@ -28,7 +40,10 @@ struct mkv {
     int64_t systime_offset_count;  // Number of summed frames
     int64_t systime_offset;  // Average systime offset from frame time
     unsigned long cluster_offset;  // Current cluster element start as bytes from data
+    int64_t cluster_systime_offset_sum;  // Value of systime_offset_sum at the start of current cluster
+    int64_t cluster_systime_offset_count;  // Value of systime_offset_count at the start of current cluster
     char *codec_id;  // Codec identifier
+    int64_t systime_samples;  // Stop accumulating systime offsets after this many samples (0 for all)
 };
 
 /*
@@ -36,6 +51,15 @@ struct mkv {
  */
 struct mkv *mkv_open(char *filename);
 
+/*
+ * Map the file once more if it has grown since it was opened. Returns 1 if
+ * it has, 0 otherwise. Parsing continues from the same position with the
+ * appended data available, including the element that was truncated at the
+ * previous end of the file. If frm is not NULL, the data of that frame is
+ * moved into the new mapping as well.
+ */
+int mkv_remap(struct mkv *s, char *filename, struct mkv_frame *frm);
+
 /*
  * Close the video file
  */
@@ -51,6 +75,49 @@ int mkv_next(struct mkv *s, struct mkv_frame *frm);
  */
 void mkv_seek(struct mkv *s, unsigned long offset);
 
+/*
+ * Stop parsing before offset in bytes. Use 0 to parse to the end of the file.
+ */
+void mkv_limit(struct mkv *s, unsigned long offset);
+
+/*
+ * Current cursor position in bytes
+ */
+unsigned long mkv_tell(struct mkv *s);
+
+/*
+ * Find the first Cluster starting at or after offset in bytes by searching
+ * for its ID and checking that a Timecode follows. Returns its offset, or
+ * 0 if there is none. Data inside frames that happens to look like a Cluster
+ * will be found too, which is detected if the preceding data is parsed up to
+ * the returned offset and the cursor does not end up exactly there.
+ */
+unsigned long mkv_sync(struct mkv *s, unsigned long offset);
+
+/*
+ * Read the Cues element, located through the SeekHead or among the top
+ * level elements before the first Cluster, and store up to n cue points
+ * in cues. Only cue points that points to a Cluster are considered. The
+ * TimecodeScale is read into s->time_scale. Returns the total number of
+ * cue points or -1 if there are no Cues in the file. Current cursor
+ * position is restored after the call.
+ */
+int mkv_cues(struct mkv *s, struct mkv_cue *cues, int n);
+
+/*
+ * Find up to n frames from current cursor and store their pts, cluster offset
+ * and key frame flag in entries. The axis systime offsets are accumulated
+ * in the same pass, use mkv_systime_offset() to get their average once done.
+ * Returns the number of entries stored, which is 0 at end of file.
+ */
+int mkv_index(struct mkv *s, struct mkv_index_entry *entries, int n);
+
+/*
+ * Average systime offset of the axis blocks parsed so far (0 if none).
+ * The result is also stored in s->systime_offset.
+ */
+int64_t mkv_systime_offset(struct mkv *s);
+
 /*
  * Estimate the system time offset if the video is from an Axis camera.
  * The time is estimated as an average offset from the frame time (pts)
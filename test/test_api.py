@@ -1,3 +1,5 @@
+from py.test import raises
+
 from vi3o import Video
 import os
 
@@ -9,3 +11,15 @@ systime_mkv = os.path.join(mydir, "systime.mkv")
 def test_video():
     assert Video(test_mjpg)[1].systime == 1445859308.97
     assert Video(systime_mkv)[1].systime == 1448984844.2525
+
+
+def test_video_unsupported_options():
+    # The files open fine without the options
+    Video(test_mjpg)
+    Video(systime_mkv)
+    with raises(TypeError):
+        Video(test_mjpg, size=(80, 60))
+    with raises(TypeError):
+        Video(test_mjpg, frame_cache=None)
+    with raises(TypeError):
+        Video(systime_mkv, prefech=2)
@@ -0,0 +1,160 @@
+import os
+import shutil
+import threading
+import time
+
+import vi3o
+from vi3o import cache, utils
+from vi3o.mjpg import Mjpg
+from vi3o.__main__ import main
+from vi3o.cache import find_videos
+from vi3o.utils import index_file, index_lock, remove_index_lock
+
+mydir = os.path.dirname(__file__)
+test_mjpg = os.path.join(mydir, "t.mjpg")
+
+
+def _make_videos(tmpdir):
+    paths = [str(tmpdir.join('a', 'first.mjpg')), str(tmpdir.join('b', 'c', 'second.mjpg'))]
+    for path in paths:
+        os.makedirs(os.path.dirname(path))
+        shutil.copy(test_mjpg, path)
+    tmpdir.join('b', 'notes.txt').write('not a video')
+    return paths
+
+def test_find_videos(tmpdir):
+    paths = _make_videos(tmpdir)
+    assert find_videos([str(tmpdir)]) == sorted(paths)
+    assert find_videos([paths[1]]) == [paths[1]]
+
+def test_index_many(tmpdir):
+    paths = _make_videos(tmpdir)
+    for path in paths:
+        if os.path.exists(index_file(path.encode('utf-8'), False)):
+            os.unlink(index_file(path.encode('utf-8'), False))
+    progress = []
+    errors = vi3o.index_many([str(tmpdir)], workers=2,
+                             progress=lambda *args: progress.append(args))
+    assert errors == {}
+    assert sorted(p[2] for p in progress) == sorted(paths)
+    assert sorted(p[0] for p in progress) == [1, 2]
+    for path in paths:
+        assert os.path.exists(index_file(path.encode('utf-8'), False))
+
+def test_index_cli(tmpdir, capsys):
+    paths = _make_videos(tmpdir)
+    missing = str(tmpdir.join('missing.mjpg'))
+    assert main(['index', '--jobs', '1', str(tmpdir), missing]) == 1
+    out = capsys.readouterr()[0]
+    assert '[3/3]' in out
+    assert 'missing.mjpg FAILED' in out
+    assert main(['index', '-q', paths[0]]) == 0
+
+def test_index_lock(tmpdir):
+    path = str(tmpdir.join('video.idx'))
+    events = []
+    def build():
+        with index_lock(path):
+            events.append('second')
+    with index_lock(path):
+        thread = threading.Thread(target=build)
+        thread.start()
+        time.sleep(0.2)
+        events.append('first')
+    thread.join()
+    assert events == ['first', 'second']
+
+    t0 = time.time()
+    with index_lock(path):
+        with index_lock(path, timeout=0.1):
+            events.append('timeout')
+    assert time.time() - t0 >= 0.1
+    assert events[-1] == 'timeout'
+
+    # Lock files removed while waiting for them are not locked
+    def wait():
+        with index_lock(path):
+            events.append('waited')
+            assert os.path.exists(path + '.lock')
+    with index_lock(path):
+        thread = threading.Thread(target=wait)
+        thread.start()
+        time.sleep(0.2)
+        remove_index_lock(path)
+        assert os.path.exists(path + '.lock')
+    remove_index_lock(path)
+    thread.join()
+    assert events[-1] == 'waited'
+    remove_index_lock(path)
+    assert not os.path.exists(path + '.lock')
+
+    # Unlocked if the lock file can not be created
+    with index_lock(str(tmpdir.join('missing', 'video.idx'))):
+        events.append('unlocked')
+    assert events[-1] == 'unlocked'
+
+def test_evict(tmpdir, monkeypatch):
+    monkeypatch.setattr(utils, 'cache_dir', str(tmpdir.join('cache')))
+    paths = _make_videos(tmpdir)
+    idxs = [index_file(path.encode('utf-8'), False) for path in paths]
+    for i, path in enumerate(paths):
+        assert len(Mjpg(path)) == 16
+        os.utime(idxs[i], (1000 - i, 1000 - i))
+    assert [e.path for e in cache.cache_entries()] == idxs[::-1]
+    size = cache.cache_size()
+    assert size > 0
+
+    index_file(paths[1].encode('utf-8'), False)
+    assert [e.path for e in cache.cache_entries()] == idxs
+    assert cache.evict(size - 1) == [idxs[0]]
+    assert not os.path.exists(idxs[0])
+    assert cache.evict(size) == []
+    with index_lock(idxs[1]):
+        assert cache.purge() == [idxs[1]]
+        assert os.path.exists(idxs[1] + '.lock')
+    assert cache.cache_entries() == []
+    # Left since it was in use, but removed by the next eviction
+    assert cache.purge() == []
+    assert not os.path.exists(idxs[1] + '.lock')
+
+def test_parse_size():
+    assert cache.parse_size('1000') == 1000
+    assert cache.parse_size('2k') == 2048
+    assert cache.parse_size('1.5M') == 1536 * 1024
+    assert cache.parse_size('none') is None
+
+def test_shared_cache(tmpdir, monkeypatch):
+    path = _make_videos(tmpdir)[0]
+    monkeypatch.setattr(utils, 'cache_dir', str(tmpdir.join('shared')))
+    shared_idx = index_file(path.encode('utf-8'), False)
+    assert len(Mjpg(path)) == 16
+    monkeypatch.setattr(utils, 'cache_dir', str(tmpdir.join('local')))
+    monkeypatch.setattr(utils, 'shared_cache_dirs', [str(tmpdir.join('shared'))])
+    idx = index_file(path.encode('utf-8'), False)
+    assert idx.startswith(str(tmpdir.join('local')))
+    with open(idx) as a, open(shared_idx) as b:
+        assert a.read() == b.read()
+
+def test_sidecar_index(tmpdir, monkeypatch):
+    monkeypatch.setattr(utils, 'cache_dir', str(tmpdir.join('cache')))
+    monkeypatch.setattr(utils, 'sidecar_index', True)
+    path = _make_videos(tmpdir)[0]
+    idx = index_file(path.encode('utf-8'), False)
+    assert os.path.dirname(idx) == str(tmpdir.join('a', '.vi3o'))
+    assert len(Mjpg(path)) == 16
+    assert os.path.exists(idx)
+    moved = str(tmpdir.join('moved'))
+    shutil.move(str(tmpdir.join('a')), moved)
+    assert index_file(os.path.join(moved, 'first.mjpg'), False) == \
+        os.path.join(moved, '.vi3o', os.path.basename(idx))
+
+def test_cache_cli(tmpdir, monkeypatch, capsys):
+    monkeypatch.setattr(utils, 'cache_dir', str(tmpdir.join('cache')))
+    _make_videos(tmpdir)
+    assert main(['index', '-q', str(tmpdir)]) == 0
+    assert main(['cache', 'list']) == 0
+    assert '2 files' in capsys.readouterr()[0]
+    assert main(['cache', 'purge', '--max-size', '1M']) == 0
+    assert main(['cache', 'purge']) == 0
+    assert 'Removed 2 files' in capsys.readouterr()[0]
+    assert cache.cache_entries() == []
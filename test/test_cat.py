@@ -4,6 +4,7 @@ from __future__ import unicode_literals, print_function
 import os
 import sys
 
+import numpy as np
 import pytest
 import vi3o
 from vi3o import cat
@@ -196,3 +197,25 @@ def test_cat_kwargs_forwarding(monkeypatch):
     videocat = cat.VideoCat(["hello.mkv"], grey=True)
     assert my_mock.called
     my_mock.assert_called_with("hello.mkv", grey=True)
+
+
+def test_cat_read_batch(videocat):
+    batch = videocat.read_batch(3, 8)
+    assert batch.shape == (8, 2, 2)
+    assert list(batch[:, 0, 0]) == [3, 4, 0, 1, 2, 3, 4, 5]
+    assert list(batch.index) == list(range(3, 11))
+    assert list(batch.systime) == pytest.approx(_EXPECTED_SYSTIMES[3:11])
+    assert list(batch.timestamp) == pytest.approx(_EXPECTED_TIMESTAMPS[3:11])
+
+    out = np.zeros((4, 2, 2), np.uint8)
+    batch = videocat.read_batch(-3, 4, out=out)
+    assert len(batch) == 3
+    assert np.shares_memory(batch, out)
+    assert list(batch.systime) == pytest.approx(_EXPECTED_SYSTIMES[-3:])
+
+
+def test_cat_iter_batches(videocat):
+    batches = list(videocat.iter_batches(4))
+    assert [len(batch) for batch in batches] == [4, 4, 4, 3]
+    systimes = np.concatenate([batch.systime for batch in batches])
+    assert list(systimes) == pytest.approx(_EXPECTED_SYSTIMES)
@@ -1,5 +1,5 @@
 from py.test import raises
-from vi3o.mjpg import Mjpg, jpg_info
+from vi3o.mjpg import Mjpg, MjpgIter, jpg_info
 from vi3o.utils import index_file
 import os
 from vi3o.compat import pathlib
@@ -66,3 +66,218 @@ def test_grey():
     for img in video:
         assert img.shape == (120, 160)
 
+
+def test_background_index():
+    idx = index_file(Mjpg(test_mjpg).filename, False)
+    if os.path.exists(idx):
+        os.unlink(idx)
+    video = Mjpg(test_mjpg, background=True)
+    assert 0.0 <= video.index_progress <= 1.0
+    assert video[3].index == 3
+    assert video.estimated_length > 0
+    assert len(video) == 16
+    assert video.index_progress == 1.0
+    assert video.estimated_length == 16
+    assert video.offset == Mjpg(test_mjpg).offset
+    assert Mjpg(test_mjpg, background=True)._index_thread is None
+
+def test_skip(tmpdir):
+    import io
+    import PIL.Image
+    # Progressive images have several scans that are read when the
+    # decompression starts, make sure they are skipped too
+    frames = list(Mjpg(test_mjpg))
+    data = b''
+    for i, img in enumerate(frames):
+        buf = io.BytesIO()
+        PIL.Image.fromarray(img).save(buf, 'jpeg', progressive=bool(i % 2))
+        data += buf.getvalue()
+    filename = str(tmpdir.join('progressive.mjpg'))
+    with open(filename, 'wb') as fd:
+        fd.write(data)
+    for name in (test_mjpg, filename):
+        it = MjpgIter(name.encode('utf-8'))
+        offsets = []
+        for img in it:
+            offsets.append(it.m.start_position_in_file)
+        it = MjpgIter(name.encode('utf-8'))
+        assert list(iter(it.skip, None)) == offsets
+        assert it.fcnt == len(frames)
+    video = Mjpg(filename)
+    assert len(video) == len(frames)
+    assert video[7].index == 7
+
+def test_index_captured_while_iterating():
+    video = Mjpg(test_mjpg)
+    idx = index_file(video.filename, False)
+    if os.path.exists(idx):
+        os.unlink(idx)
+    for img in video:
+        pass
+    assert os.path.exists(idx)
+    offsets = video._index
+    assert video.offset == offsets
+    os.unlink(idx)
+    assert Mjpg(test_mjpg).offset == offsets
+
+def test_index_captured_unsaved(monkeypatch, tmpdir):
+    import vi3o.utils
+    offsets = Mjpg(test_mjpg).offset
+    # A cache directory that can not be created
+    tmpdir.join('file').write('')
+    monkeypatch.setattr(vi3o.utils, 'cache_dir', str(tmpdir.join('file', 'cache')))
+    video = Mjpg(test_mjpg)
+    for img in video:
+        pass
+    assert video.offset == offsets
+
+def test_yuv420p():
+    video = Mjpg(test_mjpg, pixel_format='yuv420p')
+    grey = Mjpg(test_mjpg, grey=True)
+    rgb = Mjpg(test_mjpg)
+    for img, grey_img in zip(video, grey):
+        assert img.shape == (180, 160)
+        assert img.u.shape == img.v.shape == (60, 80)
+        assert (img.y == grey_img).all()
+        assert img.timestamp == grey_img.timestamp
+    img = video[3]
+    assert img.index == 3
+    # JFIF YCbCr to RGB
+    y = img.y.astype(float)
+    u = img.u.repeat(2, 0).repeat(2, 1) - 128.0
+    v = img.v.repeat(2, 0).repeat(2, 1) - 128.0
+    g = y - 0.344136 * u - 0.714136 * v
+    assert abs(g.clip(0, 255) - rgb[3][:, :, 1]).mean() < 2
+    with raises(ValueError):
+        Mjpg(test_mjpg, pixel_format='bgr')
+
+def test_read_out():
+    import numpy as np
+    video = Mjpg(test_mjpg)
+    out = np.zeros((120, 160, 3), np.uint8)
+    img = video.read(3, out=out)
+    assert img.index == 3
+    assert np.shares_memory(img, out)
+    assert (out == video[3]).all()
+    it = iter(video)
+    assert it.next(out).index == 0
+    assert (out == video[0]).all()
+    with raises(ValueError):
+        video.read(3, out=np.zeros((120, 160), np.uint8))
+
+def test_frame_pool():
+    from vi3o import FramePool
+    pool = FramePool(2)
+    video = Mjpg(test_mjpg, pool=pool)
+    reference = [img.copy() for img in Mjpg(test_mjpg)]
+    buffers = set()
+    for img, ref in zip(video, reference):
+        assert (img == ref).all()
+        buffers.add(img.__array_interface__['data'][0])
+    assert len(buffers) == len(pool) == 2
+    # Frames still referenced are not reused
+    imgs = list(video)
+    assert all((img == ref).all() for img, ref in zip(imgs, reference))
+    assert len(pool) == 2
+
+def test_read_batch():
+    import numpy as np
+    video = Mjpg(test_mjpg)
+    frames = list(Mjpg(test_mjpg))
+    batch = video.read_batch(3, 5)
+    assert batch.shape == (5, 120, 160, 3)
+    assert list(batch.index) == [3, 4, 5, 6, 7]
+    assert list(batch.timestamp) == [img.timestamp for img in frames[3:8]]
+    assert all((batch[i] == frames[3 + i]).all() for i in range(5))
+    assert len(video.read_batch(14, 5)) == 2
+    assert len(video.read_batch(16, 5)) == 0
+    with raises(IndexError):
+        video.read_batch(17, 1)
+
+    batches = list(video.iter_batches(5))
+    assert [len(batch) for batch in batches] == [5, 5, 5, 1]
+    assert list(np.concatenate([batch.index for batch in batches])) == list(range(16))
+
+    video = Mjpg(test_mjpg, pixel_format='yuv420p')
+    batch = video.read_batch(0, 3)
+    assert batch.y.shape == (3, 120, 160)
+    assert (batch.u[2] == video[2].u).all()
+
+def test_scale():
+    full = list(Mjpg(test_mjpg))
+    for scale, shape in [(0.5, (60, 80)), (0.25, (30, 40)), (0.125, (15, 20))]:
+        video = Mjpg(test_mjpg, scale=scale)
+        imgs = list(video)
+        assert len(imgs) == 16
+        assert imgs[0].shape == shape + (3,)
+        assert (video[3] == imgs[3]).all()
+        assert [img.timestamp for img in imgs] == [img.timestamp for img in full]
+    half = Mjpg(test_mjpg, scale=0.5)[0].astype(float)
+    assert abs(half - full[0].reshape(60, 2, 80, 2, 3).mean(axis=(1, 3))).mean() < 2
+
+    video = Mjpg(test_mjpg, scale=0.5, pixel_format='yuv420p')
+    assert video[0].shape == (90, 80)
+    assert (video[0].y == Mjpg(test_mjpg, scale=0.5, grey=True)[0]).all()
+    with raises(ValueError):
+        Mjpg(test_mjpg, scale=0.3)
+
+def test_decode_jpeg():
+    from vi3o.mjpg import decode_jpeg
+    with open(test_jpg, "rb") as fd:
+        data = fd.read()
+    assert decode_jpeg(data).shape == (240, 352, 3)
+    assert decode_jpeg(data, scale=0.25).shape == (60, 88, 3)
+    assert decode_jpeg(data, grey=True, scale=0.5).shape == (120, 176)
+
+def test_crop():
+    full = list(Mjpg(test_mjpg))
+    for x, y, w, h in [(10, 20, 50, 40), (33, 17, 127, 103), (150, 110, 10, 10)]:
+        video = Mjpg(test_mjpg, crop=(x, y, w, h))
+        imgs = list(video)
+        assert imgs[0].shape == (h, w, 3)
+        assert all((img == ref[y:y+h, x:x+w]).all() for img, ref in zip(imgs, full))
+        assert (video[5] == full[5][y:y+h, x:x+w]).all()
+    batch = Mjpg(test_mjpg, crop=(10, 20, 50, 40)).read_batch(2, 4)
+    assert all((batch[i] == full[2 + i][20:60, 10:60]).all() for i in range(4))
+
+    grey = Mjpg(test_mjpg, grey=True)[3]
+    assert (Mjpg(test_mjpg, grey=True, crop=(10, 20, 50, 40))[3] == grey[20:60, 10:60]).all()
+    yuv = Mjpg(test_mjpg, pixel_format='yuv420p')[3]
+    img = Mjpg(test_mjpg, pixel_format='yuv420p', crop=(11, 21, 50, 40))[3]
+    assert (img.y == yuv.y[20:60, 10:60]).all()
+    assert (img.u == yuv.u[10:30, 5:30]).all()
+    assert (img.v == yuv.v[10:30, 5:30]).all()
+
+    half = Mjpg(test_mjpg, scale=0.5)[0]
+    assert (Mjpg(test_mjpg, scale=0.5, crop=(20, 40, 100, 60))[0] == half[20:50, 10:60]).all()
+    # Full resolution columns 21 to 150 are in the scaled columns 10 to 75
+    assert (Mjpg(test_mjpg, scale=0.5, crop=(21, 41, 130, 78))[0] == half[20:60, 10:76]).all()
+    eighth = Mjpg(test_mjpg, scale=1 / 8.0)[0]
+    assert (Mjpg(test_mjpg, scale=1 / 8.0, crop=(150, 110, 10, 10))[0] == eighth[13:15, 18:20]).all()
+    with raises(ValueError):
+        list(Mjpg(test_mjpg, crop=(100, 0, 100, 10)))
+
+def test_prefetch():
+    from vi3o.utils import PrefetchIter
+    frames = list(Mjpg(test_mjpg))
+    it = iter(Mjpg(test_mjpg, prefetch=4))
+    assert isinstance(it, PrefetchIter)
+    imgs = list(it)
+    assert [img.index for img in imgs] == list(range(16))
+    assert all((img == ref).all() for img, ref in zip(imgs, frames))
+    with raises(StopIteration):
+        next(it)
+
+    def failing():
+        yield 1
+        raise KeyError('broken')
+    it = PrefetchIter(failing(), 2)
+    assert next(it) == 1
+    with raises(KeyError):
+        next(it)
+
+    it = PrefetchIter(iter(range(1000)), 2)
+    next(it)
+    it.close()
+    it._thread.join(1)
+    assert not it._thread.is_alive()
@@ -17,12 +17,19 @@ mjpg_codec_mkv = os.path.join(mydir, "test_mjpg_codec.mkv")
 mac_mkv = os.path.join(mydir, "c.mkv")
 codec_bug_mkv = os.path.join(mydir, "20220914_093512_A4D4.mkv")
 
+def remove_index(fn):
+    # Mkv looks up its index by the utf-8 encoded filename
+    if not isinstance(fn, bytes):
+        fn = fn.encode('utf-8')
+    for idx in (index_file(fn), index_file(fn, appendable=True)):
+        if os.path.exists(idx):
+            os.unlink(idx)
+
 def test_iter():
     timestamps = []
     pixels = []
     video = Mkv(test_mkv)
-    if os.path.exists(index_file(test_mkv)):
-        os.unlink(index_file(test_mkv))
+    remove_index(test_mkv)
     for i, img in enumerate(video):
         assert img.index == i
         timestamps.append(img.timestamp)
@@ -48,8 +55,7 @@ def test_iter():
         video[100]
 
 def test_idx():
-    if os.path.exists(index_file(test_mkv)):
-        os.unlink(index_file(test_mkv))
+    remove_index(test_mkv)
     test_iter()
     test_iter()
 
@@ -131,6 +137,146 @@ def test_mjpg_codec_grey():
         assert img.shape == (300, 480)
     assert systimes == [1539001990.82, 1539001991.82, 1539001992.82]
 
+def test_mjpg_codec_scale():
+    video = Mkv(mjpg_codec_mkv, scale=0.5)
+    assert [img.shape for img in video] == [(150, 240, 3)] * 3
+    assert video[1].systime == 1539001991.82
+    with raises(ValueError):
+        Mkv(mjpg_codec_mkv, scale=0.5, size=(100, 100))
+
+def test_mjpg_codec_crop():
+    full = list(Mkv(mjpg_codec_mkv))
+    video = Mkv(mjpg_codec_mkv, crop=(100, 50, 200, 120))
+    imgs = list(video)
+    assert imgs[0].shape == (120, 200, 3)
+    assert all((img == ref[50:170, 100:300]).all() for img, ref in zip(imgs, full))
+    assert video[1].systime == 1539001991.82
+    half = Mkv(mjpg_codec_mkv, scale=0.5)[2]
+    assert (Mkv(mjpg_codec_mkv, scale=0.5, crop=(100, 50, 200, 120))[2] == half[25:85, 50:150]).all()
+
+def test_keyframes():
+    video = Mkv(systime_mkv)
+    frames = list(Mkv(systime_mkv))
+    keyframes = list(video.keyframes())
+    key_index = [i for i, key in enumerate(video.frame['key_frame']) if key]
+    assert len(key_index) < len(frames)
+    assert [img.index for img in keyframes] == key_index
+    for img in keyframes:
+        ref = frames[img.index]
+        assert img.pts == ref.pts
+        assert img.systime == ref.systime
+        assert (img == ref).all()
+    # Frame threading delays the output until the decoder is drained
+    threaded = list(Mkv(systime_mkv, threads=4, thread_type='frame').keyframes())
+    assert [img.pts for img in threaded] == [img.pts for img in keyframes]
+    assert all((a == b).all() for a, b in zip(threaded, keyframes))
+    assert [img.index for img in Mkv(systime_mkv, keyframes_only=True)] == key_index
+    assert [img.index for img in Mkv(mjpg_codec_mkv).keyframes()] == [0, 1, 2]
+
+def test_iter_indexes():
+    frames = list(Mkv(systime_mkv))
+    video = Mkv(systime_mkv)
+    for sub in (video[::4], video[3::13], video[30:], video[::-5]):
+        imgs = list(sub)
+        assert [img.index for img in imgs] == list(sub.range)
+        for img in imgs:
+            assert img.pts == frames[img.index].pts
+            assert img.systime == frames[img.index].systime
+            assert (img == frames[img.index]).all()
+
+    imgs = list(video.iter_fps(2))
+    assert 0 < len(imgs) < len(frames)
+    slots = [int((img.pts - frames[0].pts) * 2 // 1000000) for img in imgs]
+    assert slots == list(range(len(slots)))
+    assert all((img == frames[img.index]).all() for img in imgs)
+    assert [img.index for img in Mkv(mjpg_codec_mkv)[::2]] == [0, 2]
+
+def test_reverse():
+    frames = list(Mkv(systime_mkv))
+    video = Mkv(systime_mkv)
+    for sub in (video[::-1], video[33:2:-3], video[31::-1]):
+        imgs = list(sub)
+        assert [img.index for img in imgs] == list(sub.range)
+        assert all((img == frames[img.index]).all() for img in imgs)
+        assert [img.systime for img in imgs] == [frames[i].systime for i in sub.range]
+
+def test_frame_cache():
+    from vi3o import FrameCache
+    frames = list(Mkv(systime_mkv))
+    cache = FrameCache()
+    video = Mkv(systime_mkv, frame_cache=cache)
+    key = max(i for i in range(21) if video.frame['key_frame'][i])
+    img = video[20]
+    assert all(i in cache for i in range(key, 21))
+    img[...] = 0
+    for i in range(20, key - 1, -1):
+        img = video[i]
+        assert img.index == i
+        assert img.pts == frames[i].pts
+        assert (img == frames[i]).all()
+
+    cache = FrameCache(3 * frames[0].nbytes)
+    video = Mkv(systime_mkv, frame_cache=cache)
+    video[20]
+    assert len(cache) == 3 and cache.nbytes == 3 * frames[0].nbytes
+    assert all(i in cache for i in (18, 19, 20))
+
+def test_frame_cache_pool():
+    import numpy as np
+    from vi3o import FrameCache, FramePool
+    frames = list(Mkv(systime_mkv))
+    pool = FramePool(2)
+    cache = FrameCache()
+    video = Mkv(systime_mkv, frame_cache=cache, pool=pool)
+    video[20]
+    buffers = [np.frombuffer(buf[0], 'B') for buf in pool._buffers]
+    assert len(cache) > 1
+    assert not any(np.shares_memory(img, buf)
+                   for img in cache._frames.values() for buf in buffers)
+    for i in range(20, -1, -1):
+        img = video[i]
+        img[...] = 0
+        del img
+        assert (video[i] == frames[i]).all()
+
+def test_frame_cache_read_batch():
+    from vi3o import FrameCache
+    frames = list(Mkv(systime_mkv))
+    video = Mkv(systime_mkv, frame_cache=FrameCache())
+    video[5]
+    video[9]
+    batch = video.read_batch(5, 4)
+    assert list(batch.index) == [5, 6, 7, 8]
+    assert list(batch.pts) == [frames[i].pts for i in range(5, 9)]
+    assert all((batch[i] == frames[5 + i]).all() for i in range(4))
+
+def test_frame_cache_eviction():
+    import numpy as np
+    from vi3o import FrameCache
+    cache = FrameCache(300)
+    for i in range(4):
+        cache.put(i, np.zeros(100, 'B'))
+    assert sorted(cache._frames) == [1, 2, 3]
+    cache.get(1)
+    cache.put(4, np.zeros(100, 'B'))
+    assert sorted(cache._frames) == [1, 3, 4]
+    cache = FrameCache(300, 'fifo')
+    for i in range(3):
+        cache.put(i, np.zeros(100, 'B'))
+    cache.get(0)
+    cache.put(3, np.zeros(100, 'B'))
+    assert sorted(cache._frames) == [1, 2, 3]
+    cache.put(5, np.zeros(1000, 'B'))
+    assert 5 not in cache
+    with raises(ValueError):
+        FrameCache(policy='random')
+
+def test_prefetch():
+    frames = list(Mkv(systime_mkv))
+    imgs = list(Mkv(systime_mkv, prefetch=3))
+    assert [img.pts for img in imgs] == [img.pts for img in frames]
+    assert all((img == ref).all() for img, ref in zip(imgs, frames))
+
 def test_serial_number():
     assert Mkv(mac_mkv).serial_number == b'ACCC8E19244E'
 
@@ -145,3 +291,242 @@ def test_decode_bug():
     img2 = video[1]
     assert (img1-img2).sum() == 0
 
+
+def test_systime_samples():
+    full = Mkv(systime_mkv, reindex=True)
+    for samples in (1, 3):
+        # Axis metadata blocks are not frames, also after the last sample
+        sampled = Mkv(systime_mkv, reindex=True, systime_samples=samples)
+        assert len(sampled) == len(full)
+        assert (sampled.frame == full.frame).all()
+        assert abs(sampled.systime_offset - full.systime_offset) < 10000
+
+def test_json_index_migration():
+    import json
+    video = Mkv(systime_mkv)
+    idx = index_file(video.filename)
+    remove_index(video.filename)
+    with open(idx, "w") as fd:
+        json.dump({'frame': [[int(v) for v in f] for f in video.frame],
+                   'systime_offset': video.systime_offset,
+                   'mjpg_mode': video.mjpg_mode,
+                   'version': 4}, fd)
+    migrated = Mkv(systime_mkv)
+    assert (migrated.frame == video.frame).all()
+    assert migrated.systimes == video.systimes
+    with open(index_file(video.filename, appendable=True), "rb") as fd:
+        assert fd.read(4) == b'VI3O'
+
+def test_fast_open():
+    video = Mkv(systime_mkv)
+    fast = Mkv(systime_mkv, reindex=True, fast_open=True)
+    assert len(fast.cues) == 2
+    img = fast.at_timestamp(video[-1].timestamp + 1)
+    assert img.index is None
+    assert img.pts == video[-1].pts
+    img = fast.at_timestamp(video[20].timestamp + 0.001)
+    assert img.index == 20
+    assert (img == video[20]).all()
+    assert (fast.frame == video.frame).all()
+    assert fast.systimes == video.systimes
+    assert fast.at_timestamp(video[7].timestamp).index == 7
+
+def test_refresh_appended(tmpdir):
+    with open(systime_mkv, 'rb') as fd:
+        data = fd.read()
+    fn = str(tmpdir.join('growing.mkv'))
+    with open(fn, 'wb') as fd:
+        fd.write(data[:20001])
+    video = Mkv(fn)
+    n = len(video)
+    assert 0 < n < 36
+    assert not video.refresh()
+    # The decoder has read its first packet, which the refresh remaps
+    assert video.myiter.fcnt == 0
+    with open(fn, 'ab') as fd:
+        fd.write(data[20001:])
+    os.utime(fn, (0, 0))
+    assert video.refresh()
+    full = Mkv(systime_mkv)
+    assert (video[0] == full[0]).all()
+    assert (video.frame == full.frame).all()
+    assert video.systime_offset == full.systime_offset
+    assert (video[-1] == full[-1]).all()
+    assert len(Mkv(fn)) == 36
+
+def test_refresh_lazy_and_background(tmpdir):
+    with open(systime_mkv, 'rb') as fd:
+        data = fd.read()
+    fn = str(tmpdir.join('growing.mkv'))
+    for options in ({'lazy': True}, {'background': True}, {'fast_open': True}):
+        with open(fn, 'wb') as fd:
+            fd.write(data[:20001])
+        video = Mkv(fn, reindex=True, **options)
+        assert not video.refresh()
+        with open(fn, 'ab') as fd:
+            fd.write(data[20001:])
+        os.utime(fn, (0, 0))
+        assert video.refresh()
+        assert len(video) == 36
+    assert not Mkv(systime_mkv, reindex=True, lazy=True).refresh()
+    assert not Mkv(systime_mkv, reindex=True, background=True).refresh()
+
+def test_follow(tmpdir):
+    fn = str(tmpdir.join('growing.mkv'))
+    with open(systime_mkv, 'rb') as src, open(fn, 'wb') as dst:
+        dst.write(src.read())
+    video = Mkv(fn, follow=0.2)
+    assert len([img for img in video]) == 36
+
+def test_background_index():
+    full = Mkv(systime_mkv)
+    video = Mkv(systime_mkv, reindex=True, background=True)
+    assert 0.0 <= video.index_progress <= 1.0
+    assert (video[2] == full[2]).all()
+    assert video.at_timestamp(full[30].timestamp).index == 30
+    assert len(video) == 36
+    assert video.index_progress == 1.0
+    assert video.estimated_length == 36
+    assert (video.frame == full.frame).all()
+    assert video.systimes == full.systimes
+
+def test_lazy_index():
+    full = Mkv(systime_mkv)
+    video = Mkv(systime_mkv, reindex=True, lazy=True)
+    assert video._frame is None
+    systimes = [img.systime for img in video]
+    assert video._frame is not None
+    assert (video.frame == full.frame).all()
+    assert video.systime_offset == full.systime_offset
+    assert abs(systimes[-1] - full.systimes[-1]) < 0.1
+    assert len(Mkv(systime_mkv, reindex=True, lazy=True)) == 36
+
+def test_lazy_index_unsaved(monkeypatch, tmpdir):
+    import vi3o.utils
+    full = Mkv(systime_mkv)
+    # A cache directory that can not be created
+    tmpdir.join('file').write('')
+    monkeypatch.setattr(vi3o.utils, 'cache_dir', str(tmpdir.join('file', 'cache')))
+    video = Mkv(systime_mkv, lazy=True)
+    assert len([img for img in video]) == 36
+    assert (video.frame == full.frame).all()
+
+def test_parallel_index():
+    for fn in (test_mkv, systime_mkv, codec_bug_mkv):
+        for samples in (None, 1, 3):
+            serial = Mkv(fn, reindex=True, systime_samples=samples, index_workers=1)
+            parallel = Mkv(fn, reindex=True, systime_samples=samples, index_workers=3)
+            assert (serial.frame == parallel.frame).all()
+            assert serial.systime_offset == parallel.systime_offset
+
+def test_mkv_sync():
+    m = lib.mkv_open(systime_mkv.encode('utf-8'))
+    assert lib.mkv_sync(m, 0) == 444
+    assert lib.mkv_sync(m, 445) == 12936
+    assert lib.mkv_sync(m, 12937) == 0
+    lib.mkv_close(m)
+
+def test_decoder_threads():
+    video = Mkv(systime_mkv)
+    for thread_type in (None, 'frame', 'slice'):
+        threaded = Mkv(systime_mkv, threads=4, thread_type=thread_type)
+        imgs = list(threaded)
+        assert len(imgs) == 36
+        assert [img.pts for img in imgs] == [img.pts for img in video]
+        assert (imgs[20] == video[20]).all()
+        assert (threaded[20] == video[20]).all()
+        assert (threaded[3] == video[3]).all()
+        assert threaded[21].pts == video[21].pts
+    with raises(ValueError):
+        Mkv(systime_mkv, thread_type='bad')
+
+def test_h264_grey():
+    video = Mkv(systime_mkv)
+    grey = Mkv(systime_mkv, grey=True)
+    for i in (0, 20):
+        img = video[i].astype(float)
+        luma = 0.299 * img[:, :, 0] + 0.587 * img[:, :, 1] + 0.114 * img[:, :, 2]
+        assert grey[i].shape == luma.shape
+        assert abs(grey[i] - luma).mean() < 3
+
+def test_yuv420p():
+    video = Mkv(systime_mkv, pixel_format='yuv420p')
+    grey = Mkv(systime_mkv, grey=True)
+    img = video[20]
+    h, w = grey[20].shape
+    assert img.shape == (h * 3 // 2, w)
+    assert img.y.shape == (h, w)
+    assert img.u.shape == img.v.shape == (h // 2, w // 2)
+    assert img.pts == grey[20].pts
+    assert len(list(video)) == 36
+    # The luma keeps the range of the video, while grey frames are full range
+    import numpy as np
+    expanded = np.clip(((img.y.astype(int) - 16) * 255 + 219 // 2) // 219, 0, 255)
+    assert (grey[20] == img.y).all() or (grey[20] == expanded).all()
+
+def test_mjpg_codec_yuv420p():
+    video = Mkv(mjpg_codec_mkv, pixel_format='yuv420p')
+    grey = Mkv(mjpg_codec_mkv, grey=True)
+    for img, grey_img in zip(video, grey):
+        assert img.shape == (450, 480)
+        assert img.u.shape == img.v.shape == (150, 240)
+        assert (img.y == grey_img).all()
+        assert img.systime == grey_img.systime
+
+def test_read_out():
+    import numpy as np
+    from vi3o import FramePool
+    video = Mkv(systime_mkv, pool=FramePool(2))
+    reference = [img.copy() for img in Mkv(systime_mkv)]
+    assert all((img == ref).all() for img, ref in zip(video, reference))
+    out = np.zeros_like(reference[0])
+    img = video.read(20, out=out)
+    assert img.index == 20
+    assert np.shares_memory(img, out)
+    assert (out == reference[20]).all()
+
+def test_read_batch():
+    import numpy as np
+    video = Mkv(systime_mkv)
+    frames = list(Mkv(systime_mkv))
+    batch = video.read_batch(18, 5)
+    assert len(batch) == 5
+    assert list(batch.index) == [18, 19, 20, 21, 22]
+    assert list(batch.pts) == [img.pts for img in frames[18:23]]
+    assert list(batch.systime) == [img.systime for img in frames[18:23]]
+    assert (batch[2] == frames[20]).all()
+    assert len(video.read_batch(34, 5)) == 2
+
+    batches = list(video.iter_batches(10))
+    assert [len(batch) for batch in batches] == [10, 10, 10, 6]
+    assert (np.concatenate(batches)[35] == frames[35]).all()
+
+def test_size_and_crop():
+    full = Mkv(systime_mkv, grey=True)[20]
+    h, w = full.shape
+    scaled = Mkv(systime_mkv, size=(w // 2, None), interpolation='area')
+    img = scaled[20]
+    assert img.shape == (h // 2, w // 2, 3)
+    assert img.pts == full.pts
+    assert len(list(scaled)) == 36
+
+    cropped = Mkv(systime_mkv, grey=True, crop=(16, 8, w // 2, h // 2))[20]
+    assert (cropped == full[8:8 + h // 2, 16:16 + w // 2]).all()
+    # Odd corners are exact, except for yuv420p
+    cropped = Mkv(systime_mkv, grey=True, crop=(17, 9, w // 2, h // 2))[20]
+    assert (cropped == full[9:9 + h // 2, 17:17 + w // 2]).all()
+    rgb = Mkv(systime_mkv)[20].astype(int)
+    cropped = Mkv(systime_mkv, crop=(17, 9, w // 2, h // 2))[20]
+    assert abs(cropped - rgb[9:9 + h // 2, 17:17 + w // 2]).mean() < 2
+    yuv = Mkv(systime_mkv, pixel_format='yuv420p', crop=(16, 8, w // 2, h // 2))[20]
+    assert (Mkv(systime_mkv, pixel_format='yuv420p', crop=(17, 9, w // 2, h // 2))[20] == yuv).all()
+
+    with raises(ValueError):
+        Mkv(systime_mkv, crop=(0, 0, w + 1, h))[0]
+    with raises(ValueError):
+        Mkv(systime_mkv, interpolation='sinc')
+    with raises(ValueError):
+        list(Mkv(mjpg_codec_mkv, size=(100, 100)))
+
+    img = Mkv(systime_mkv, scale=0.25)[20]
+    assert img.shape == ((h + 3) // 4, (w + 3) // 4, 3)
@@ -0,0 +1,69 @@
+import os
+
+from vi3o import parallel
+from vi3o.mkv import Mkv
+from vi3o.parallel import iter_frames, gop_ranges
+
+mydir = os.path.dirname(__file__)
+systime_mkv = os.path.join(mydir, "systime.mkv")
+mjpg_codec_mkv = os.path.join(mydir, "test_mjpg_codec.mkv")
+
+
+def test_gop_ranges(monkeypatch):
+    video = Mkv(systime_mkv)
+    assert gop_ranges(video) == [(0, 32), (32, 36)]
+    monkeypatch.setattr(parallel, 'MIN_TASK_FRAMES', 64)
+    assert gop_ranges(video) == [(0, 36)]
+
+
+def test_iter_frames():
+    frames = list(Mkv(systime_mkv))
+    imgs = list(iter_frames(Mkv(systime_mkv), workers=2, readahead=2))
+    assert [img.index for img in imgs] == list(range(len(frames)))
+    for img, ref in zip(imgs, frames):
+        assert img.pts == ref.pts
+        assert img.systime == ref.systime
+        assert (img == ref).all()
+
+
+def test_iter_frames_short_gops(monkeypatch):
+    monkeypatch.setattr(parallel, 'MIN_TASK_FRAMES', 1)
+    frames = list(Mkv(mjpg_codec_mkv, pixel_format='yuv420p'))
+    imgs = list(iter_frames(Mkv(mjpg_codec_mkv, pixel_format='yuv420p'), workers=3))
+    assert [img.systime for img in imgs] == [img.systime for img in frames]
+    assert all((img.u == ref.u).all() for img, ref in zip(imgs, frames))
+
+
+def test_workers_open_the_file(monkeypatch):
+    import multiprocessing
+    initargs = []
+    pool = multiprocessing.Pool
+    def capture(workers, initializer, args):
+        initargs.append(args)
+        return pool(workers, initializer, args)
+    monkeypatch.setattr(multiprocessing, 'Pool', capture)
+    video = Mkv(systime_mkv, grey=True)
+    imgs = list(iter_frames(video, workers=2))
+    assert all((img == ref).all() for img, ref in zip(imgs, Mkv(systime_mkv, grey=True)))
+    # The workers get the filename and options, not the index
+    filename, options = initargs[0][:2]
+    assert filename == systime_mkv
+    assert options['pixel_format'] == 'grey'
+
+
+def test_max_buffer_bytes(monkeypatch):
+    import multiprocessing
+    pools = []
+    pool = multiprocessing.Pool
+    def capture(workers, initializer, args):
+        pools.append((workers, args))
+        return pool(workers, initializer, args)
+    monkeypatch.setattr(multiprocessing, 'Pool', capture)
+    frames = list(Mkv(systime_mkv))
+    gop_bytes = 32 * frames[0].nbytes
+    for max_buffer_bytes, workers in ((1, 1), (gop_bytes, 1), (2 * gop_bytes, 2)):
+        imgs = list(iter_frames(Mkv(systime_mkv), workers=2, max_buffer_bytes=max_buffer_bytes))
+        assert all((img == ref).all() for img, ref in zip(imgs, frames))
+        assert len(imgs) == len(frames)
+        assert pools[-1][0] == workers
+        assert len(pools[-1][1][2]) == workers
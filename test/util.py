@@ -5,6 +5,10 @@ import sys
 
 import itertools
 
+import numpy as np
+
+from vi3o.utils import Frame
+
 # Python2 compatibility
 if sys.version_info >= (3, 3, 0):
     import unittest.mock as mock
@@ -49,4 +53,15 @@ class _FakeVideo:
             obj.systime = idx
             return obj
 
-        raise IndexError
\ No newline at end of file
+        raise IndexError
+
+    def read_batch(self, start, count, out=None):
+        count = min(count, self._length - start)
+        if out is None:
+            out = np.zeros((count, 2, 2), np.uint8)
+        batch = out[:count].view(Frame)
+        batch[:] = np.arange(start, start + count).reshape(-1, 1, 1)
+        batch.index = np.arange(start, start + count)
+        batch.timestamp = np.arange(start, start + count, dtype=float)
+        batch.systime = np.arange(start, start + count, dtype=float)
+        return batch
@@ -7,26 +7,29 @@ from .version import __version_info__, __version__
 
 # FIXME: Turn into a Video base class that documents the interface
 
-def Video(filename, grey=False):
+def Video(filename, grey=False, **kwargs):
     """
     Creates a *Video* object representing the video in the file *filename*.
-    See Overview above.
+    See Overview above. Additional keyword arguments, e.g. *background*, are passed
+    on to :class:`vi3o.mkv.Mkv` or :class:`vi3o.mjpg.Mjpg`, or to those of each
+    video of a :class:`vi3o.recording.Recording`. A TypeError is raised if they are
+    not supported for the kind of file.
     """
     # Be compatible with pathlib.Path filenames
     filename = str(filename)
 
     if filename.endswith('.mkv'):
         from vi3o.mkv import Mkv
-        return Mkv(filename, grey)
+        return Mkv(filename, grey, **kwargs)
     elif filename.endswith('.mjpg'):
         from vi3o.mjpg import Mjpg
-        return Mjpg(filename, grey)
+        return Mjpg(filename, grey, **kwargs)
     elif filename.endswith('recording.xml'):
         from vi3o.recording import read_recording_xml, Recording
-        return Recording(read_recording_xml(filename), grey=grey)
+        return Recording(read_recording_xml(filename), grey=grey, **kwargs)
     else:
         from vi3o.imageio import ImageioVideo
-        return ImageioVideo(filename, grey)
+        return ImageioVideo(filename, grey, **kwargs)
 
 
 def _get_debug_viewer(name):
@@ -65,3 +68,5 @@ def flipp(name='Default', pause=None, aspect_ratio=None):
 
 from vi3o.sync import SyncedVideos
 from vi3o.cat import VideoCat, VideoGlob
+from vi3o.cache import index_many
+from vi3o.utils import FramePool, FrameCache
@@ -0,0 +1,58 @@
+import argparse
+import sys
+import time
+
+from vi3o import cache
+from vi3o.cache import index_many
+
+
+def _print_progress(done, total, path, error):
+    if error is None:
+        print("[%d/%d] %s" % (done, total, path))
+    else:
+        print("[%d/%d] %s FAILED %s" % (done, total, path, error))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m vi3o', description='vi3o utilities')
+    commands = parser.add_subparsers(dest='command')
+
+    index = commands.add_parser('index', help='Build the cached index of video files')
+    index.add_argument('-j', '--jobs', type=int, default=None,
+                       help='Number of parallel processes (default: one per cpu core)')
+    index.add_argument('-q', '--quiet', action='store_true', help='Only report errors')
+    index.add_argument('paths', nargs='+', help='Video files or directories')
+
+    cache_parser = commands.add_parser('cache', help='Manage the index cache')
+    cache_commands = cache_parser.add_subparsers(dest='cache_command')
+    cache_commands.add_parser('list', help='List the cached index files, least recently used first')
+    purge = cache_commands.add_parser('purge', help='Remove cached index files')
+    purge.add_argument('--max-size', type=cache.parse_size, default=0,
+                       help='Only remove the least recently used files until the cache is '
+                            'smaller than this, e.g. 500M')
+
+    args = parser.parse_args(argv)
+    if args.command == 'index':
+        errors = index_many(args.paths, args.jobs, None if args.quiet else _print_progress)
+        for path in sorted(errors) if args.quiet else ():
+            print("%s FAILED %s" % (path, errors[path]))
+        return 1 if errors else 0
+    if args.command == 'cache' and args.cache_command == 'list':
+        entries = cache.cache_entries()
+        for entry in entries:
+            print("%10d  %s  %s" % (entry.size,
+                                    time.strftime('%Y-%m-%d %H:%M', time.localtime(entry.atime)),
+                                    entry.path))
+        print("%d files, %d bytes" % (len(entries), sum(e.size for e in entries)))
+        return 0
+    if args.command == 'cache' and args.cache_command == 'purge':
+        removed = cache.evict(args.max_size)
+        print("Removed %d files" % len(removed))
+        return 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+"""
+:mod:`vi3o.cache` --- Index cache management
+============================================
+
+Random access to mkv and mjpg files is based on an index of the frames in the file
+that is built when the file is first opened and then cached. The index files are
+stored in ``~/.cache/vi3o`` or the directory given by the ``VI3O_CACHE_DIR``
+environment variable (:data:`vi3o.utils.cache_dir`). When the cache grows larger
+than :data:`max_size` bytes, the least recently used index files are removed. The
+limit is 1G by default and can be set with the ``VI3O_CACHE_SIZE`` environment
+variable, e.g. ``VI3O_CACHE_SIZE=500M``, or ``none`` to never remove anything.
+
+To reuse index files between hosts, ``VI3O_SHARED_CACHE`` can be set to a list of
+cache directories (separated by ``os.pathsep``) populated by other hosts. They are
+only read from, and the index files found there are copied into the local cache.
+The videos need to be mounted at the same path on all hosts. If
+``VI3O_SIDECAR_INDEX=1`` is set, the index files are instead stored in a ``.vi3o``
+directory next to the videos, which works regardless of where they are mounted.
+Index files there are used even if the directory is read-only.
+
+For large collections of recordings, the cache can be populated up front using
+several processes:
+
+.. code-block:: python
+
+    import vi3o
+
+    vi3o.index_many(['/mnt/nas/recordings'], workers=8)
+
+or from the command line, where the cache can also be inspected and purged:
+
+.. code-block:: bash
+
+    python -m vi3o index --jobs 8 /mnt/nas/recordings
+    python -m vi3o cache list
+    python -m vi3o cache purge --max-size 100M
+
+"""
+
+import collections
+import multiprocessing
+import os
+import time
+
+import vi3o
+from vi3o import utils
+
+INDEXED_EXTENSIONS = ('.mkv', '.mjpg')
+
+# Seconds between checks of the cache size when new index files are created
+EVICT_INTERVAL = 60
+
+CacheEntry = collections.namedtuple("CacheEntry", ["path", "size", "atime"])
+
+
+def parse_size(size):
+    """
+    Parses a size in bytes with an optional K, M, G or T suffix, e.g. ``"500M"``.
+    Returns None for ``"none"``.
+    """
+    size = str(size).strip().upper()
+    if size == 'NONE':
+        return None
+    units = 'KMGT'
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * 1024 ** (units.index(size[-1]) + 1))
+    return int(size)
+
+max_size = parse_size(os.environ.get('VI3O_CACHE_SIZE', '1G'))
+_last_evict = 0
+
+
+def cache_entries():
+    """
+    Returns a list of :class:`CacheEntry` tuples for the index files in the local cache,
+    least recently used first.
+    """
+    entries = []
+    try:
+        names = os.listdir(utils.cache_dir)
+    except OSError:
+        return entries
+    for name in names:
+        if not name.endswith('.idx'):
+            continue
+        path = os.path.join(utils.cache_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append(CacheEntry(path, st.st_size, st.st_atime))
+    entries.sort(key=lambda e: e.atime)
+    return entries
+
+
+def cache_size():
+    """
+    Returns the total size in bytes of the index files in the local cache.
+    """
+    return sum(e.size for e in cache_entries())
+
+
+def touch(path):
+    """
+    Marks the index file *path* as used now. The access time is set explicitly since
+    file systems are often mounted to not update it.
+    """
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    utils.remove_index_lock(path)
+
+
+def _remove_stale_locks():
+    # Lock files left when the index file was removed while it was locked, or
+    # when building it failed
+    try:
+        names = os.listdir(utils.cache_dir)
+    except OSError:
+        return
+    for name in names:
+        if name.endswith('.lock'):
+            path = os.path.join(utils.cache_dir, name[:-len('.lock')])
+            if not os.path.exists(path):
+                utils.remove_index_lock(path)
+
+
+def evict(size=None):
+    """
+    Removes the least recently used index files from the local cache until it is no
+    larger than *size* bytes (default :data:`max_size`), together with their lock files
+    unless they are in use. Returns the paths of the removed index files.
+    """
+    if size is None:
+        size = max_size
+        if size is None:
+            return []
+    entries = cache_entries()
+    total = sum(e.size for e in entries)
+    removed = []
+    for entry in entries:
+        if total <= size:
+            break
+        _remove(entry.path)
+        total -= entry.size
+        removed.append(entry.path)
+    _remove_stale_locks()
+    return removed
+
+
+def purge():
+    """
+    Removes all index files from the local cache. Returns their paths.
+    """
+    return evict(0)
+
+
+def evict_soon():
+    # Called when a new index file is about to be created. Evicts at most once every
+    # EVICT_INTERVAL seconds to not list the cache directory for every new file.
+    global _last_evict
+    if time.time() - _last_evict > EVICT_INTERVAL:
+        _last_evict = time.time()
+        evict()
+
+
+def find_videos(paths):
+    """
+    Returns a sorted list of the files in *paths* that can be indexed. Directories are
+    searched recursively.
+    """
+    videos = []
+    for path in paths:
+        path = str(path)
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                videos.extend(os.path.join(root, fn) for fn in files
+                              if fn.lower().endswith(INDEXED_EXTENSIONS))
+        else:
+            videos.append(path)
+    return sorted(set(videos))
+
+
+def _index_one(path):
+    # Opening the video and asking for its length forces the index to be built
+    try:
+        return path, len(vi3o.Video(path)), None
+    except Exception as e:
+        return path, None, "%s: %s" % (type(e).__name__, e)
+
+
+def index_many(paths, workers=None, progress=None):
+    """
+    Builds the cached index of all videos in *paths*, which can be video files or
+    directories that are searched recursively for .mkv and .mjpg files. The files are
+    indexed in parallel by *workers* processes (default one per cpu core). Videos opened
+    with :func:`vi3o.Video` afterwards will use the cached index. If *progress* is
+    given it is called as ``progress(done, total, path, error)`` after each file.
+    Returns a dict mapping the paths of the files that could not be indexed to
+    an error message.
+    """
+    videos = find_videos(paths)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(videos)))
+
+    if workers == 1:
+        results = (_index_one(path) for path in videos)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(_index_one, videos)
+
+    errors = {}
+    try:
+        for done, (path, length, error) in enumerate(results, 1):
+            if error is not None:
+                errors[path] = error
+            if progress is not None:
+                progress(done, len(videos), path, error)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return errors
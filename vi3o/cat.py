@@ -1,6 +1,8 @@
 import collections
 from glob import glob
 
+import numpy as np
+
 import vi3o
 from vi3o import mjpg
 from vi3o import utils
@@ -125,6 +127,64 @@ class VideoCat(object):
 
         raise TypeError
 
+    def read_batch(self, start, count, out=None):
+        """
+        Decodes *count* consecutive frames starting with frame number *start* into a
+        single array, see :meth:`vi3o.mkv.Mkv.read_batch`. The frames can span several
+        of the videos, which then need to have the same frame size.
+        """
+        if start < 0:
+            start += self._length
+        if not 0 <= start <= self._length:
+            raise IndexError(start)
+        count = min(count, self._length - start)
+
+        parts = []
+        batch = out
+        item, filled = start, 0
+        for blk in self._videos:
+            length = len(blk.video)
+            if filled == count:
+                break
+            if item >= length:
+                item -= length
+                continue
+            n = min(count - filled, length - item)
+            if batch is None and parts:
+                # The frame size is known from the first part, which is moved
+                # into a single array together with the rest
+                batch = utils.Frame((count,) + parts[0].shape[1:], 'B')
+                batch[:filled] = parts[0]
+            part = blk.video.read_batch(item, n, None if batch is None else batch[filled:filled + n])
+
+            # Update the systimes of the frames
+            if blk.systime_offset is not None:
+                part.systime = part.timestamp + blk.systime_offset
+            if blk.timestamp_offset is not None:
+                part.timestamp = part.timestamp + blk.timestamp_offset
+
+            parts.append(part)
+            filled += n
+            item = 0
+
+        if batch is None:
+            batch = parts[0] if parts else self._videos[0].video.read_batch(0, 0)
+        batch = batch[:filled].view(utils.Frame)
+        if parts and hasattr(parts[0], 'y'):
+            height, width = parts[0].y.shape[1:]
+            utils.set_planes(batch, 'yuv420p', width, height)
+        utils.join_batches(batch, parts)
+        batch.index = np.arange(start, start + filled)
+        return batch
+
+    def iter_batches(self, size):
+        """
+        Iterates over the video in batches of *size* frames, see :meth:`read_batch`.
+        The last batch holds the remaining frames.
+        """
+        for start in range(0, self._length, size):
+            yield self.read_batch(start, size)
+
     @property
     def systimes(self):
         return self._systimes
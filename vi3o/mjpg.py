@@ -5,48 +5,177 @@
 
 import json
 import os, sys
-from vi3o.utils import SlicedView, index_file, Frame
+import numpy as np
+from threading import Condition, Thread
+from vi3o.utils import SlicedView, index_file, index_lock, check_pixel_format, new_frame, \
+    new_batch, set_planes, output_size, PrefetchIter
 try:
     from vi3o._mjpg import ffi, lib
 except ImportError as e:
     import warnings
     warnings.warn("Failed to import. Try to recompile/reinstall vi3o. " + str(e))
 
+def _save_offsets(idx, offsets):
+    # Written under a temporary name and moved into place, as the index is
+    # loaded without holding the index_lock
+    tmp = idx + '.tmp.%d' % os.getpid()
+    with open(tmp, 'w') as fd:
+        json.dump(offsets, fd)
+    os.replace(tmp, idx)
+
 class Mjpg(object):
     """
     If a filename that ends with .mjpg is passed to :func:`vi3o.Video` this kind of object
-    is returned. It has a few additional format specific properties:
+    is returned. If *background* is True and there is no cached index, the file is
+    indexed in a background thread. With *pixel_format* set to ``'yuv420p'`` the frames
+    are returned as the planar YCbCr data of the jpeg images. Frames can be decoded
+    into preallocated buffers using *pool* and :meth:`Mjpg.read`. These options work
+    like for mkv files, see :ref:`mkv-files`.
+
+    If *scale* is set to 1/2, 1/4 or 1/8, the images are decoded at that scale,
+    which is a lot faster than decoding them at full resolution since most of the
+    inverse DCT work is skipped. If *crop* is set to a region (x, y, width, height)
+    of the full resolution images, only that part of them is returned. For rgb and
+    grey images, the rows and columns of blocks outside the region are not decoded
+    at all when vi3o is built against libjpeg-turbo. For yuv420p, x and y are rounded
+    down to even numbers. Frames are decoded in a background thread ahead of time if
+    *prefetch* is set, see :ref:`mkv-files`. It has a few additional format
+    specific properties:
     """
-    def __init__(self, filename, grey=False):
+    def __init__(self, filename, grey=False, background=False, pixel_format=None,
+                 pool=None, scale=1, crop=None, prefetch=0):
         # Be compatible with pathlib.Path filenames
         filename = str(filename).encode('utf-8')
         self.filename = filename
         self.grey = grey
+        self.pixel_format = check_pixel_format(pixel_format, grey)
+        self.pool = pool
+        self.scale = scale
+        scale_denom(scale)
+        self.crop = crop
+        self.prefetch = prefetch
         open(filename).close()
         self._myiter = None
         self._index = None
+        self._index_thread = None
+        self._index_error = None
+        if background and not os.path.exists(index_file(self.filename, self.grey)):
+            self._indexed = []
+            self._index_size = os.stat(filename).st_size
+            self._index_position = 0
+            self._index_cond = Condition()
+            self._index_thread = Thread(target=self._background_index)
+            self._index_thread.daemon = True
+            self._index_thread.start()
 
     def __iter__(self):
-        return MjpgIter(self.filename, self.grey)
+        if self.prefetch:
+            return PrefetchIter(self._iter(), self.prefetch)
+        return self._iter()
+
+    def _iter(self):
+        # The index is recorded while iterating if it is not built yet
+        on_index = None
+        if self._index is None and self._index_thread is None and \
+                not os.path.exists(index_file(self.filename, self.grey)):
+            on_index = self._captured_index
+        return MjpgIter(self.filename, self.grey, on_index, self.pixel_format, self.pool,
+                        self.scale, self.crop)
 
     @property
     def myiter(self):
         if self._myiter is None:
-            self._myiter = iter(self)
+            self._myiter = MjpgIter(self.filename, self.grey, pixel_format=self.pixel_format,
+                                    pool=self.pool, scale=self.scale, crop=self.crop)
         return self._myiter
 
+    def _captured_index(self, offsets):
+        # Called by MjpgIter when an iteration from the start of the file has
+        # reached its end. The offsets are used even if they can not be saved.
+        if self._index is None:
+            self._index = offsets
+        try:
+            idx = index_file(self.filename, self.grey)
+            if not os.path.exists(idx):
+                with index_lock(idx):
+                    if not os.path.exists(idx):
+                        _save_offsets(idx, offsets)
+        except (IOError, OSError):
+            # E.g. an unwritable cache directory, the index is built again next time
+            pass
+
     @property
     def offset(self):
+        if self._index_thread is not None:
+            self._wait_index()
         if self._index is None:
             idx = index_file(self.filename, self.grey)
-            if os.path.exists(idx):
+            if not os.path.exists(idx):
+                with index_lock(idx):
+                    if not os.path.exists(idx):
+                        it = MjpgIter(self.filename, self.grey)
+                        self._index = list(iter(it.skip, None))
+                        _save_offsets(idx, self._index)
+            if self._index is None:
                 self._index = json.load(open(idx))
-            else:
-                self._index = [self.myiter.m.start_position_in_file for img in self.myiter]
-                with open(idx, 'w') as fd:
-                    json.dump(self._index, fd)
         return self._index
 
+    def _background_index(self):
+        try:
+            idx = index_file(self.filename, self.grey)
+            with index_lock(idx):
+                if os.path.exists(idx):
+                    self._index = json.load(open(idx))
+                    return
+                it = MjpgIter(self.filename, self.grey)
+                for offset in iter(it.skip, None):
+                    with self._index_cond:
+                        self._indexed.append(offset)
+                        self._index_position = offset
+                        self._index_cond.notify_all()
+                _save_offsets(idx, self._indexed)
+                self._index = self._indexed
+        except Exception as e:
+            self._index_error = e
+        finally:
+            with self._index_cond:
+                self._index_thread = None
+                self._index_cond.notify_all()
+
+    def _wait_index(self, count=None):
+        # Returns the offsets indexed so far once the background indexing has
+        # indexed more than *count* frames, or all offsets
+        if self._index_thread is not None:
+            with self._index_cond:
+                while self._index_thread is not None:
+                    if count is not None and count < len(self._indexed):
+                        return self._indexed
+                    self._index_cond.wait()
+        if self._index_error is not None:
+            raise self._index_error
+        return self.offset
+
+    @property
+    def index_progress(self):
+        """
+        The fraction of the file that has been indexed, 1.0 when the index is complete.
+        """
+        if self._index_thread is None:
+            return 1.0
+        return min(float(self._index_position) / max(self._index_size, 1), 1.0)
+
+    @property
+    def estimated_length(self):
+        """
+        The number of frames in the video, estimated from the part that has been
+        indexed if the indexing is not finished.
+        """
+        if self._index_thread is None:
+            return len(self)
+        count = len(self._indexed)
+        progress = self.index_progress
+        return int(round(count / progress)) if progress > 0 else count
+
     @property
     def systimes(self):
         raise NotImplementedError
@@ -57,11 +186,48 @@ class Mjpg(object):
     def __getitem__(self, item):
         if isinstance(item, slice):
             return SlicedView(self, item, {'systimes': self._sliced_systimes})
+        return self.read(item)
+
+    def read(self, item, out=None):
+        """
+        Returns frame number *item* like ``video[item]``, but decoded into the array
+        *out* if given, see :class:`vi3o.mkv.Mkv`.
+        """
         if (item < 0):
             item += len(self)
-        lib.mjpg_seek(self.myiter.m, self.offset[item])
+        lib.mjpg_seek(self.myiter.m, self._wait_index(item)[item])
         self.myiter.fcnt = item
-        return self.myiter.next()
+        return self.myiter.next(out)
+
+    def read_batch(self, start, count, out=None):
+        """
+        Decodes *count* consecutive frames starting with frame number *start* into a
+        single array, see :meth:`vi3o.mkv.Mkv.read_batch`.
+        """
+        if start < 0:
+            start += len(self)
+        if not 0 <= start <= len(self):
+            raise IndexError(start)
+        count = min(count, len(self) - start)
+        if out is not None:
+            out = out[:count]
+        if count > 0:
+            lib.mjpg_seek(self.myiter.m, self._wait_index(start)[start])
+        self.myiter.fcnt = start
+        return self.myiter.next_batch(count, out)
+
+    def iter_batches(self, size):
+        """
+        Iterates over the video in batches of *size* frames, see
+        :meth:`vi3o.mkv.Mkv.read_batch`. The last batch holds the remaining frames.
+        """
+        it = self._iter()
+        while True:
+            batch = it.next_batch(size)
+            if len(batch):
+                yield batch
+            if len(batch) < size:
+                return
 
     def __len__(self):
         return len(self.offset)
@@ -92,30 +258,99 @@ class Mjpg(object):
 
 
 class MjpgIter(object):
-    def __init__(self, filename, grey=False):
+    def __init__(self, filename, grey=False, on_index=None, pixel_format=None, pool=None,
+                 scale=1, crop=None):
         self.m = ffi.new("struct mjpg *")
         self.fcnt = 0
-        if grey:
+        # The offsets of the frames read are passed to on_index when the end of
+        # the file is reached
+        self.on_index = on_index
+        self.captured = []
+        self.pixel_format = check_pixel_format(pixel_format, grey)
+        self.pool = pool
+        self.scale = scale
+        self.crop = crop
+        # The size of the frames returned, known once the first header is read
+        self.width = self.height = None
+        if self.pixel_format == 'grey':
             r = lib.mjpg_open(self.m, filename, lib.IMTYPE_GRAY, lib.IMORDER_INTERLEAVED)
             self.channels = 1
+        elif self.pixel_format == 'yuv420p':
+            r = lib.mjpg_open(self.m, filename, lib.IMTYPE_YCbCr, lib.IMORDER_PLANAR)
+            self.channels = 3
         else:
             r = lib.mjpg_open(self.m, filename, lib.IMTYPE_RGB, lib.IMORDER_INTERLEAVED)
             self.channels = 3
         if r != lib.OK:
             raise IOError("Failed to open: " + filename)
+        self.m.scale_denom = scale_denom(scale)
 
     def __iter__(self):
         return self
 
-    def next(self):
+    def next_head(self):
+        # Read the header of the next frame, returns False at the end of the file
         r = lib.mjpg_next_head(self.m)
         if r != lib.OK:
+            if self.on_index is not None:
+                on_index, captured = self.on_index, self.captured
+                self.on_index = self.captured = None
+                on_index(captured)
+            return False
+        if self.on_index is not None:
+            self.captured.append(self.m.start_position_in_file)
+        if self.width is None:
+            self.width, self.height = self.m.width, self.m.height
+            if self.crop is not None:
+                roi = scaled_crop(self.crop, self.scale)
+                roi, (self.width, self.height) = output_size(self.m.width, self.m.height,
+                                                             None, roi)
+                self.m.roi_x, self.m.roi_y, self.m.roi_width, self.m.roi_height = roi
+        return True
+
+    def skip(self):
+        # Reads the header of the next frame only, returns its offset in the file or
+        # None at the end of the file
+        if not self.next_head() or lib.mjpg_skip_data(self.m) != lib.OK:
+            return None
+        self.fcnt += 1
+        return self.m.start_position_in_file
+
+    def next_batch(self, count, out=None):
+        """
+        Decodes the following *count* frames into a single array, or into *out* if
+        given, see :func:`vi3o.utils.new_batch`. Returns the part of it that was filled
+        before the video ended, with the index, timestamp and systime of the frames as
+        arrays.
+        """
+        batch = None
+        timestamps = np.zeros(count)
+        index = np.arange(self.fcnt, self.fcnt + count)
+        n = 0
+        while n < count and self.next_head():
+            if batch is None:
+                batch = new_batch(self.pixel_format, self.width, self.height, count, out)
+                pixels = ffi.cast('unsigned char *', batch.__array_interface__['data'][0])
+                size = batch[0].nbytes
+            self.m.pixels = pixels + n * size
+            if lib.mjpg_next_data(self.m) != lib.OK:
+                break
+            timestamps[n] = self.m.timestamp_sec + self.m.timestamp_usec / 1000000.0
+            self.fcnt += 1
+            n += 1
+        if batch is None:
+            # Nothing was decoded and the size of the frames might not be known
+            batch = new_batch(self.pixel_format, self.width or 0, self.height or 0,
+                              0, None if out is None else out[:0])
+        batch = set_planes(batch[:n], self.pixel_format, self.width, self.height)
+        batch.index = index[:n]
+        batch.timestamp = batch.systime = timestamps[:n]
+        return batch
+
+    def next(self, out=None):
+        if not self.next_head():
             raise StopIteration
-        if self.channels == 1:
-            shape = (self.m.height, self.m.width)
-        else:
-            shape = (self.m.height, self.m.width, self.channels)
-        img = Frame(shape, 'B')
+        img = new_frame(self.pixel_format, self.width, self.height, out, self.pool)
         assert img.__array_interface__['strides'] is None
         self.m.pixels = ffi.cast('unsigned char *', img.__array_interface__['data'][0])
 
@@ -136,6 +371,64 @@ class MjpgIter(object):
     def __del__(self):
         lib.mjpg_close(self.m)
 
+# The scales jpeg images can be decoded at
+SCALES = (1, 1 / 2.0, 1 / 4.0, 1 / 8.0)
+
+def scale_denom(scale):
+    """
+    Returns the denominator of *scale*, which has to be one of :data:`SCALES`.
+    """
+    for denom in (1, 2, 4, 8):
+        if abs(scale * denom - 1) < 1e-6:
+            return denom
+    raise ValueError("Unsupported scale %r, expected 1, 1/2, 1/4 or 1/8" % (scale,))
+
+def scaled_size(width, height, scale):
+    """
+    Returns the size (width, height) of a *width* x *height* jpeg image decoded at
+    *scale*.
+    """
+    denom = scale_denom(scale)
+    return (width + denom - 1) // denom, (height + denom - 1) // denom
+
+def scaled_crop(crop, scale):
+    """
+    Returns the region (x, y, w, h) of an image decoded at *scale* that covers the
+    region *crop* of the full resolution image. Like in :func:`scaled_size`, partly
+    covered pixels at the right and bottom edges are included.
+    """
+    denom = scale_denom(scale)
+    x, y, w, h = [int(v) for v in crop]
+    x0, y0 = x // denom, y // denom
+    x1, y1 = (x + w + denom - 1) // denom, (y + h + denom - 1) // denom
+    return x0, y0, x1 - x0, y1 - y0
+
+def decode_jpeg(data, grey=False, scale=1):
+    """
+    Decodes the jpeg image in the bytes *data* at *scale*, one of :data:`SCALES`, into
+    an RGB :class:`vi3o.utils.Frame`, or a greyscale if *grey* is True.
+    """
+    m = ffi.new("struct mjpg *")
+    buf = ffi.from_buffer(data)
+    if grey:
+        r = lib.mjpg_open_buffer(m, ffi.cast('uint8_t *', buf), len(data), lib.IMTYPE_GRAY, lib.IMORDER_INTERLEAVED)
+    else:
+        r = lib.mjpg_open_buffer(m, ffi.cast('uint8_t *', buf), len(data), lib.IMTYPE_RGB, lib.IMORDER_INTERLEAVED)
+    if r != lib.OK:
+        raise IOError("Failed to decode jpeg image")
+    m.scale_denom = scale_denom(scale)
+    try:
+        if lib.mjpg_next_head(m) != lib.OK:
+            raise IOError("Failed to decode jpeg image")
+        img = new_frame('grey' if grey else 'rgb', m.width, m.height)
+        m.pixels = ffi.cast('unsigned char *', img.__array_interface__['data'][0])
+        if lib.mjpg_next_data(m) != lib.OK:
+            raise IOError("Failed to decode jpeg image")
+    finally:
+        lib.mjpg_close(m)
+    img.timestamp = img.systime = m.timestamp_sec + m.timestamp_usec / 1000000.0
+    return img
+
 def jpg_info(filename):
     """
     Reads a single jpeg image from the file *filename* and extracts the Axis user data header.
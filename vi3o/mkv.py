@@ -1,6 +1,14 @@
+import hashlib
 import json
+import multiprocessing
 import os
-from vi3o.utils import SlicedView, index_file, Frame
+import time
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from vi3o.utils import SlicedView, index_file, index_lock, save_index, load_index, \
+    check_pixel_format, new_frame, new_batch, set_planes, join_batches, output_size, \
+    PrefetchIter
+from vi3o.mjpg import scale_denom, scaled_size, scaled_crop
 try:
     from vi3o._mkv import ffi, lib
     from vi3o._mjpg import lib as mjpg_lib
@@ -10,68 +18,568 @@ except ImportError as e:
     warnings.warn("Failed to import. Try to recompile/reinstall vi3o. " + str(e))
 
 
-from threading import Lock
+from threading import Condition, Lock, Thread
 decode_open_lock = Lock()
 
-INDEX_VERSION = 4
+INDEX_VERSION = 6
+INDEX_CHUNK = 4096
+
+# Number of bytes at the start of the file used to recognize it when it has grown
+HEAD_SIZE = 65536
+
+# Files larger than this are indexed using one thread per cpu core by default
+PARALLEL_INDEX_SIZE = 256 << 20
+
+# Number of byte ranges per thread when indexing in parallel
+PARALLEL_INDEX_RANGES = 4
+
+# Number of systime samples used for the preliminary systime offset while an
+# index is captured during iteration
+LAZY_SYSTIME_SAMPLES = 100
+
+# Seconds between checks for appended data when following a file
+FOLLOW_POLL_INTERVAL = 0.05
+
+# One row per frame in Mkv.frame, sorted on pts
+FRAME_DTYPE = np.dtype([('pts', '<u8'), ('offset', '<u8'), ('key_frame', 'u1')])
+FRAME_ORDER = ['pts', 'offset', 'key_frame']
+
+# One row per keyframe cluster in Mkv.cues
+CUE_DTYPE = np.dtype([('pts', '<u8'), ('offset', '<u8')])
+
+def _entry_dtype():
+    # Layout of the struct mkv_index_entry array filled in by lib.mkv_index
+    entry = ffi.typeof('struct mkv_index_entry')
+    names, formats, offsets = [], [], []
+    for name, field in entry.fields:
+        names.append(name)
+        formats.append('%s%d' % ('i' if field.type.cname == 'int' else 'u', ffi.sizeof(field.type)))
+        offsets.append(field.offset)
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                     'itemsize': ffi.sizeof(entry)})
+
+def _read_index(m, chunk_done=None):
+    # Parse the frames from the cursor of m up to its limit into an array.
+    # Each chunk of frames is passed to chunk_done, in file order, as it is read.
+    entries = ffi.new('struct mkv_index_entry[]', INDEX_CHUNK)
+    entry_dtype = _entry_dtype()
+    chunks = []
+    while True:
+        n = lib.mkv_index(m, entries, INDEX_CHUNK)
+        if n == 0:
+            break
+        chunk = np.frombuffer(ffi.buffer(entries, n * entry_dtype.itemsize), entry_dtype)
+        chunks.append(chunk.astype(FRAME_DTYPE))
+        if chunk_done is not None:
+            chunk_done(m, chunks[-1])
+    frame = np.concatenate(chunks) if chunks else np.zeros(0, FRAME_DTYPE)
+    return np.sort(frame, order=FRAME_ORDER)
 
 class Mkv(object):
-    def __init__(self, filename, grey=False, reindex=False):
+    """
+    If a filename that ends with .mkv is passed to :func:`vi3o.Video` this kind of object
+    is returned. The frames are indexed when the file is first opened and the index is
+    cached. The options are described in more detail in :ref:`mkv-files`:
+
+    - *grey*, *pixel_format*: Return greyscale or ``'yuv420p'`` frames instead of RGB.
+    - *reindex*: Build a new index even if there is a cached one.
+    - *systime_samples*: Estimate the systime offset from this many Axis blocks only.
+    - *fast_open*: Open the file using its Cues and index it one GOP at the time.
+    - *follow*: Wait for frames appended to the file while iterating, forever or
+      for this many seconds.
+    - *background*: Index the file in a background thread.
+    - *lazy*: Record the index while iterating over the file the first time.
+    - *index_workers*: Number of threads used to index large files.
+    - *threads*, *thread_type*: Number of H.264 decoding threads, 0 for one per cpu
+      core, and the kind of threading, "frame" or "slice".
+    - *pool*: A :class:`vi3o.utils.FramePool` to decode the frames into.
+    - *crop*, *size*, *interpolation*, *scale*: Decode the region (x, y, width, height)
+      only and scale the frames to (width, height) or by 1/2, 1/4 or 1/8.
+    - *frame_cache*: A :class:`vi3o.utils.FrameCache` keeping the frames decoded by
+      random access. The cached frames are not taken from *pool*.
+    - *prefetch*: Decode this many frames ahead in a background thread.
+    - *keyframes_only*: Iterate over the keyframes only, see :meth:`Mkv.keyframes`.
+    """
+    def __init__(self, filename, grey=False, reindex=False, systime_samples=None,
+                 fast_open=False, follow=False, background=False, lazy=False,
+                 index_workers=None, threads=1, thread_type=None, pixel_format=None,
+                 pool=None, size=None, crop=None, interpolation='bicubic', scale=1,
+                 frame_cache=None, prefetch=0, keyframes_only=False):
         # Be compatible with pathlib.Path filenames
         filename = str(filename).encode('utf-8')
         self.filename = filename
         self.grey = grey
+        self.pixel_format = check_pixel_format(pixel_format, grey)
+        self.pool = pool
+        self.follow = follow
+        if thread_type not in THREAD_TYPES:
+            raise ValueError("Unknown thread_type: %r" % (thread_type,))
+        self.threads = threads
+        self.thread_type = thread_type
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError("Unknown interpolation: %r" % (interpolation,))
+        self.size = size
+        self.crop = crop
+        self.interpolation = interpolation
+        scale_denom(scale)
+        if scale != 1 and size is not None:
+            raise ValueError("scale and size can not both be set")
+        self.scale = scale
+        self.frame_cache = frame_cache
+        self.prefetch = prefetch
+        self.keyframes_only = keyframes_only
         open(filename).close()
         self._myiter = None
+        self._frame = None
+        self._gops = None
+        self.cues = None
         self.systime_offset = 0
+        self._systime_samples = systime_samples
+        self._index_thread = None
+        self._index_error = None
+        self._index_workers = index_workers
+
+        self._index_path = index_file(self.filename, systime_samples, appendable=True)
+        if background:
+            if reindex or not self._load_index():
+                self._start_background_index(reindex)
+            return
+        if not reindex and self._load_index():
+            return
+        # Only one process at the time builds the index, others wait and load it
+        with index_lock(self._index_path):
+            if reindex or not self._load_index():
+                if lazy:
+                    self._open_lazy()
+                elif not (fast_open and self._open_cues()):
+                    self._build_index()
+
+    def _file_state(self, size=None):
+        # Size, modification time and a hash of the first part of the file
+        # used to detect if a file has been appended to or replaced
+        st = os.stat(self.filename)
+        if size is None:
+            size = st.st_size
+        with open(self.filename, 'rb') as fd:
+            head = hashlib.md5(fd.read(min(size, HEAD_SIZE))).hexdigest()
+        return {'size': st.st_size, 'mtime': st.st_mtime, 'head': head}
+
+    def _save_index(self):
+        self._index_meta.update(systime_offset=self.systime_offset,
+                                mjpg_mode=self.mjpg_mode,
+                                version=INDEX_VERSION)
+        save_index(self._index_path, self._frame, replace=True, **self._index_meta)
 
-        need_index = True
-        idx = index_file(self.filename)
-        if os.path.exists(idx):
+    def _read_index_file(self, idx):
+        try:
             try:
+                return load_index(idx)
+            except ValueError:
+                # Index from older versions in json format
                 index = json.load(open(idx))
-            except Exception:
-                pass
-            else:
-                if index['version'] == INDEX_VERSION:
-                    self.frame = index['frame']
-                    self.systime_offset = index['systime_offset']
-                    self.mjpg_mode = index['mjpg_mode']
-                    need_index = False
-
-        if need_index or reindex:
-            self.frame = []
-            m = lib.mkv_open(self.filename)
-            frm = ffi.new('struct mkv_frame *')
-            cluster_offsets = set()
-            while lib.mkv_next(m, frm):
-                if frm.key_frame:
-                    if frm.offset in cluster_offsets:
-                        print("FIXME: Multiple keyframes per cluster!")
-                    cluster_offsets.add(frm.key_frame)
-                self.frame.append([frm.pts, frm.offset, frm.key_frame])
-            self.frame.sort()
-            self.systime_offset = iter(self).estimate_systime_offset() # FIXME: This makes a second pass over the file parsing it
+                frame = np.array([tuple(f) for f in index.pop('frame')], FRAME_DTYPE)
+                return index, frame
+        except Exception:
+            return None, None
+
+    def _load_index(self):
+        index, frame = None, None
+        if os.path.exists(self._index_path):
+            index, frame = self._read_index_file(self._index_path)
+        migrate = index is None
+        if migrate:
+            # Convert indexes from older versions, which are specific to the
+            # current size and modification time of the file
+            idx = index_file(self.filename, self._systime_samples)
+            if not os.path.exists(idx):
+                return False
+            index, frame = self._read_index_file(idx)
+            if index is None or index['version'] not in (4, 5):
+                return False
+            index.update(self._file_state(), resume_offset=0)
+        elif index['version'] != INDEX_VERSION:
+            return False
+
+        self._index_meta = index
+        self._frame = frame
+        self.systime_offset = index['systime_offset']
+        self.mjpg_mode = index['mjpg_mode']
+        if migrate:
+            self._save_index()
+        self._refresh()
+        return True
+
+    def refresh(self):
+        """
+        Extends the index with the frames appended to the file since it was indexed.
+        Returns True if any data was appended. If the file has been changed in some
+        other way it is completely reindexed.
+        """
+        # Build the full index first if it is built lazily or in the background
+        self.frame
+        with index_lock(self._index_path):
+            return self._refresh()
+
+    def _refresh(self):
+        index = self._index_meta
+        state = self._file_state(index['size'])
+        if (state['size'], state['mtime']) == (index['size'], index['mtime']):
+            return False
+        if state['size'] < index['size'] or state['head'] != index['head']:
+            self._myiter = None
+            self._build_index()
+            return True
+
+        state = self._file_state()
+        m = lib.mkv_open(self.filename)
+        if self._systime_samples:
+            m.systime_samples = self._systime_samples
+        offset = index['resume_offset']
+        if offset:
+            m.time_scale = index['time_scale']
+            m.systime_offset_sum = index['resume_systime_sum']
+            m.systime_offset_count = index['resume_systime_count']
+            lib.mkv_seek(m, offset)
+        frame = self._frame
+        frame = np.concatenate([frame[frame['offset'] < offset], _read_index(m)])
+        self._frame = np.sort(frame, order=FRAME_ORDER)
+        if not offset:
             self.mjpg_mode = (ffi.string(m.codec_id) == b'V_MS/VFW/FOURCC')
+        self._finish_index(m, state)
+        lib.mkv_close(m)
+        if self._myiter is not None:
+            # The packet read ahead by the iterator is moved to the new mapping
+            lib.mkv_remap(self._myiter.m, self.filename, self._myiter.frm)
+        return True
+
+    def _build_index(self, chunk_done=None):
+        # Parse the frames and estimate the systime offset in a single pass
+        # over the file without decoding anything. If *systime_samples* is
+        # set, the estimate is based on only that many Axis blocks.
+        state = self._file_state()
+        workers = self._index_workers
+        if workers is None:
+            workers = multiprocessing.cpu_count() if state['size'] > PARALLEL_INDEX_SIZE else 1
+        if workers > 1 and chunk_done is None and self._build_index_parallel(state, workers):
+            return
+        m = lib.mkv_open(self.filename)
+        if self._systime_samples:
+            m.systime_samples = self._systime_samples
+        self._frame = _read_index(m, chunk_done)
+        self.mjpg_mode = (ffi.string(m.codec_id) == b'V_MS/VFW/FOURCC')
+        self._finish_index(m, state)
+        lib.mkv_close(m)
+
+    def _index_range(self, start, end, time_scale, systime_samples):
+        m = lib.mkv_open(self.filename)
+        if start:
+            m.time_scale = time_scale
+            lib.mkv_seek(m, start)
+        lib.mkv_limit(m, end)
+        if systime_samples:
+            m.systime_samples = systime_samples
+        return m, _read_index(m)
+
+    def _build_index_parallel(self, state, workers):
+        # Split the file into byte ranges starting at clusters and index them
+        # in parallel. The result is identical to indexing it serially.
+        # Returns False if that is not possible.
+        m = lib.mkv_open(self.filename)
+        lib.mkv_next(m, ffi.new('struct mkv_frame *'))
+        time_scale, first_cluster = m.time_scale, m.cluster_offset
+        size = state['size']
+        count = workers * PARALLEL_INDEX_RANGES
+        bounds = set(lib.mkv_sync(m, size * i // count) for i in range(1, count))
+        lib.mkv_close(m)
+        bounds = [0] + sorted(b for b in bounds if b > first_cluster) + [0]
+        if len(bounds) < 3:
+            return False
+        samples = self._systime_samples or 0
+        ranges = list(zip(bounds[:-1], bounds[1:]))
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(lambda r: self._index_range(r[0], r[1], time_scale, samples),
+                               ranges)
+        finally:
+            pool.close()
+        try:
+            # Something inside a frame that looked like a cluster makes the
+            # parsing of the preceding range not end exactly at it
+            if any(lib.mkv_tell(m) != end for (m, _), (_, end) in zip(results[:-1], ranges)):
+                return False
+
+            # Combine the systime samples as if the ranges were parsed in order,
+            # reparsing the range where the systime_samples limit is reached
+            total_sum = total_count = 0
+            for i, (m, frame) in enumerate(results):
+                if samples and total_count + m.systime_offset_count > samples:
+                    if total_count < samples:
+                        lib.mkv_close(m)
+                        m, frame = self._index_range(ranges[i][0], ranges[i][1], time_scale,
+                                                     samples - total_count)
+                        results[i] = (m, frame)
+                    else:
+                        m.systime_offset_sum = m.systime_offset_count = 0
+                        m.cluster_systime_offset_sum = m.cluster_systime_offset_count = 0
+                m.cluster_systime_offset_sum += total_sum
+                m.cluster_systime_offset_count += total_count
+                total_sum += m.systime_offset_sum
+                total_count += m.systime_offset_count
+            m.systime_offset_sum = total_sum
+            m.systime_offset_count = total_count
+
+            self._frame = np.sort(np.concatenate([f for _, f in results]), order=FRAME_ORDER)
+            self.mjpg_mode = (ffi.string(results[0][0].codec_id) == b'V_MS/VFW/FOURCC')
+            self._finish_index(m, state)
+        finally:
+            for m, _ in results:
+                lib.mkv_close(m)
+        return True
+
+    def _open_lazy(self):
+        # Estimate the systime offset from the first systime samples only
+        samples = self._systime_samples or LAZY_SYSTIME_SAMPLES
+        m = lib.mkv_open(self.filename)
+        m.systime_samples = samples
+        entries = ffi.new('struct mkv_index_entry[]', 64)
+        frames = 0
+        while m.systime_offset_count < samples and frames < 4 * samples:
+            n = lib.mkv_index(m, entries, 64)
+            if n == 0:
+                break
+            frames += n
+        self.mjpg_mode = (ffi.string(m.codec_id) == b'V_MS/VFW/FOURCC')
+        self.systime_offset = lib.mkv_systime_offset(m)
+        lib.mkv_close(m)
+        self._lazy_state = self._file_state()
+
+    def _captured_index(self, it):
+        # Called by MkvIter when an iteration from the start of the file has
+        # reached its end
+        if self._frame is not None or self._gops is not None:
+            return
+        self._frame = np.sort(np.array(it.captured, FRAME_DTYPE), order=FRAME_ORDER)
+        try:
+            with index_lock(self._index_path):
+                self._finish_index(it.m, self._lazy_state)
+        except (IOError, OSError):
+            # E.g. an unwritable cache directory, the index is built again next time
+            pass
+
+    def _start_background_index(self, reindex):
+        # Parse the headers up to the first frame to find the codec
+        m = lib.mkv_open(self.filename)
+        lib.mkv_next(m, ffi.new('struct mkv_frame *'))
+        self.mjpg_mode = (ffi.string(m.codec_id) == b'V_MS/VFW/FOURCC')
+        lib.mkv_close(m)
+        # Frames in _indexed are final while those in _pending might be
+        # preceded by frames later in the file
+        self._indexed = np.zeros(0, FRAME_DTYPE)
+        self._pending = np.zeros(0, FRAME_DTYPE)
+        self._index_size = os.stat(self.filename).st_size
+        self._index_position = 0
+        self._index_error = None
+        self._index_cond = Condition()
+        self._index_thread = Thread(target=self._background_index, args=(reindex,))
+        self._index_thread.daemon = True
+        self._index_thread.start()
+
+    def _background_index(self, reindex):
+        try:
+            with index_lock(self._index_path):
+                # Another process might have built the index while we waited
+                if reindex or not self._load_index():
+                    self._build_index(self._background_chunk_done)
+        except Exception as e:
+            self._index_error = e
+        finally:
+            with self._index_cond:
+                self._index_thread = None
+                self._index_cond.notify_all()
+
+    def _background_chunk_done(self, m, chunk):
+        # Frames before the last keyframe in the file (with lower pts) are final
+        keys = np.flatnonzero(chunk['key_frame'])
+        pending = np.sort(np.concatenate([self._pending, chunk]), order=FRAME_ORDER)
+        if len(keys):
+            final = pending['pts'] < chunk['pts'][keys[-1]]
+            indexed = np.concatenate([self._indexed, pending[final]])
+            pending = pending[~final]
+        else:
+            indexed = self._indexed
+        systime_offset = lib.mkv_systime_offset(m)
+        with self._index_cond:
+            self._indexed, self._pending = indexed, pending
+            self._index_position = m.cluster_offset
+            self.systime_offset = systime_offset
+            if self._myiter is not None:
+                self._myiter.systime_offset = systime_offset
+            self._index_cond.notify_all()
+
+    def _wait_index(self, count=None, pts=None):
+        # Returns the frames indexed so far once the background indexing has
+        # indexed more than *count* frames or passed *pts*, or the full index
+        if self._index_thread is not None:
+            with self._index_cond:
+                while self._index_thread is not None:
+                    indexed = self._indexed
+                    if count is not None and count < len(indexed):
+                        return indexed
+                    if pts is not None and len(indexed) and indexed['pts'][-1] > pts:
+                        return indexed
+                    self._index_cond.wait()
+        if self._index_error is not None:
+            raise self._index_error
+        return self.frame
+
+    @property
+    def index_progress(self):
+        """
+        The fraction of the file that has been indexed, 1.0 when the index is complete.
+        """
+        if self._index_thread is None:
+            return 1.0
+        return min(float(self._index_position) / max(self._index_size, 1), 1.0)
+
+    @property
+    def estimated_length(self):
+        """
+        The number of frames in the video, estimated from the part that has been
+        indexed if the indexing is not finished.
+        """
+        if self._index_thread is None:
+            return len(self)
+        count = len(self._indexed) + len(self._pending)
+        progress = self.index_progress
+        return int(round(count / progress)) if progress > 0 else count
+
+    def _finish_index(self, m, state):
+        # Save the index together with the position of the last cluster
+        # which is where indexing continues if the file is appended to
+        self.systime_offset = lib.mkv_systime_offset(m)
+        self._index_meta = dict(state,
+                                resume_offset=m.cluster_offset,
+                                resume_systime_sum=m.cluster_systime_offset_sum,
+                                resume_systime_count=m.cluster_systime_offset_count,
+                                time_scale=m.time_scale)
+        if self._myiter is not None:
+            self._myiter.systime_offset = self.systime_offset
+        self._save_index()
+
+    def _open_cues(self):
+        # Read the keyframe clusters from the Cues and split the file into
+        # GOPs at those clusters. The first GOP also contains the headers.
+        m = lib.mkv_open(self.filename)
+        try:
+            count = lib.mkv_cues(m, ffi.NULL, 0)
+            if count <= 0:
+                return False
+            cues = ffi.new('struct mkv_cue[]', count)
+            lib.mkv_cues(m, cues, count)
+            self._time_scale = m.time_scale
+        finally:
             lib.mkv_close(m)
+        cues = np.array([(c.pts, c.offset) for c in cues], CUE_DTYPE)
+        _, first = np.unique(cues['offset'], return_index=True)
+        self.cues = cues[first]
+        self._gop_bounds = [0] + self.cues['offset'].tolist() + [0]
+        self._gops = [None] * (len(self.cues) + 1)
+        self._systime_sums = (0, 0)
+        self._index_meta = self._file_state()
+        self._index_gop(0)
+        return True
 
-            tmp = idx + '.tmp.%d' % os.getpid()
-            with open(tmp, 'w') as fd:
-                json.dump({'frame': self.frame,
-                           'systime_offset': self.systime_offset,
-                           'mjpg_mode': self.mjpg_mode,
-                           'version': INDEX_VERSION}, fd)
-            try:
-                os.link(tmp, idx)
-            except FileExistsError:
-                pass
-            os.unlink(tmp)
+    def _index_gop(self, gop):
+        if self._gops[gop] is None:
+            m = lib.mkv_open(self.filename)
+            if gop > 0:
+                m.time_scale = self._time_scale
+                lib.mkv_seek(m, self._gop_bounds[gop])
+            lib.mkv_limit(m, self._gop_bounds[gop + 1])
+            self._gops[gop] = _read_index(m)
+            if gop == 0:
+                self.mjpg_mode = (ffi.string(m.codec_id) == b'V_MS/VFW/FOURCC')
+            if gop == len(self._gops) - 1:
+                # Systime samples after the start of the last cluster
+                self._resume_tail = (m.cluster_offset,
+                                     m.systime_offset_sum - m.cluster_systime_offset_sum,
+                                     m.systime_offset_count - m.cluster_systime_offset_count,
+                                     m.time_scale)
+            # Estimate the systime offset from all GOPs indexed so far
+            m.systime_offset_sum += self._systime_sums[0]
+            m.systime_offset_count += self._systime_sums[1]
+            self._systime_sums = (m.systime_offset_sum, m.systime_offset_count)
+            self.systime_offset = lib.mkv_systime_offset(m)
+            lib.mkv_close(m)
+        return self._gops[gop]
+
+    @property
+    def frame(self):
+        if self._index_thread is not None:
+            self._wait_index()
+        if self._frame is None:
+            with index_lock(self._index_path):
+                if self._gops is not None:
+                    self._index_all_gops()
+                elif not self._load_index():
+                    # Not yet captured by iterating over a lazy opened video
+                    self._build_index()
+        return self._frame
+
+    def _index_all_gops(self):
+        for gop in range(len(self._gops)):
+            self._index_gop(gop)
+        self._frame = np.sort(np.concatenate(self._gops), order=FRAME_ORDER)
+        self._gops = None
+        offset, tail_sum, tail_count, time_scale = self._resume_tail
+        self._index_meta.update(resume_offset=offset,
+                                resume_systime_sum=self._systime_sums[0] - tail_sum,
+                                resume_systime_count=self._systime_sums[1] - tail_count,
+                                time_scale=time_scale)
+        self._save_index()
+        if self._myiter is not None:
+            self._myiter.systime_offset = self.systime_offset
+
+    def at_timestamp(self, timestamp):
+        """
+        Returns the last frame with a timestamp not later than *timestamp* (or the first frame).
+        If the video was opened with *fast_open*, only the GOP containing that frame is indexed
+        and the index of the returned frame is None unless all previous GOPs have been indexed.
+        """
+        pts = int(round(timestamp * 1000000))
+        if self._index_thread is not None:
+            frame = self._wait_index(pts=pts)
+            item = np.searchsorted(frame['pts'], pts, 'right') - 1
+            return self[max(int(item), 0)]
+        if self._gops is None:
+            item = np.searchsorted(self.frame['pts'], pts, 'right') - 1
+            return self[max(int(item), 0)]
+
+        gop = int(np.searchsorted(self.cues['pts'], pts, 'right'))
+        while not len(self._index_gop(gop)) and gop + 1 < len(self._gops):
+            gop += 1
+        frame = self._gops[gop]
+        item = max(int(np.searchsorted(frame['pts'], pts, 'right')) - 1, 0)
+        keys = np.flatnonzero(frame['key_frame'][:item + 1])
+        if len(keys):
+            offset = int(frame['offset'][keys[-1]])
+        else:
+            offset = self._gop_bounds[gop]
+        self.myiter.seek(offset)
+        img = self._next_with_pts(int(frame['pts'][item]))
+        img.systime = float(img.pts + self.systime_offset) / 1000000.0
+        if all(f is not None for f in self._gops[:gop]):
+            img.index = sum(len(f) for f in self._gops[:gop]) + item
+        else:
+            img.index = None
+        return img
 
     @property
     def systimes(self):
         if self.mjpg_mode:
             raise NotImplementedError
-        return [float(f[0] + self.systime_offset) / 1000000.0 for f in self.frame]
+        pts = self.frame['pts'].astype(np.int64)
+        return ((pts + self.systime_offset) / 1000000.0).tolist()
 
     def _sliced_systimes(self, range):
         return [self.systimes[i] for i in range]
@@ -85,42 +593,228 @@ class Mkv(object):
         return ffi.string(self.myiter.m.mac)
 
     def __iter__(self):
-        return MkvIter(self.filename, self.systime_offset, self.grey)
+        it = self.keyframes() if self.keyframes_only else self._iter()
+        if self.prefetch:
+            return PrefetchIter(it, self.prefetch)
+        return it
+
+    def _iter(self):
+        on_index = None
+        if self._frame is None and self._gops is None and self._index_thread is None \
+                and self.follow is False:
+            # Opened with lazy=True and the index has not been built yet
+            on_index = self._captured_index
+        return MkvIter(self.filename, self.systime_offset, self.grey, self.follow,
+                       self._systime_samples, on_index, self.threads, self.thread_type,
+                       self.pixel_format, self.pool, self.size, self.crop, self.interpolation,
+                       self.scale)
 
     @property
     def myiter(self):
         if self._myiter is None:
-            self._myiter = iter(self)
+            self._myiter = MkvIter(self.filename, self.systime_offset, self.grey, self.follow,
+                                   threads=self.threads, thread_type=self.thread_type,
+                                   pixel_format=self.pixel_format, pool=self.pool,
+                                   size=self.size, crop=self.crop,
+                                   interpolation=self.interpolation, scale=self.scale)
         return self._myiter
 
     def __getitem__(self, item):
         if isinstance(item, slice):
             return SlicedView(self, item, {'systimes': self._sliced_systimes})
+        return self.read(item)
+
+    def read(self, item, out=None):
+        """
+        Returns frame number *item* like ``video[item]``, but decoded into the array
+        *out* if given. It has to be a contiguous uint8 array of the same shape as the
+        frames.
+        """
         if (item < 0):
             item += len(self)
+        if self.frame_cache is not None:
+            img = self.frame_cache.get(item)
+            if img is not None:
+                return self._copy_frame(img, out)
+        return self._decode(item, out)
+
+    def _decode(self, item, out=None):
+        # Decodes frame number item, leaving myiter positioned at the frame after it
+        frame = self._wait_index(count=item)
         keyindex = item
-        while self.frame[keyindex][2] == 0:
+        while frame['key_frame'][keyindex] == 0:
             keyindex -= 1
             assert keyindex >= 0
-        pts = self.frame[item][0]
+        pts = int(frame['pts'][item])
         if keyindex > self.myiter.fcnt or item < self.myiter.fcnt:
-            lib.mkv_seek(self.myiter.m, self.frame[keyindex][1])
-            lib.mkv_next(self.myiter.m, self.myiter.frm)
-        for img in self.myiter:
+            self.myiter.seek(int(frame['offset'][keyindex]))
+            self.myiter.fcnt = keyindex
+        img = self._next_with_pts(pts, out)
+        img.index = item
+        self.myiter.fcnt = item + 1
+        return img
+
+    def read_batch(self, start, count, out=None):
+        """
+        Decodes *count* consecutive frames starting with frame number *start* into a
+        single array of shape (count, height, width, channels), or fewer frames if the
+        video ends before that. If *out* is given, they are decoded into it. The index,
+        pts, timestamp and systime of the frames are available as arrays in the
+        attributes of the same name of the returned array.
+        """
+        if start < 0:
+            start += len(self)
+        if not 0 <= start <= len(self):
+            raise IndexError(start)
+        batch = new_batch(self.pixel_format, self.myiter.width, self.myiter.height,
+                          count, out)
+        count = min(count, len(self) - start)
+        if count == 0:
+            return join_batches(batch[:0], [])
+        # Not read from the frame cache, as the rest of the batch is decoded after it
+        first = self._decode(start, batch[0])
+        rest = self.myiter.next_batch(batch[1:count])
+        batch = set_planes(batch[:1 + len(rest)], self.pixel_format,
+                           self.myiter.width, self.myiter.height)
+        return join_batches(batch, [first, rest])
+
+    def iter_batches(self, size):
+        """
+        Iterates over the video in batches of *size* frames, see :meth:`Mkv.read_batch`.
+        The last batch holds the remaining frames.
+        """
+        it = self._iter()
+        while True:
+            batch = it.next_batch(new_batch(self.pixel_format, it.width, it.height, size))
+            if len(batch):
+                yield batch
+            if len(batch) < size:
+                return
+
+    def iter_indexes(self, indexes):
+        """
+        Iterates over the frames with the increasing, or decreasing, frame numbers
+        *indexes*. The frames in between are not converted to the output format, and
+        those that no other frames refer to are not decoded at all. When the next frame
+        is after the next keyframe, the frames in between are skipped by seeking to that
+        keyframe. This is used when iterating over a slice of the video, e.g.
+        ``video[::10]``.
+
+        Decreasing frame numbers, e.g. ``video[::-1]``, are decoded forward one GOP
+        at a time, and the frames from each GOP are then returned in reverse order.
+        Each frame is decoded once and at most one GOP of frames is kept in memory.
+        """
+        if len(indexes) > 1 and indexes[1] < indexes[0]:
+            return self._iter_reversed(self._iter(), indexes)
+        return self._iter_indexes(self._iter(), indexes)
+
+    def _keyframe_of(self, keyframes, index):
+        # The index of the keyframe frame number index is decoded from
+        return keyframes[max(np.searchsorted(keyframes, index, 'right') - 1, 0)]
+
+    def _iter_reversed(self, it, indexes):
+        keyframes = np.flatnonzero(self._wait_index()['key_frame'])
+        gop = []
+        for index in indexes:
+            if gop and self._keyframe_of(keyframes, index) != self._keyframe_of(keyframes, gop[0]):
+                for img in reversed(list(self._iter_indexes(it, gop[::-1]))):
+                    yield img
+                gop = []
+            gop.append(index)
+        for img in reversed(list(self._iter_indexes(it, gop[::-1]))):
+            yield img
+
+    def _iter_indexes(self, it, indexes):
+        frame = self._wait_index()
+        keyframes = np.flatnonzero(frame['key_frame'])
+        for index in indexes:
+            pts = int(frame['pts'][index])
+            keyindex = self._keyframe_of(keyframes, index)
+            if keyindex > it.fcnt or index < it.fcnt:
+                it.seek(int(frame['offset'][keyindex]))
+            it.skip_to(pts)
+            while True:
+                try:
+                    img = it.next()
+                except StopIteration:
+                    return
+                if img.pts == pts or self.mjpg_mode:
+                    break
+            img.index = int(index)
+            it.fcnt = index + 1
+            yield img
+
+    def iter_fps(self, fps):
+        """
+        Iterates over the video at a frame rate of about *fps* frames per second by
+        only decoding the first frame of every 1/*fps* second interval, see
+        :meth:`Mkv.iter_indexes`.
+        """
+        frame = self._wait_index()
+        if not len(frame):
+            return iter(())
+        slots = np.floor((frame['pts'] - frame['pts'][0]) * (fps / 1000000.0))
+        return self.iter_indexes(np.flatnonzero(np.r_[True, slots[1:] > slots[:-1]]))
+
+    def keyframes(self):
+        """
+        Iterates over the keyframes of the video. Only the keyframes are read and
+        decoded, which makes skimming through long H.264 recordings roughly as many
+        times faster as there are frames in each GOP. The frames have the same index,
+        pts, timestamp and systime as when the entire video is decoded.
+        """
+        frame = self._wait_index()
+        it = self._iter()
+        it.decoder.set_keyframes_only(True)
+        return self._iter_indexes(it, np.flatnonzero(frame['key_frame']))
+
+    def _next_with_pts(self, pts, out=None):
+        while True:
+            try:
+                if self.frame_cache is None:
+                    img = self.myiter.next(out)
+                else:
+                    # Cached frames stay alive, so they are never decoded into
+                    # buffers of the pool
+                    img = self.myiter.next(new_frame(self.pixel_format, self.myiter.width,
+                                                     self.myiter.height))
+            except StopIteration:
+                assert False
+            if self.frame_cache is not None:
+                self._cache_frame(img)
             if img.pts == pts or self.mjpg_mode:
-                img.index = item
-                self.myiter.fcnt = item + 1
+                if self.frame_cache is not None:
+                    return self._copy_frame(img, out)
                 return img
             elif img.pts > pts:
                 pass # We might get newer frames that was already in the pipe before the seek
-        assert False
+
+    def _cache_frame(self, img):
+        # Frames are only cached if their index is known for sure
+        frame = self._wait_index(count=img.index)
+        if img.index < len(frame) and frame['pts'][img.index] == img.pts:
+            self.frame_cache.put(img.index, img)
+
+    def _copy_frame(self, img, out=None):
+        # Returns a copy of the cached frame img, in out if given
+        copy = new_frame(self.pixel_format, self.myiter.width, self.myiter.height, out,
+                         self.pool)
+        copy[...] = img
+        copy.index, copy.pts = img.index, img.pts
+        copy.timestamp, copy.systime = img.timestamp, img.systime
+        return copy
 
     def __len__(self):
         return len(self.frame)
 
     def __getstate__(self):
+        self._wait_index()
         state = dict(self.__dict__)
         del state['_myiter']
+        for attr in ('_index_cond', '_indexed', '_pending'):
+            state.pop(attr, None)
+        if self._frame is not None:
+            state['_frame'] = np.asarray(self._frame)
         return state
 
     def __setstate__(self, state):
@@ -131,32 +825,91 @@ class Mkv(object):
 class DecodeError(Exception):
     pass
 
+THREAD_TYPES = {None: 'DECODE_THREAD_DEFAULT',
+                'frame': 'DECODE_THREAD_FRAME',
+                'slice': 'DECODE_THREAD_SLICE'}
+
+DECODE_FORMATS = {'rgb': 'DECODE_RGB24',
+                  'grey': 'DECODE_GRAY8',
+                  'yuv420p': 'DECODE_YUV420P'}
+
+# The interpolation methods of Mkv
+INTERPOLATIONS = {'bicubic': 'DECODE_BICUBIC',
+                  'bilinear': 'DECODE_BILINEAR',
+                  'fast_bilinear': 'DECODE_FAST_BILINEAR',
+                  'nearest': 'DECODE_NEAREST',
+                  'area': 'DECODE_AREA',
+                  'lanczos': 'DECODE_LANCZOS'}
+
 class H264Decoder(object):
+    def __init__(self, threads=1, thread_type=None, grey=False):
+        self.threads = threads
+        self.thread_type = getattr(lib, THREAD_TYPES[thread_type])
+        self.grey = grey
+
     def open(self, m):
         with decode_open_lock:
-            self.p = lib.decode_open(m)
+            self.p = lib.decode_open(m, self.threads, self.thread_type, self.grey)
 
     def __del__(self):
         with decode_open_lock:
             self.p = lib.decode_close(self.p)
 
-    def decode_frame(self, frm, pixels, pts, grey):
-        return lib.decode_frame(self.p, frm, pixels, pts, grey)
+    def set_output(self, crop, size, interpolation):
+        x, y, w, h = crop
+        if lib.decode_set_output(self.p, x, y, w, h, size[0], size[1],
+                                 getattr(lib, INTERPOLATIONS[interpolation])) < 0:
+            raise ValueError("Bad crop %r or size %r" % (crop, size))
+
+    def decode_frame(self, frm, pixels, pts, pixel_format):
+        return lib.decode_frame(self.p, frm, pixels, pts, getattr(lib, DECODE_FORMATS[pixel_format]))
+
+    def flush(self):
+        lib.decode_flush(self.p)
+
+    def set_keyframes_only(self, keyframes_only):
+        lib.decode_set_keyframes_only(self.p, keyframes_only)
+
+    def skip_to(self, pts):
+        lib.decode_skip_to(self.p, pts)
 
 class MjpgDecoder(object):
+    def __init__(self, scale=1):
+        self.scale_denom = scale_denom(scale)
+        self.roi = None
+
+    def set_roi(self, roi):
+        self.roi = roi
+
     def open(self, m):
         pass
 
-    def decode_frame(self, frm, pixels, pts, grey):
+    def flush(self):
+        pass
+
+    def set_keyframes_only(self, keyframes_only):
+        # Every frame is a keyframe
+        pass
+
+    def skip_to(self, pts):
+        # Frames are never decoded just to decode others
+        pass
+
+    def decode_frame(self, frm, pixels, pts, pixel_format):
         if frm.len == 0:
             return 0
         m = mjpg_ffi.new("struct mjpg *")
-        if grey:
+        if pixel_format == 'grey':
             r = mjpg_lib.mjpg_open_buffer(m, frm.data, frm.len, mjpg_lib.IMTYPE_GRAY, mjpg_lib.IMORDER_INTERLEAVED)
+        elif pixel_format == 'yuv420p':
+            r = mjpg_lib.mjpg_open_buffer(m, frm.data, frm.len, mjpg_lib.IMTYPE_YCbCr, mjpg_lib.IMORDER_PLANAR)
         else:
             r = mjpg_lib.mjpg_open_buffer(m, frm.data, frm.len, mjpg_lib.IMTYPE_RGB, mjpg_lib.IMORDER_INTERLEAVED)
         if r != mjpg_lib.OK:
             raise IOError("Failed to decode frame")
+        m.scale_denom = self.scale_denom
+        if self.roi is not None:
+            m.roi_x, m.roi_y, m.roi_width, m.roi_height = self.roi
 
         if mjpg_lib.mjpg_next_head(m) != mjpg_lib.OK:
             return 0
@@ -169,23 +922,59 @@ class MjpgDecoder(object):
         return 1
 
 class MkvIter(object):
-    def __init__(self, filename, systime_offset, grey=False):
+    def __init__(self, filename, systime_offset, grey=False, follow=False,
+                 systime_samples=None, on_index=None, threads=1, thread_type=None,
+                 pixel_format=None, pool=None, size=None, crop=None, interpolation='bicubic',
+                 scale=1):
         self.m = lib.mkv_open(filename)
+        self.filename = filename
         self.systime_offset = systime_offset
+        self.follow = follow
         self.frm = ffi.new('struct mkv_frame *')
+        self.pixel_format = check_pixel_format(pixel_format, grey)
+        self.pool = pool
         self.out_of_packages = False
-        lib.mkv_next(self.m, self.frm)
+        # Frames read are recorded and passed to on_index if the end of the
+        # file is reached without seeking
+        self.on_index = on_index
+        self.captured = []
+        if systime_samples:
+            self.m.systime_samples = systime_samples
+        if lib.mkv_next(self.m, self.frm):
+            self.capture()
+        self.has_packet = True
+        self.need_packet = False
         assert self.m.codec_private
         assert self.m.codec_private_len > 0
         if ffi.string(self.m.codec_id) == b'V_MS/VFW/FOURCC':
-            self.decoder = MjpgDecoder()
+            self.decoder = MjpgDecoder(scale)
         else:
-            self.decoder = H264Decoder()
+            self.decoder = H264Decoder(threads, thread_type, self.pixel_format == 'grey')
 
         self.decoder.open(self.m)
+        self.width, self.height = self.m.width, self.m.height
+        if isinstance(self.decoder, H264Decoder):
+            if scale != 1:
+                if size is not None:
+                    raise ValueError("scale and size can not both be set")
+                size = scaled_size(*output_size(self.width, self.height, None, crop)[1],
+                                   scale=scale)
+            if size is not None or crop is not None:
+                crop, (self.width, self.height) = output_size(self.width, self.height, size, crop)
+                self.decoder.set_output(crop, (self.width, self.height), interpolation)
+        else:
+            if size is not None:
+                raise ValueError("size is only supported for H.264 video")
+            if crop is not None:
+                output_size(self.width, self.height, None, crop)
+            self.width, self.height = scaled_size(self.width, self.height, scale)
+            if crop is not None:
+                roi = scaled_crop(crop, scale)
+                self.width, self.height = roi[2:]
+                self.decoder.set_roi(roi)
         self.fcnt = 0
         self.pts = ffi.new('uint64_t *')
-        if grey:
+        if self.pixel_format == 'grey':
             self.channels = 1
         else:
             self.channels = 3
@@ -202,33 +991,107 @@ class MkvIter(object):
     def __iter__(self):
         return self
 
-    def next(self):
-        assert self.m.width > 0
-        if self.channels == 1:
-            shape = (self.m.height, self.m.width)
-        else:
-            shape = (self.m.height, self.m.width, self.channels)
+    def seek(self, offset):
+        """
+        Continue decoding from the cluster at *offset*.
+        """
+        lib.mkv_seek(self.m, offset)
+        # Frames from before the seek still in the decoder are dropped
+        self.decoder.flush()
+        self.on_index = self.captured = None
+        self.has_packet = lib.mkv_next(self.m, self.frm) != 0
+        self.need_packet = False
+
+    def skip_to(self, pts):
+        """
+        Skip the frames before *pts*. Those that later frames refer to are
+        decoded but not converted to the output format, the others are not
+        decoded at all.
+        """
+        self.decoder.skip_to(pts)
+
+    def capture(self):
+        if self.on_index is not None:
+            self.captured.append((self.frm.pts, self.frm.offset, self.frm.key_frame))
 
-        img = Frame(shape, 'B')
+    def next_packet(self):
+        if lib.mkv_next(self.m, self.frm):
+            self.capture()
+            return True
+        if self.on_index is not None:
+            self.on_index(self)
+            self.on_index = self.captured = None
+        if self.follow is False or self.out_of_packages:
+            return False
+        # Wait for more data to be appended to the file
+        last_data = time.time()
+        while self.follow is True or time.time() - last_data < self.follow:
+            time.sleep(FOLLOW_POLL_INTERVAL)
+            if lib.mkv_remap(self.m, self.filename, self.frm):
+                last_data = time.time()
+                if lib.mkv_next(self.m, self.frm):
+                    return True
+        self.out_of_packages = True
+        return False
+
+    def next(self, out=None):
+        assert self.width > 0
+        img = new_frame(self.pixel_format, self.width, self.height, out, self.pool)
         assert img.__array_interface__['strides'] is None
         pixels = ffi.cast('uint8_t *', img.__array_interface__['data'][0])
 
+        img.index = self.fcnt
+        img.pts = self.decode(pixels)
+        img.timestamp = float(img.pts) / 1000000.0
+        img.systime = float(img.pts + self.systime_offset) / 1000000.0
+        return img
+
+    def next_batch(self, out):
+        """
+        Decodes the following frames into the batch *out* (see
+        :func:`vi3o.utils.new_batch`) until it is full or the video ends. Returns the
+        part of *out* that was filled with the index, pts, timestamp and systime of
+        the frames as arrays.
+        """
+        pixels = ffi.cast('uint8_t *', out.__array_interface__['data'][0])
+        size = out[0].nbytes if len(out) else 0
+        index = np.arange(self.fcnt, self.fcnt + len(out))
+        pts = np.zeros(len(out), np.uint64)
+        count = 0
+        try:
+            while count < len(out):
+                pts[count] = self.decode(pixels + count * size)
+                count += 1
+        except StopIteration:
+            pass
+        batch = set_planes(out[:count], self.pixel_format, self.width, self.height)
+        batch.index = index[:count]
+        batch.pts = pts[:count]
+        batch.timestamp = batch.pts / 1000000.0
+        batch.systime = (batch.pts.astype(np.int64) + self.systime_offset) / 1000000.0
+        return batch
+
+    def decode(self, pixels):
+        # Decode the next frame into the buffer pointed to by pixels and
+        # return its pts
         while True:
-            r = self.decoder.decode_frame(self.frm, pixels, self.pts, self.channels == 1)
+            # The next packet is read just before it is needed to not hold
+            # back the current frame while following a file being written
+            if self.need_packet:
+                self.has_packet = self.next_packet()
+                self.need_packet = False
+            r = self.decoder.decode_frame(self.frm, pixels, self.pts, self.pixel_format)
             if r >= 0:
-                if lib.mkv_next(self.m, self.frm) == 0 and r == 0:
+                if not self.has_packet and r == 0:
                     raise StopIteration
+                self.need_packet = True
                 if r == 1:
                     break
+                # r == 2 means that a frame was skipped, see MkvIter.skip_to
             else:
                 raise DecodeError
-
-        img.index = self.fcnt
-        img.pts = self.pts[0]
-        img.timestamp = float(img.pts) / 1000000.0
-        img.systime = float(img.pts + self.systime_offset) / 1000000.0
         self.fcnt += 1
-        return img
+        return self.pts[0]
 
     def __next__(self):
         return self.next()
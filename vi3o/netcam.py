@@ -16,6 +16,7 @@ import requests
 from requests.auth import HTTPBasicAuth, HTTPDigestAuth
 
 from vi3o.image import imread
+from vi3o.mjpg import decode_jpeg, scale_denom
 from vi3o.utils import Frame
 
 
@@ -25,10 +26,13 @@ class AxisCam(object):
     resolution *width*x*height* using the *username* and *password* as credntials.
     If *no_proxy* is True, the proxy settings from the environment will be ignored
     and any other keyword parameter will be passed on to the camera as a VAPIX
-    parameter.
+    parameter. If *scale* is set to 1/2, 1/4 or 1/8, the images are decoded at that
+    scale, which is faster than decoding them at full resolution.
     """
-    def __init__(self, ip, width=None, height=None, username=None, password=None, no_proxy=False, **kwargs):
-
+    def __init__(self, ip, width=None, height=None, username=None, password=None, no_proxy=False,
+                 scale=1, **kwargs):
+        scale_denom(scale)
+        self.scale = scale
 
         if no_proxy:
             os.environ['NO_PROXY'] = ip
@@ -64,7 +68,10 @@ class AxisCam(object):
                 headers[l[:i]] = l[i+1:].strip()
 
         data = self._fd.read(int(headers[b'Content-Length']))
-        img = imread(StringIO(data)).view(Frame)
+        if self.scale == 1:
+            img = imread(StringIO(data)).view(Frame)
+        else:
+            img = decode_jpeg(data, scale=self.scale)
         img.index = self.fcnt
         self.fcnt += 1
         img.timestamp = img.systime = -1 # FIXME
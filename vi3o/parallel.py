@@ -0,0 +1,140 @@
+"""
+:mod:`vi3o.parallel` --- Parallel decoding
+==========================================
+
+A single H.264 decoder only uses a few cores, even with threading. The GOPs of a
+video, i.e. the frames from one keyframe up to the next, can however be decoded
+independently of each other. :func:`iter_frames` decodes several GOPs in parallel
+in separate processes and returns the frames in order:
+
+.. code-block:: python
+
+    from vi3o.mkv import Mkv
+    from vi3o.parallel import iter_frames
+
+    for img in iter_frames(Mkv("myfile.mkv"), workers=8):
+        ...
+
+"""
+
+import collections
+import multiprocessing
+
+import numpy as np
+
+from vi3o.utils import frame_shape, new_frame
+
+# GOPs shorter than this are decoded together with the following ones to not spend
+# more time passing work to the processes than decoding
+MIN_TASK_FRAMES = 16
+
+# Default limit of the total size of the buffers of the GOPs decoded ahead
+MAX_BUFFER_BYTES = 1 << 30
+
+_worker_video = None
+_worker_slots = None
+
+
+def _open_options(video):
+    # The arguments of Mkv that give the same index and frames as video. The index
+    # has been built and cached by the time the workers open the file.
+    return dict(systime_samples=video._systime_samples, pixel_format=video.pixel_format,
+                threads=video.threads, thread_type=video.thread_type, size=video.size,
+                crop=video.crop, interpolation=video.interpolation, scale=video.scale)
+
+
+def _init_worker(filename, options, slots, shape):
+    global _worker_video, _worker_slots
+    from vi3o.mkv import Mkv
+    _worker_video = Mkv(filename, **options)
+    _worker_slots = [np.frombuffer(slot, 'B').reshape((-1,) + shape) for slot in slots]
+
+
+def _decode_range(slot, start, count):
+    # Decodes frames start to start + count into the shared buffer slot and returns
+    # the number of frames decoded and their metadata
+    batch = _worker_video.read_batch(start, count, _worker_slots[slot][:count])
+    return len(batch), batch.index, batch.pts, batch.timestamp, batch.systime
+
+
+def gop_ranges(video):
+    """
+    Returns a list of ranges (start, stop) of frame numbers of *video* that each
+    start with a keyframe and can be decoded independently of the others. Short
+    GOPs are merged to hold at least :data:`MIN_TASK_FRAMES` frames.
+    """
+    frame = video.frame
+    keyframes = list(np.flatnonzero(frame['key_frame'])) + [len(frame)]
+    if keyframes[0] != 0:
+        keyframes.insert(0, 0)
+    ranges = []
+    for start, stop in zip(keyframes[:-1], keyframes[1:]):
+        if ranges and ranges[-1][1] - ranges[-1][0] < MIN_TASK_FRAMES:
+            ranges[-1] = (ranges[-1][0], int(stop))
+        else:
+            ranges.append((int(start), int(stop)))
+    return ranges
+
+
+def iter_frames(video, workers=None, readahead=None, max_buffer_bytes=None):
+    """
+    Iterates over the frames of the :class:`vi3o.mkv.Mkv` *video* in order, decoding
+    GOPs in parallel in *workers* processes (default one per cpu core). Each process
+    opens the file of *video* with the same decoding options, loading the cached
+    index, and decodes its GOPs into buffers in shared memory from where the frames
+    are copied out in order. At most *readahead* GOPs (default the number of workers)
+    are decoded ahead of the frame last returned, each using one buffer large enough
+    for the longest GOP of the video. Fewer GOPs are decoded ahead, by fewer workers,
+    if the buffers would need more than *max_buffer_bytes* bytes (default
+    :data:`MAX_BUFFER_BYTES`), but always at least one.
+    """
+    ranges = gop_ranges(video)
+    if not ranges:
+        return
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if readahead is None:
+        readahead = workers
+    if max_buffer_bytes is None:
+        max_buffer_bytes = MAX_BUFFER_BYTES
+
+    width, height = video.myiter.width, video.myiter.height
+    shape = frame_shape(video.pixel_format, width, height)
+    slot_frames = max(stop - start for start, stop in ranges)
+    slot_bytes = slot_frames * int(np.prod(shape))
+    readahead = max(1, min(readahead, len(ranges), max_buffer_bytes // slot_bytes))
+    workers = max(1, min(workers, readahead))
+    slots = [multiprocessing.RawArray('B', slot_bytes) for _ in range(readahead)]
+    views = [np.frombuffer(slot, 'B').reshape((-1,) + shape) for slot in slots]
+
+    filename = video.filename.decode('utf-8')
+    pool = multiprocessing.Pool(workers, _init_worker,
+                                (filename, _open_options(video), slots, shape))
+    try:
+        free = list(range(readahead))
+        pending = collections.deque()
+        tasks = iter(ranges)
+        while True:
+            while free:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                slot = free.pop()
+                start, stop = task
+                pending.append((slot, pool.apply_async(_decode_range, (slot, start, stop - start))))
+            if not pending:
+                break
+            slot, result = pending.popleft()
+            count, index, pts, timestamp, systime = result.get()
+            for i in range(count):
+                img = new_frame(video.pixel_format, width, height, pool=video.pool)
+                img[...] = views[slot][i]
+                img.index = int(index[i])
+                img.pts = int(pts[i])
+                img.timestamp = float(timestamp[i])
+                img.systime = float(systime[i])
+                yield img
+            free.append(slot)
+    finally:
+        pool.terminate()
+        pool.join()
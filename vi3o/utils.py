@@ -1,14 +1,337 @@
-import sys, os, hashlib
+import sys, os, hashlib, json, shutil, struct, time, collections, threading, weakref
+from contextlib import contextmanager
 import numpy as np
 import vi3o
 from vi3o import compat
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 if sys.version_info > (3,):
     xrange = range
+    import queue
+else:
+    import Queue as queue
 
 class Frame(np.ndarray):
     pass
 
+# Values of the pixel_format argument to the video classes
+PIXEL_FORMATS = ('rgb', 'grey', 'yuv420p')
+
+def check_pixel_format(pixel_format, grey):
+    """
+    Returns the pixel format to use for the *pixel_format* and *grey* arguments of a
+    video class, where *pixel_format* defaults to ``'grey'`` or ``'rgb'`` depending on
+    *grey*.
+    """
+    if pixel_format is None:
+        return 'grey' if grey else 'rgb'
+    if pixel_format not in PIXEL_FORMATS:
+        raise ValueError("Unknown pixel_format %r, expected one of %s" %
+                         (pixel_format, ', '.join(PIXEL_FORMATS)))
+    return pixel_format
+
+def frame_shape(pixel_format, width, height):
+    """
+    Returns the shape of the :class:`Frame` holding a *width* x *height* image in
+    *pixel_format*. The I420 images of the ``'yuv420p'`` format, i.e. a full
+    resolution Y plane followed by U and V planes subsampled by 2 in both directions,
+    have the shape (height * 3 // 2, width), or are flat if the size is odd.
+    """
+    if pixel_format == 'yuv420p':
+        if width % 2 == 0 and height % 2 == 0:
+            return (height * 3 // 2, width)
+        return (width * height + 2 * ((width + 1) // 2) * ((height + 1) // 2),)
+    if pixel_format == 'grey':
+        return (height, width)
+    return (height, width, 3)
+
+def output_size(width, height, size=None, crop=None):
+    """
+    Returns the region (x, y, w, h) of a *width* x *height* image selected by *crop*
+    and the size (w, h) that region is scaled to, which is *size*. Either of the
+    dimensions of *size* can be None to keep the aspect ratio of the region.
+    """
+    if crop is None:
+        crop = (0, 0, width, height)
+    x, y, w, h = [int(v) for v in crop]
+    if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > width or y + h > height:
+        raise ValueError("crop %r is not inside the %dx%d frame" % (tuple(crop), width, height))
+    if size is None:
+        return (x, y, w, h), (w, h)
+    out_width, out_height = size
+    if out_width is None and out_height is None:
+        out_width, out_height = w, h
+    elif out_width is None:
+        out_width = max(1, int(round(float(out_height) * w / h)))
+    elif out_height is None:
+        out_height = max(1, int(round(float(out_width) * h / w)))
+    if out_width <= 0 or out_height <= 0:
+        raise ValueError("Bad size %r" % (tuple(size),))
+    return (x, y, w, h), (int(out_width), int(out_height))
+
+def new_frame(pixel_format, width, height, out=None, pool=None):
+    """
+    Returns a :class:`Frame` to decode a *width* x *height* image in *pixel_format*
+    into. If *out* is given, it has to be a contiguous uint8 array of the right shape
+    (see :func:`frame_shape`) and the image is decoded into it. Otherwise a buffer is
+    taken from the :class:`FramePool` *pool* if given, or allocated. The planes of
+    ``'yuv420p'`` images can be accessed as views in the *y*, *u* and *v* attributes
+    of the frame.
+    """
+    shape = frame_shape(pixel_format, width, height)
+    if out is None and pool is not None:
+        out = pool.get(shape)
+    if out is None:
+        img = Frame(shape, 'B')
+    else:
+        if out.shape != shape or out.dtype != np.uint8 or not out.flags.c_contiguous:
+            raise ValueError("out has to be a contiguous uint8 array of shape %r" % (shape,))
+        img = out if isinstance(out, Frame) else out.view(Frame)
+    return set_planes(img, pixel_format, width, height)
+
+def new_batch(pixel_format, width, height, count, out=None):
+    """
+    Returns a :class:`Frame` of shape (count,) + :func:`frame_shape` to decode *count*
+    consecutive *width* x *height* images in *pixel_format* into. If *out* is given,
+    it has to be a contiguous uint8 array of that shape and the images are decoded
+    into it.
+    """
+    shape = (count,) + frame_shape(pixel_format, width, height)
+    if out is None:
+        return Frame(shape, 'B')
+    if out.shape != shape or out.dtype != np.uint8 or not out.flags.c_contiguous:
+        raise ValueError("out has to be a contiguous uint8 array of shape %r" % (shape,))
+    return out if isinstance(out, Frame) else out.view(Frame)
+
+def set_planes(img, pixel_format, width, height):
+    """
+    Sets the *y*, *u* and *v* attributes of the frame or batch of frames *img* to views
+    of its planes if *pixel_format* is ``'yuv420p'``. Returns *img*.
+    """
+    if pixel_format == 'yuv420p':
+        chroma_width, chroma_height = (width + 1) // 2, (height + 1) // 2
+        luma = width * height
+        chroma = luma + chroma_width * chroma_height
+        shape = frame_shape(pixel_format, width, height)
+        lead = img.shape[:-len(shape)]
+        flat = img.reshape(lead + (int(np.prod(shape)),))
+        img.y = flat[..., :luma].reshape(lead + (height, width))
+        img.u = flat[..., luma:chroma].reshape(lead + (chroma_height, chroma_width))
+        img.v = flat[..., chroma:].reshape(lead + (chroma_height, chroma_width))
+    return img
+
+# Per frame metadata of batches of frames and their types
+BATCH_METADATA = [('index', np.int64), ('pts', np.uint64),
+                  ('timestamp', np.float64), ('systime', np.float64)]
+
+def join_batches(batch, parts):
+    """
+    Sets the metadata arrays of *batch* to the concatenation of the metadata of *parts*,
+    which are frames or batches of frames that together make up *batch*. Only metadata
+    present in all parts is kept, or all of it is empty if there are no parts. Returns
+    *batch*.
+    """
+    for name, dtype in BATCH_METADATA:
+        if not parts:
+            setattr(batch, name, np.zeros(0, dtype))
+        elif all(hasattr(part, name) for part in parts):
+            setattr(batch, name, np.concatenate([np.atleast_1d(np.asarray(getattr(part, name), dtype))
+                                                 for part in parts]))
+    return batch
+
+class FramePool(object):
+    """
+    A bounded ring of at most *size* reusable frame buffers. Passing it as the *pool*
+    argument of :class:`vi3o.mkv.Mkv` or :class:`vi3o.mjpg.Mjpg` makes them decode into
+    a buffer from the pool that is no longer in use instead of allocating a new one
+    for every frame. A buffer is in use as long as there are references to a frame
+    decoded into it, or to any view of such a frame. If all buffers are in use,
+    frames are allocated as usual. The pool can be shared between videos.
+    """
+    def __init__(self, size=8):
+        self.size = size
+        # Each buffer is a [memory, weakref to the array last returned for it] pair
+        self._buffers = collections.deque()
+        self._lock = threading.Lock()
+
+    def get(self, shape):
+        """
+        Returns an unused buffer of *shape*, or None if all buffers are in use.
+        """
+        size = int(np.prod(shape))
+        with self._lock:
+            for i in range(len(self._buffers)):
+                buf = self._buffers[0]
+                self._buffers.rotate(-1)
+                if buf[1]() is None:
+                    if len(buf[0]) != size:
+                        buf[0] = bytearray(size)
+                    return self._use(buf, shape)
+            if len(self._buffers) < self.size:
+                buf = [bytearray(size), None]
+                self._buffers.append(buf)
+                return self._use(buf, shape)
+        return None
+
+    def _use(self, buf, shape):
+        # Frames decoded into the array, and all views of them, have it as their
+        # base, since its own base is not an array. It is thus alive as long as any
+        # of them are.
+        arr = np.frombuffer(buf[0], 'B')
+        buf[1] = weakref.ref(arr)
+        return arr.reshape(shape)
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def __getstate__(self):
+        # The buffers are not copied when pickling
+        return {'size': self.size}
+
+    def __setstate__(self, state):
+        self.__init__(state['size'])
+
+class FrameCache(object):
+    """
+    A cache of decoded frames of at most *size* bytes, keyed by their frame number.
+    Passing it as the *frame_cache* argument of :class:`vi3o.mkv.Mkv` keeps the frames
+    decoded for random access, including the ones decoded on the way from a keyframe
+    to the frame asked for, so that accessing them again does not decode anything.
+    When the cache is full, the least recently used frames are evicted, or the oldest
+    ones if *policy* is ``'fifo'``. Each video needs a cache of its own.
+    """
+    def __init__(self, size=256 * 1024 * 1024, policy='lru'):
+        if policy not in ('lru', 'fifo'):
+            raise ValueError("Unknown policy %r, expected 'lru' or 'fifo'" % (policy,))
+        self.size = size
+        self.policy = policy
+        self.nbytes = 0
+        self._frames = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the frame cached as *key*, or None.
+        """
+        with self._lock:
+            img = self._frames.get(key)
+            if img is not None and self.policy == 'lru':
+                del self._frames[key]
+                self._frames[key] = img
+            return img
+
+    def put(self, key, img):
+        """
+        Caches the frame *img* as *key*. Frames larger than the cache are not cached.
+        """
+        with self._lock:
+            if key in self._frames:
+                self.nbytes -= self._frames.pop(key).nbytes
+            if img.nbytes > self.size:
+                return
+            while self.nbytes + img.nbytes > self.size:
+                self.nbytes -= self._frames.popitem(last=False)[1].nbytes
+            self._frames[key] = img
+            self.nbytes += img.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.nbytes = 0
+
+    def __contains__(self, key):
+        return key in self._frames
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __getstate__(self):
+        # The frames are not copied when pickling
+        return {'size': self.size, 'policy': self.policy}
+
+    def __setstate__(self, state):
+        self.__init__(state['size'], state['policy'])
+
+def _prefetch(it, ready, stop):
+    # Runs in the thread of a PrefetchIter, puts (True, item) for each item of it
+    # and then (False, exception) with the exception that ended the iteration
+    def put(item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    try:
+        for item in it:
+            if not put((True, item)):
+                return
+        put((False, StopIteration()))
+    except Exception as e:
+        put((False, e))
+
+class PrefetchIter(object):
+    """
+    Iterates over the iterator *it* in a background thread, which keeps up to *size*
+    items ready ahead of the one last returned. When *it* decodes frames, the decoding
+    is done while the frames already returned are processed. Exceptions raised by *it*
+    are raised again when the item they replaced is reached. The thread stops when the
+    iteration ends, when :meth:`close` is called or when the :class:`PrefetchIter` is
+    garbage collected.
+    """
+    def __init__(self, it, size):
+        self.it = it
+        self._ready = queue.Queue(size)
+        self._stop = threading.Event()
+        self._done = False
+        self._thread = threading.Thread(target=_prefetch, args=(it, self._ready, self._stop))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+        ok, item = self._ready.get()
+        if ok:
+            return item
+        self._done = True
+        raise item
+
+    def __next__(self):
+        return self.next()
+
+    def close(self):
+        """
+        Stops the background thread and drops the items not yet returned.
+        """
+        self._done = True
+        self._stop.set()
+        while True:
+            try:
+                self._ready.get_nowait()
+            except queue.Empty:
+                break
+
+    def __del__(self):
+        self.close()
+
+def iter_indexes(video, indexes):
+    """
+    Iterates over the frames of *video* with the increasing or decreasing frame numbers
+    *indexes*, using its iter_indexes method if it has one, see
+    :meth:`vi3o.mkv.Mkv.iter_indexes`.
+    """
+    if hasattr(video, 'iter_indexes'):
+        return video.iter_indexes(indexes)
+    return (video[i] for i in indexes)
+
 class SlicedView(object):
     def __init__(self, parent, indexes, properties=()):
         self.parent = parent
@@ -18,6 +341,12 @@ class SlicedView(object):
     def __getitem__(self, item):
         return self.parent[self.range[item]]
 
+    def __iter__(self):
+        return iter_indexes(self.parent, self.range)
+
+    def iter_indexes(self, indexes):
+        return iter_indexes(self.parent, [self.range[i] for i in indexes])
+
     def __len__(self):
         return len(self.range)
 
@@ -73,6 +402,10 @@ class VideoFilter:
         for f in self.video:
             yield self._filter(f)
 
+    def iter_indexes(self, indexes):
+        for f in iter_indexes(self.video, indexes):
+            yield self._filter(f)
+
     def __len__(self):
         return len(self.video)
 
@@ -110,16 +443,202 @@ def copy_missing_metadata(dst_img, template_frame):
         try_set_attribute(dst_frame, attribute)
     return dst_frame
 
-cache_dir = os.path.join(os.path.expanduser('~'), ".cache", "vi3o")
+cache_dir = os.environ.get('VI3O_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), ".cache", "vi3o"))
+
+# Directories with index files built on other hosts. They are searched for index
+# files missing in cache_dir, which are then copied into cache_dir.
+shared_cache_dirs = [d for d in os.environ.get('VI3O_SHARED_CACHE', '').split(os.pathsep) if d]
+
+# Store index files in a .vi3o directory next to the videos if it is writable. If it is
+# not, existing index files there are used as if they were in a shared cache directory.
+sidecar_index = os.environ.get('VI3O_SIDECAR_INDEX', '') not in ('', '0')
+
+def _index_key(key):
+    return hashlib.md5(str(key).encode()).hexdigest() + '.idx'
+
+def _sidecar_index_file(fn, extradata, stats):
+    # Keyed on the basename to be independent of where the directory is mounted
+    if isinstance(fn, bytes):
+        fn = fn.decode('utf-8')
+    d = os.path.join(os.path.dirname(os.path.abspath(fn)), '.vi3o')
+    if stats is None:
+        key = (os.path.basename(fn), 'appendable', extradata)
+    else:
+        key = (os.path.basename(fn), stats.st_size, stats.st_mtime, extradata)
+    return os.path.join(d, _index_key(key))
+
+def index_file(fn, extradata=None, appendable=False):
+    """
+    Returns the path of the cached index file for the video *fn*. The index file
+    is specific to the current size and modification time of the video, unless
+    *appendable* is True. In that case it is up to the caller to detect changes.
+    See :mod:`vi3o.cache` for where the index files are stored.
+    """
+    from vi3o import cache
+
+    stats = None if appendable else os.stat(fn)
+    shared = []
+    if sidecar_index:
+        sidecar = _sidecar_index_file(fn, extradata, stats)
+        try:
+            os.makedirs(os.path.dirname(sidecar))
+        except OSError:
+            pass
+        if os.access(os.path.dirname(sidecar), os.W_OK):
+            return sidecar
+        shared.append(sidecar)
 
-def index_file(fn, extradata=None):
-    stats = os.stat(fn)
-    key = str((os.path.abspath(fn), stats.st_size, stats.st_mtime, extradata))
-    key = hashlib.md5(key.encode()).hexdigest()
-    path = os.path.join(cache_dir, key + '.idx')
+    if appendable:
+        key = (os.path.abspath(fn), 'appendable', extradata)
+    else:
+        key = (os.path.abspath(fn), stats.st_size, stats.st_mtime, extradata)
+    name = _index_key(key)
+    path = os.path.join(cache_dir, name)
     d = os.path.dirname(path)
     try:
         os.makedirs(d)
     except OSError:
         pass
+
+    if os.path.exists(path):
+        cache.touch(path)
+        return path
+    shared.extend(os.path.join(d, name) for d in shared_cache_dirs)
+    for shared_path in shared:
+        if os.path.exists(shared_path):
+            tmp = path + '.tmp.%d' % os.getpid()
+            shutil.copyfile(shared_path, tmp)
+            os.replace(tmp, path)
+            break
+    cache.evict_soon()
     return path
+
+# Seconds to wait for another process to finish building an index before
+# building it anyway
+INDEX_LOCK_TIMEOUT = 600
+
+@contextmanager
+def index_lock(path, timeout=None):
+    """
+    Context manager that holds an advisory lock on the index file *path* while the index
+    is built, to make other processes building the same index wait for it to be finished
+    instead of doing the same work. Existing index files should be loaded without taking
+    the lock, and looked for again once it is held. If the lock can't be acquired within
+    *timeout* seconds (default :data:`INDEX_LOCK_TIMEOUT`), or the lock file can't be
+    created, e.g. in a read-only cache, the block is executed without it. The lock is
+    not reentrant.
+    """
+    if fcntl is None:
+        yield
+        return
+    if timeout is None:
+        timeout = INDEX_LOCK_TIMEOUT
+    fd = _lock_file(path + '.lock', time.time() + timeout)
+    try:
+        yield
+    finally:
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            fd.close()
+
+def _lock_file(lock, deadline):
+    # Returns the opened and locked file *lock*, or None if it could not be locked
+    while True:
+        try:
+            fd = open(lock, 'a')
+        except (IOError, OSError):
+            return None
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError):
+                if time.time() > deadline:
+                    fd.close()
+                    return None
+                time.sleep(0.05)
+        if _is_linked(fd, lock):
+            return fd
+        # Removed by remove_index_lock while waiting, lock the new file instead
+        fd.close()
+
+def _is_linked(fd, path):
+    # True if the open file *fd* is the one at *path*
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    fst = os.fstat(fd.fileno())
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+def remove_index_lock(path):
+    """
+    Removes the lock file used by :func:`index_lock` for the index file *path*, unless
+    it is locked.
+    """
+    lock = path + '.lock'
+    if fcntl is None or not os.path.exists(lock):
+        return
+    try:
+        fd = open(lock, 'a')
+    except (IOError, OSError):
+        return
+    with fd:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return
+        # Processes that opened it before it is removed notice it once they lock it
+        if _is_linked(fd, lock):
+            try:
+                os.unlink(lock)
+            except OSError:
+                pass
+
+
+INDEX_MAGIC = b'VI3OIDX\0'
+
+def save_index(path, frame, replace=False, **meta):
+    """
+    Save the structured numpy array *frame* together with the json serializable *meta*
+    data into the index file *path*. The array is stored raw after a small header, aligned
+    to allow :func:`load_index` to memory map it. The file is written under a temporary
+    name and then linked into place, which means that an already existing index is kept
+    unless *replace* is True.
+    """
+    header = json.dumps(dict(meta, dtype=frame.dtype.descr, count=len(frame))).encode()
+    start = len(INDEX_MAGIC) + 4 + len(header)
+    header += b' ' * (-start % 64)
+    tmp = path + '.tmp.%d' % os.getpid()
+    with open(tmp, 'wb') as fd:
+        fd.write(INDEX_MAGIC)
+        fd.write(struct.pack('<I', len(header)))
+        fd.write(header)
+        fd.write(np.ascontiguousarray(frame).tobytes())
+    if replace:
+        os.replace(tmp, path)
+        return
+    try:
+        os.link(tmp, path)
+    except FileExistsError:
+        pass
+    os.unlink(tmp)
+
+def load_index(path):
+    """
+    Load an index file saved by :func:`save_index`. Returns the meta data dict and the
+    array, which is memory mapped read-only from the file. Raises ValueError if *path*
+    is not a binary index file.
+    """
+    with open(path, 'rb') as fd:
+        if fd.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError("Not a binary index file: " + path)
+        size, = struct.unpack('<I', fd.read(4))
+        meta = json.loads(fd.read(size).decode())
+    dtype = np.dtype([tuple(field) for field in meta.pop('dtype')])
+    count = meta.pop('count')
+    if count == 0:
+        return meta, np.zeros(0, dtype)
+    offset = len(INDEX_MAGIC) + 4 + size
+    return meta, np.memmap(path, dtype, 'r', offset, (count,))